@@ -8,13 +8,21 @@
 
 
 import os
+import json
+import multiprocessing
+import subprocess
+import traceback
 from datetime import datetime
+from time import time
 from fabric.api import task, env
+from fabric.network import disconnect_all
 from pprint import PrettyPrinter
 import sys
 
+# first, so that FAB_PROFILE covers the imports below
+from lib.profiling import finish_import_profile, profile_tasks
 
-from bookshelf.api_v1 import ssh_session
+from bookshelf.api_v1 import ssh_session, log_yellow
 from bookshelf.api_v2.logging_helpers import log_green, log_red
 
 from bookshelf.api_v3.cloud_instance import Distribution
@@ -26,13 +34,86 @@ from lib.mycookbooks import (setup_fab_env,
                              parse_config,
                              has_state,
                              load_state,
-                             save_state)
-
-
+                             save_state,
+                             update_state,
+                             new_build_id,
+                             STATE_FILE_NAME)
+
+
+from lib.images import (record_image,
+                        update_image,
+                        find_image,
+                        is_promoted,
+                        latest_images,
+                        load_images)
+from lib.fingerprint import build_inputs, fingerprint
+from lib.pool import (MAX_IDLE_AGE,
+                      pooled_count,
+                      pool_key,
+                      configure_pool,
+                      add_to_pool,
+                      claim_from_pool)
+from lib.matrix import (CLOUD_LIMITS,
+                        EXECUTORS,
+                        MatrixScheduler,
+                        expected_durations,
+                        target_name)
+from lib.work_queue import (FAILED as QUEUE_FAILED,
+                             LEASE,
+                             QueueWorker,
+                             open_queue)
+from lib.throttle import ThrottledClient
+from lib.footprint import (instance_disk_used,
+                           human_bytes,
+                           slim as slim_instance)
+from lib.bench import (CloudBackend,
+                       LocalBackend,
+                       measure_boot,
+                       summarize,
+                       save_bench,
+                       load_bench,
+                       compare)
+from lib.image_jobs import (PENDING as JOB_PENDING,
+                            DONE as JOB_DONE,
+                            FAILED as JOB_FAILED,
+                            WAIT_TIMEOUT,
+                            add_job,
+                            fail_stale_jobs,
+                            heartbeat,
+                            load_jobs,
+                            update_job,
+                            unreported_handles,
+                            wait_for_jobs)
+from lib.poller import (SharedPoller,
+                        instance_id,
+                        image_id as image_id_of,
+                        INSTANCE,
+                        IMAGE,
+                        RUNNING,
+                        AVAILABLE,
+                        FAILED,
+                        MISSING,
+                        TERMINATED)
+from lib.manifest import (capture_manifest,
+                          save_manifest,
+                          load_manifest,
+                          diff_manifests)
+
+from lib.metrics import (record_build,
+                         finish_build,
+                         flush_api_calls,
+                         timed_stage,
+                         report as metrics_report)
+from lib.plan import History, check_config, format_plan, plan_build
+from lib.builder import OBJECTIVES, TYPE_KEYS, builder_candidates
+from lib.preflight import all_targets, load_cloud_config, validate_targets
+from lib.check_selection import full_run_due, select_checks
 from lib.bootstrap import (bootstrap_jenkins_slave_centos7,
-                           bootstrap_jenkins_slave_ubuntu14)
+                           bootstrap_jenkins_slave_ubuntu14,
+                           centos7_bootstrap_steps,
+                           ubuntu14_bootstrap_steps)
 
-from tests.acceptance import acceptance_tests
+from tests.acceptance import acceptance_tests, checks_for
 
 
 CLOUD_YAML_FILE = {
@@ -57,12 +138,57 @@ def help():
         # creates a new instance
         $ fab cloud:ec2|rackspace|gce region:us-west-2 distribution:centos7 up
 
+        # up does nothing when an image was already built from the same
+        # config, bootstrap code and package lists. Include the upstream
+        # revisions in that check, or rebuild regardless with:
+        $ fab cloud:ec2 region:us-west-2 distribution:centos7 upstream up
+        $ fab cloud:ec2 region:us-west-2 distribution:centos7 force up
+
+        # keeps 2 booted base instances around, which up claims instead
+        # of booting a new instance. Instances idle for longer than 6 hours
+        # are recycled.
+        $ fab cloud:ec2 region:us-west-2 distribution:centos7 pool_fill:2
+
+        # boots the builder on the instance type of builder_types in the
+        # cloud yaml file with the shortest, or the cheapest, predicted
+        # build according to metrics.db
+        $ fab cloud:ec2 region:us-west-2 distribution:centos7 builder:time up
+        $ fab cloud:ec2 region:us-west-2 distribution:centos7 builder:cost up
+
         # installs packages on an existing instance
         $ fab bootstrap
 
+        # installs packages, compiling each reboot-free segment of the
+        # bootstrap into a single uploaded shell script
+        $ fab batch bootstrap
+
+        # installs packages, running independent steps concurrently,
+        # at most 4 at a time
+        $ fab parallel:4 bootstrap
+
+        # removes package caches, build leftovers and logs, and zeroes the
+        # free space, before creating the image
+        $ fab slim
+
         # creates a new ami
         $ fab create_image
 
+        # same, leaving the imaging to a background worker, destroy then
+        # waits for the image before destroying the instance
+        $ fab create_image:wait=no destroy
+
+        # boots a fresh instance from the image of the build and runs the
+        # acceptance tests against it, while destroy tears the builder
+        # down. The image is promoted in images.json only when they pass,
+        # up and tests only build on promoted images
+        $ fab verify
+
+        # wait for the background image creations, and report them
+        $ fab wait_images
+
+        # show what changed between two images we created
+        $ fab diff_images:ami-636c8d03,ami-0419256a
+
         # list our images on the cloud provider
         $ fab list_images
 
@@ -81,9 +207,69 @@ def help():
         # execute a command on the instance
         $ fab ssh:'ls -l'
 
-        # run acceptance tests against new instance
+        # run acceptance tests against new instance. Only the smoke tests
+        # and the tests the changes since the previous image affect run,
+        # unless the last full run of the target is a week old
         $ fab tests
 
+        # run all the acceptance tests
+        $ fab full tests
+
+        # boot throwaway instances from images and run the acceptance
+        # tests against them, 4 at a time
+        $ fab verify_images:ami-636c8d03,ami-0419256a,parallel=4
+
+        # same, for the latest image of every cloud/region/distribution
+        $ fab verify_images:latest
+
+        # check the config, environment variables, key files and base
+        # images of every target in well under a second, or of some of
+        # them, also looking the AMIs up on ec2. up, matrix and enqueue
+        # run the same checks first
+        $ fab preflight
+        $ fab preflight:ec2/us-west-2/centos7,images=yes
+
+        # show the stages and steps a build would run, with estimates from
+        # metrics.db, without booting anything
+        $ fab cloud:ec2 region:us-west-2 distribution:centos7 plan
+
+        # same, for all the targets, as json
+        $ fab plan:all,format=json
+
+        # build every target of the cloud yaml files, longest expected
+        # build first, 32 at a time and at most 12 on ec2
+        $ fab matrix:executors=32,ec2=12
+
+        # same, for some targets only
+        $ fab batch matrix:ec2/us-west-2/centos7,gce/default/ubuntu1404
+
+        # boot the latest image of the target 5 times at once, and compare
+        # its boot latency with the previous image
+        $ fab cloud:ec2 region:us-west-2 distribution:centos7 bench_boot:count=5
+
+        # same, with a local docker image as a stand-in for a cloud image
+        $ fab bench_boot:centos/systemd,backend=local,against=centos/systemd
+
+        # queue the builds of every target, or of some of them, in the work
+        # queue CI_SLAVE_QUEUE points at, queue.db by default. Workers on
+        # any number of controllers sharing it claim and build them, 2 at a
+        # time here. The build of a worker that dies goes to another worker
+        # once its 300s lease expires
+        $ fab batch enqueue
+        $ fab enqueue:ec2/us-west-2/centos7,gce/default/ubuntu1404
+        $ fab queue_worker:slots=2,lease=300
+        $ fab queue_status
+
+        # p50/p95 step durations, weekly build trends and regressions per
+        # region over the last 30 days
+        $ fab report:30
+
+        # profile the tasks on the controller, writing a profile per task
+        # and a summary of where the time went to profiles/. FAB_PROFILE=1
+        # does the same for every fab run, and profiles the imports too
+        $ fab profile up bootstrap
+        $ FAB_PROFILE=1 fab tests
+
         The following environment variables must be set:
 
         For AWS:
@@ -119,7 +305,12 @@ def help():
         # GCE_PROJECT (The GCE project to create the image in)
         gce.yaml contains provisioning and configuration parameter
 
-        Metadata state is stored locally in .state.json.
+        Metadata state is stored locally in .state.json, or in the file
+        CI_SLAVE_STATE_FILE points at.
+        The output of every bootstrap step is stored in
+        logs/<build_id>/<step>.log.gz, and linked from .state.json.
+        Stage and step durations of every build are recorded in metrics.db,
+        fab report shows their percentiles, trends and regressions.
 
           """)
 
@@ -133,15 +324,17 @@ def get_config():
     return config
 
 
-def _get_cloud_instance_factory(cloud):
+def _get_cloud_instance_factory(cloud, region, config):
+    """ returns the instance factory of cloud, behind the API throttle """
     if cloud == 'ec2':
-        return EC2Instance
+        factory = EC2Instance
     elif cloud == 'rackspace':
-        return RackspaceInstance
+        factory = RackspaceInstance
     elif cloud == 'gce':
-        return GCEInstance
+        factory = GCEInstance
     else:
         raise KeyError('Unknown cloud %s' % cloud)
+    return ThrottledClient(factory, cloud, region, config)
 
 
 def _setup_fab_for_instance(instance):
@@ -151,12 +344,14 @@ def _setup_fab_for_instance(instance):
 
 
 def _save_state_from_instance(instance):
-    state = {
+    # keep what the build recorded besides the instance, e.g. its step logs
+    state = load_state() if has_state() else {}
+    state.update({
         'cloud': instance.cloud_type,
         'region': instance.region,
         'distro': instance.distro.value,
         'state': instance.get_state()
-    }
+    })
     save_state(state)
 
 
@@ -179,19 +374,135 @@ def _get_platform_config(cloud, region, distro):
     if not instance_config:
         instance_config = instance_configs['default']
 
+    # the builder type up picked, see lib/builder.py
+    if env.config.get('builder_type'):
+        instance_config[TYPE_KEYS[cloud]] = env.config['builder_type']
+
     return instance_config
 
 
+def _bootstrap_steps(username, distro):
+    if distro == Distribution.CENTOS7:
+        return centos7_bootstrap_steps(username, distro)
+    return ubuntu14_bootstrap_steps(username, distro)
+
+
+def _choose_builder(cloud, region, distro):
+    """ picks the instance type of the builder for env.config['builder']
+
+    :return dict: the choice, or None to keep the type of the config
+    """
+    config = _get_platform_config(cloud, region, distro)
+    configured = config.get(TYPE_KEYS[cloud])
+    builder_types = parse_config(CLOUD_YAML_FILE[cloud]).get(
+        'builder_types', {})
+    candidates = builder_candidates(
+        cloud, distro, _bootstrap_steps(config['username'], distro),
+        builder_types, env.config['builder'])
+    if not candidates:
+        log_yellow('No build history to pick a builder from, '
+                   'building on {}'.format(configured))
+        return None
+    for candidate in candidates:
+        print('{:<24} {:6d}s  ${:.3f}  {}'.format(
+            candidate['type'], int(candidate['seconds']),
+            candidate['cost'], candidate['basis']))
+    choice = dict(candidates[0], objective=env.config['builder'],
+                  configured=configured)
+    log_green('Building on {}, the best {} of {} types'.format(
+        choice['type'], env.config['builder'], len(candidates)))
+    env.config['builder_type'] = choice['type']
+    return choice
+
+
+def _start_build(cloud, region, distro):
+    """ starts a new build in the state file and the metrics database """
+    build_id = new_build_id(cloud, region, distro)
+    save_state({'build_id': build_id})
+    config = _get_platform_config(cloud, region, distro)
+    record_build(build_id, cloud, region, distro,
+                 config.get('instance_type') or config.get('machine_type'))
+
+
 def create_new_intance_from_config(cloud, distro, region):
-    cloud_instance_factory = _get_cloud_instance_factory(cloud)
+    config = _get_platform_config(cloud, region, distro)
+    cloud_instance_factory = _get_cloud_instance_factory(cloud, region,
+                                                         config)
 
     log_green('Creating an instance from configuration...')
-    instance = cloud_instance_factory.create_from_config(
-        _get_platform_config(cloud, region, distro),
-        distro, region)
+    instance = cloud_instance_factory.create_from_config(config, distro,
+                                                         region)
+    log_green('...Done')
+
+    _setup_fab_for_instance(instance)
+    _start_build(cloud, region, distro)
+    _save_state_from_instance(instance)
+    return instance
+
+
+def _refill_pool_in_background(cloud, region, distro, size):
+    """ runs pool_fill in a separate process, logging to logs/ """
+    if not os.path.isdir('logs'):
+        os.makedirs('logs')
+    log_file = open(os.path.join('logs', 'pool_fill-{}-{}-{}.log'.format(
+        cloud, region, distro.value)), 'a')
+    subprocess.Popen(['fab',
+                      'cloud:{}'.format(cloud),
+                      'region:{}'.format(region),
+                      'distribution:{}'.format(distro.value),
+                      'pool_fill:{}'.format(size)],
+                     stdout=log_file, stderr=subprocess.STDOUT,
+                     close_fds=True)
+
+
+def _destroy_pooled(instance_factory, config, instance_state):
+    """ destroys an instance taken out of the warm pool """
+    try:
+        instance_factory.create_from_saved_state(config,
+                                                 instance_state).destroy()
+    except Exception:
+        log_red('Unable to destroy pooled instance {}'.format(
+            instance_state))
+
+
+def claim_instance_from_pool(cloud, distro, region):
+    """ takes a booted instance from the warm pool, if there is one
+
+    pooled instances that are not running are out of the pool once
+    claimed, so they are destroyed here or they would leak.
+    """
+    config = _get_platform_config(cloud, region, distro)
+    instance_factory = _get_cloud_instance_factory(cloud, region, config)
+    poller = SharedPoller(cloud, region, config)
+    while True:
+        instance_state, size = claim_from_pool(pool_key(cloud, region,
+                                                        distro))
+        if instance_state is None:
+            break
+        # one describe call covers all the builds claiming in this region
+        pooled_id = instance_id(cloud, instance_state)
+        state = poller.state_of(pooled_id, INSTANCE)
+        if state == RUNNING:
+            break
+        if state in (MISSING, TERMINATED):
+            log_red('Pooled instance {} is {}, dropping it'.format(
+                pooled_id, state))
+            continue
+        log_yellow('Pooled instance {} is {}, destroying it'.format(
+            pooled_id, state))
+        _destroy_pooled(instance_factory, config, instance_state)
+    if size:
+        _refill_pool_in_background(cloud, region, distro, size)
+    if instance_state is None:
+        return None
+
+    log_green('Claiming an instance from the warm pool...')
+    instance = instance_factory.create_from_saved_state(config,
+                                                        instance_state)
     log_green('...Done')
 
     _setup_fab_for_instance(instance)
+    _start_build(cloud, region, distro)
     _save_state_from_instance(instance)
     return instance
 
@@ -212,7 +523,7 @@ def create_instance_from_saved_state():
     config = _get_platform_config(cloud, region, distro)
 
     log_green('Reusing instance from saved state...')
-    instance_factory = _get_cloud_instance_factory(cloud)
+    instance_factory = _get_cloud_instance_factory(cloud, region, config)
     instance = instance_factory.create_from_saved_state(
         config, saved_state['state'])
     log_green('...Done')
@@ -230,14 +541,102 @@ def create_instance_from_saved_state():
     return instance
 
 
+def _build_fingerprint(cloud, region, distro):
+    """ returns the fingerprint of a build, and the hashes of its inputs """
+    inputs = build_inputs(_get_platform_config(cloud, region, distro),
+                          distro,
+                          upstream=env.config.get('upstream', False))
+    return fingerprint(inputs), inputs
+
+
+def _image_with_fingerprint(cloud, region, distro, build_fingerprint):
+    """ returns the newest image we built with the same fingerprint """
+    for image in reversed(load_images()):
+        if (image['cloud'] == cloud and
+                image['region'] == region and
+                image['distro'] == distro.value and
+                image.get('fingerprint') == build_fingerprint and
+                is_promoted(image)):
+            return image
+    return None
+
+
+def _up_to_date():
+    """ True when up found an existing image for this build """
+    if has_state() and load_state().get('up_to_date'):
+        log_green('Image {} is up to date, nothing to do'.format(
+            load_state()['up_to_date']))
+        return True
+    return False
+
+
+def _image_record(instance, image_name, datestr, used):
+    """ what the registry records about an image of the current build """
+    state = load_state()
+    return {
+        'cloud': instance.cloud_type,
+        'region': instance.region,
+        'distro': instance.distro.value,
+        'image_basename': instance.image_basename,
+        'image_name': image_name,
+        'created': datestr,
+        'build_id': state.get('build_id'),
+        'manifest': save_manifest(image_name, capture_manifest(instance)),
+        'fingerprint': state.get('fingerprint'),
+        'build_inputs': state.get('build_inputs'),
+        'disk_used': used,
+        'disk_usage': state.get('disk_usage'),
+        'slimmed': state.get('slimmed'),
+        'checks': state.get('checks'),
+        'full_checks_at': state.get('full_checks_at'),
+        'builder': state.get('builder'),
+        # until verify booted it and its tests passed
+        'promoted': False,
+    }
+
+
+def _start_image_worker(handle):
+    """ runs image_worker in a separate process, logging to logs/ """
+    if not os.path.isdir('logs'):
+        os.makedirs('logs')
+    log_file = open(os.path.join('logs', 'image-{}.log'.format(handle)), 'a')
+    subprocess.Popen(['fab', 'image_worker:{}'.format(handle)],
+                     stdout=log_file, stderr=subprocess.STDOUT,
+                     close_fds=True)
+
+
 @task
-def create_image():
-    """ create ami/image for either AWS, Rackspace or GCE """
+@timed_stage
+def create_image(wait='yes'):
+    """ create ami/image for either AWS, Rackspace or GCE
+
+    :param string wait: 'no' to leave the imaging to a background worker,
+        see wait_images
+    """
+    if _up_to_date():
+        return
     datestr = datetime.utcnow().strftime("%Y%m%d%H%M")
     instance = create_instance_from_saved_state()
     image_name = "{}-{}".format(instance.image_basename, datestr)
+
+    log_green('Capturing the manifest of the instance...')
+    used = instance_disk_used(instance)
+    record = _image_record(instance, image_name, datestr, used)
+
+    if wait == 'no':
+        handle = load_state()['build_id']
+        add_job(handle, {'record': record,
+                         'instance_state': instance.get_state()})
+        update_state(image_job=handle)
+        _start_image_worker(handle)
+        log_green('Creating server image {} in the background, '
+                  'handle {}'.format(image_name, handle))
+        return
+
     image_id = instance.create_image(image_name)
     log_green('Created server image {}: {}'.format(image_name, image_id))
+    record_image(dict(record, image_id=image_id))
+    finish_build('succeeded')
 
     # GCE shuts the instance down before creating an image. In the case where
     # the instance comes back up with a different IP address, we need to
@@ -246,12 +645,152 @@ def create_image():
     _save_state_from_instance(instance)
 
 
+def _job_instance(job):
+    """ the instance an image job was given """
+    record = job['record']
+    config = _get_platform_config(record['cloud'], record['region'],
+                                  Distribution(record['distro']))
+    return _get_cloud_instance_factory(
+        record['cloud'], record['region'], config).create_from_saved_state(
+            config, job['instance_state'])
+
+
+def _destroy_stale_job(handle, job):
+    """ destroys the instance of an image job whose worker is gone """
+    log_red('The worker of image job {} is gone, destroying its '
+            'instance'.format(handle))
+    finish_build('failed', job['record']['build_id'])
+    try:
+        _job_instance(job).destroy()
+    except Exception:
+        log_red('Unable to destroy the instance of image job {}'.format(
+            handle))
+        return
+    update_job(handle, destroyed=True)
+
+
+@task
+def image_worker(handle):
+    """ creates the image of a background job, see create_image:wait=no """
+    job = load_jobs()[handle]
+    record = job['record']
+    instance = _job_instance(job)
+    try:
+        # bookshelf returns once the image is available
+        with heartbeat(handle):
+            image_id = instance.create_image(record['image_name'])
+    except BaseException:
+        job = update_job(handle, status=JOB_FAILED, error=' '.join(
+            traceback.format_exc().strip().splitlines()[-2:]))
+        finish_build('failed', record['build_id'])
+    else:
+        record_image(dict(record, image_id=image_id))
+        finish_build('succeeded', record['build_id'])
+        # GCE restarts the instance, it may come back with a new address
+        job = update_job(handle, status=JOB_DONE, image_id=image_id,
+                         instance_state=instance.get_state())
+    # a waiter may have taken the job for stale and destroyed it already
+    if job.get('destroy') and not job.get('destroyed'):
+        instance.destroy()
+        update_job(handle, destroyed=True)
+
+
+@task
+def wait_images(*handles, **kwargs):
+    """ waits for background image creations and reports their outcome
+
+    :param string handles: the jobs to wait for, the job of the current
+        build, or else every job not reported yet, by default
+    :param int timeout: seconds to wait at most, 2 hours by default
+    """
+    if not handles:
+        if has_state() and load_state().get('image_job'):
+            handles = [load_state()['image_job']]
+        else:
+            handles = unreported_handles()
+    jobs = wait_for_jobs(handles,
+                         timeout=int(kwargs.get('timeout', WAIT_TIMEOUT)),
+                         on_stale=_destroy_stale_job)
+    for handle, job in sorted(jobs.items()):
+        if job['status'] == JOB_DONE:
+            log_green('{}: {} {}'.format(handle, job['record']['image_name'],
+                                         job['image_id']))
+        else:
+            log_red('{}: {} {}'.format(handle, job['status'],
+                                       job.get('error', '')))
+        if job['status'] != JOB_PENDING:
+            update_job(handle, reported=True)
+    if any(job['status'] != JOB_DONE for job in jobs.values()):
+        sys.exit(1)
+
+
 @task
+@timed_stage
+def slim():
+    """ removes caches and build leftovers before create_image """
+    if _up_to_date():
+        return
+    instance = create_instance_from_saved_state()
+    saved = slim_instance(instance)
+    if saved is not None:
+        log_green('Slimming saved {}'.format(human_bytes(saved)))
+
+
+@task
+def diff_images(old_image, new_image):
+    """ shows what changed between two images
+
+    :param string old_image: image id, or path to a stored manifest
+    :param string new_image: image id, or path to a stored manifest
+    """
+    manifests = []
+    for image_id in (old_image, new_image):
+        if os.path.isfile(image_id):
+            manifests.append(load_manifest(image_id))
+            continue
+        image = find_image(image_id)
+        if not image or not image.get('manifest'):
+            log_red('No manifest recorded for image {}'.format(image_id))
+            sys.exit(1)
+        manifests.append(load_manifest(image['manifest']))
+
+    changes = 0
+    for change, (section, name), old, new in diff_manifests(*manifests):
+        changes += 1
+        if change == '~':
+            print('~ {} {}: {} -> {}'.format(section, name, old, new))
+        else:
+            print('{} {} {}: {}'.format(change, section, name, old or new))
+    log_green('{} differences between {} and {}'.format(
+        changes, old_image, new_image))
+
+
+@task
+@timed_stage
 def destroy():
     """ destroy an existing instance """
+    if _up_to_date():
+        os.unlink(STATE_FILE_NAME)
+        return
+    handle = load_state().get('image_job')
+    if handle:
+        # a worker that is gone would never destroy the instance
+        fail_stale_jobs([handle])
+        job = update_job(handle, destroy=True)
+        if job['status'] == JOB_PENDING:
+            log_green('Image job {} destroys the instance once the image '
+                      'is created'.format(handle))
+            os.unlink(STATE_FILE_NAME)
+            return
+        if job.get('destroyed'):
+            os.unlink(STATE_FILE_NAME)
+            return
+        update_state(state=job['instance_state'])
     instance = create_instance_from_saved_state()
     instance.destroy()
-    os.unlink('.state.json')
+    if handle:
+        update_job(handle, destroyed=True)
+    os.unlink(STATE_FILE_NAME)
 
 
 @task
@@ -262,8 +801,11 @@ def down():
 
 
 @task
+@timed_stage
 def bootstrap():
     """ bootstraps an existing running instance """
+    if _up_to_date():
+        return
     instance = create_instance_from_saved_state()
 
     if instance.distro == Distribution.CENTOS7:
@@ -312,14 +854,318 @@ def delete_image(image_id):
     instance.delete_image(image_id)
 
 
+def _latest_image(cloud, region, distro_name):
+    """ the newest promoted image of the target in the registry, or None """
+    image = None
+    for candidate in load_images():
+        if (candidate['cloud'] == cloud and
+                candidate['region'] == region and
+                candidate['distro'] == distro_name and
+                is_promoted(candidate)):
+            image = candidate
+    return image
+
+
 @task
+@timed_stage
 def tests():
-    """ run tests against an existing instance """
+    """ run tests against an existing instance
+
+    only the checks affected by the changes since the previous image of the
+    target run, with the smoke checks, see lib/check_selection.py.
+    """
+    if _up_to_date():
+        return
     instance = create_instance_from_saved_state()
-    acceptance_tests(instance)
+    checks = checks_for(instance.distro.value)
+    previous = _latest_image(instance.cloud_type, instance.region,
+                             instance.distro.value)
+    if env.config.get('full_checks'):
+        selected, reason = checks, 'requested a full run'
+    elif previous is None or full_run_due(previous.get('full_checks_at')):
+        selected, reason = checks, 'a full run is due'
+    else:
+        selected, reason = select_checks(checks,
+                                         previous.get('build_inputs'),
+                                         load_state().get('build_inputs'))
+    log_green('Running {} of {} checks, {}'.format(len(selected),
+                                                   len(checks), reason))
+    acceptance_tests(instance, [check.__name__ for check in selected])
+
+    # the image records when its target last had all of its checks run
+    if len(selected) == len(checks):
+        update_state(full_checks_at=time())
+    else:
+        update_state(full_checks_at=previous.get('full_checks_at'))
+    update_state(checks=[check.__name__ for check in selected])
+
+
+def _config_for_image(image):
+    """ platform config for booting a throwaway instance from image """
+    config = dict(_get_platform_config(image['cloud'], image['region'],
+                                       Distribution(image['distro'])))
+    if image['cloud'] == 'gce':
+        config['base_image_prefix'] = image['image_name']
+        config['base_image_project'] = config['project']
+    else:
+        config['ami'] = image['image_id']
+    config['instance_name'] = '{}-verify-{}'.format(
+        config['instance_name'], datetime.utcnow().strftime("%H%M%S%f"))
+    return config
+
+
+def _verify_image(image):
+    """ boots an instance from image, tests it and destroys it
+
+    runs in a worker process of verify_images, returns the test result.
+    """
+    result = dict(image, passed=False, error=None)
+    started = time()
+    instance = None
+    try:
+        config = _config_for_image(image)
+        # fresh images may still be pending, and all the workers share
+        # one describe call per region while they wait
+        poller = SharedPoller(image['cloud'], image['region'], config)
+        state = poller.wait_for(image_id_of(image), IMAGE,
+                                (AVAILABLE, FAILED, MISSING))
+        if state != AVAILABLE:
+            raise RuntimeError('image {} is {}'.format(image_id_of(image),
+                                                       state))
+        instance_factory = _get_cloud_instance_factory(
+            image['cloud'], image['region'], config)
+        instance = instance_factory.create_from_config(
+            config, Distribution(image['distro']), image['region'])
+        _setup_fab_for_instance(instance)
+        acceptance_tests(instance)
+        result['passed'] = True
+    except BaseException:
+        # fabric aborts with SystemExit, failed checks raise AssertionError
+        result['error'] = ' '.join(
+            traceback.format_exc().strip().splitlines()[-2:])
+    finally:
+        if instance is not None:
+            try:
+                instance.destroy()
+            except Exception:
+                log_red('Unable to destroy the instance booted from {}'.format(
+                    image['image_id']))
+        disconnect_all()
+        flush_api_calls()
+    result['duration'] = int(time() - started)
+    return result
 
 
 @task
+def verify_images(*image_ids, **kwargs):
+    """ boots instances from images and runs the acceptance tests on them
+
+    :param string image_ids: the images to test, or 'latest' for the newest
+        image of every cloud, region and distribution
+    :param int parallel: how many images to test at once
+    """
+    images = []
+    for image_id in image_ids:
+        if image_id == 'latest':
+            images.extend(latest_images())
+        elif find_image(image_id):
+            images.append(find_image(image_id))
+        else:
+            # not one of ours, use the target given on the command line
+            images.append({'cloud': env.config['cloud'],
+                           'region': env.config['region'],
+                           'distro': env.config['distribution'],
+                           'image_id': image_id,
+                           'image_name': image_id})
+    if not images:
+        log_red('No images to verify')
+        sys.exit(1)
+
+    parallel = min(len(images), int(kwargs.get('parallel', 8)))
+    log_green('Verifying {} images, {} at a time'.format(len(images),
+                                                         parallel))
+    pool = multiprocessing.Pool(processes=parallel)
+    try:
+        results = pool.map(_verify_image, images)
+    finally:
+        pool.terminate()
+
+    with open('verify_report.json', 'w') as report:
+        json.dump(results, report, indent=2)
+
+    for result in results:
+        outcome = 'passed' if result['passed'] else 'FAILED'
+        line = '{cloud} {region} {distro} {image_id}: {0} in {duration}s'
+        line = line.format(outcome, **result)
+        if result['passed']:
+            log_green(line)
+        else:
+            log_red('{} ({})'.format(line, result['error']))
+    if not all(result['passed'] for result in results):
+        sys.exit(1)
+
+
+def _image_of_build(build_id, handle=None):
+    """ the image created by a build, waiting for its image job if any """
+    if handle:
+        job = wait_for_jobs([handle], timeout=WAIT_TIMEOUT,
+                            on_stale=_destroy_stale_job)[handle]
+        if job['status'] != JOB_DONE:
+            log_red('Image job {} is {}'.format(handle, job['status']))
+            return None
+    for image in reversed(load_images()):
+        if build_id and image.get('build_id') == build_id:
+            return image
+    return None
+
+
+@task
+@timed_stage
+def verify():
+    """ boots the image of the build and tests it, while the builder is
+    destroyed
+
+    the image is promoted in the registry only when the acceptance tests
+    pass on a fresh instance, which catches what only breaks on first boot.
+    """
+    if _up_to_date():
+        destroy()
+        return
+    # destroy removes the state, read it first
+    state = load_state()
+    teardown = multiprocessing.Process(target=destroy)
+    teardown.start()
+    try:
+        image = _image_of_build(state.get('build_id'),
+                                state.get('image_job'))
+        if image is None:
+            log_red('Build {} created no image'.format(state.get('build_id')))
+            sys.exit(1)
+        log_green('Verifying {} on a fresh instance...'.format(
+            image['image_id']))
+        result = _verify_image(image)
+    finally:
+        teardown.join()
+
+    if result['passed']:
+        update_image(image['image_id'], promoted=True, verified_at=time())
+        log_green('{} passed in {}s, promoted'.format(image['image_id'],
+                                                      result['duration']))
+    else:
+        update_image(image['image_id'], promoted=False,
+                     verify_error=result['error'])
+        log_red('{} FAILED on a fresh instance ({}), not promoted'.format(
+            image['image_id'], result['error']))
+    if teardown.exitcode:
+        log_red('Unable to destroy the builder')
+    if not result['passed'] or teardown.exitcode:
+        sys.exit(1)
+
+
+def _previous_image(image):
+    """ the image built for the same target before image, if any """
+    previous = None
+    for candidate in load_images():
+        if candidate['image_id'] == image['image_id']:
+            return previous
+        if (candidate['cloud'] == image['cloud'] and
+                candidate['region'] == image['region'] and
+                candidate['distro'] == image['distro']):
+            previous = candidate
+    return previous
+
+
+def _bench_boot(job):
+    """ boots an image once and times it, runs in a worker of bench_boot """
+    backend_name, image = job
+    try:
+        if backend_name == 'local':
+            backend = LocalBackend(image['image_id'])
+        else:
+            config = _config_for_image(image)
+            backend = CloudBackend(
+                _get_cloud_instance_factory(image['cloud'], image['region'],
+                                            config),
+                config, Distribution(image['distro']), image['region'],
+                image['cloud'])
+        return measure_boot(backend)
+    except BaseException:
+        return {'error': ' '.join(
+            traceback.format_exc().strip().splitlines()[-2:])}
+    finally:
+        disconnect_all()
+        flush_api_calls()
+
+
+@task
+def bench_boot(image_id='latest', count=3, backend='cloud', against=None):
+    """ boots an image count times at once and reports its boot latency
+
+    :param string image_id: the image to boot, 'latest' for the newest
+        image of the target, or a docker image for the local backend
+    :param int count: how many instances to boot
+    :param string backend: 'cloud', or 'local' to boot a docker image with
+        systemd as a stand-in for a cloud image
+    :param string against: the image to compare with, the previous image
+        of the target by default
+    """
+    if backend == 'local':
+        image = {'image_id': image_id}
+    elif image_id == 'latest':
+        image = _latest_image(env.config['cloud'], env.config['region'],
+                              env.config['distribution'])
+    else:
+        image = find_image(image_id)
+    if not image:
+        log_red('No image {} in the registry'.format(image_id))
+        sys.exit(1)
+
+    count = int(count)
+    log_green('Booting {} {} times...'.format(image['image_id'], count))
+    pool = multiprocessing.Pool(processes=count)
+    try:
+        runs = pool.map(_bench_boot, [(backend, image)] * count)
+    finally:
+        pool.terminate()
+    for run in runs:
+        if 'error' in run:
+            log_red('boot failed: {}'.format(run['error']))
+    runs = [run for run in runs if 'error' not in run]
+
+    if against is None and backend != 'local':
+        previous = _previous_image(image)
+        against = previous and previous['image_id']
+    # loaded first, the local backend compares with the last run of an image
+    previous_summary = against and load_bench(against)
+    save_bench(image['image_id'], runs)
+
+    summary = summarize(runs)
+    for milestone, values in sorted(summary.items(),
+                                    key=lambda item: item[1]['p50']):
+        print('{:<8} p50 {:6.1f}s  p90 {:6.1f}s  max {:6.1f}s'.format(
+            milestone, values['p50'], values['p90'], values['max']))
+
+    # a failed boot fails the benchmark, with or without a comparison
+    failed = len(runs) < count
+    if not previous_summary:
+        log_yellow('No benchmark of a previous image to compare with')
+        if failed:
+            sys.exit(1)
+        return
+    regressed = False
+    for milestone, old, new, slower in compare(summary, previous_summary):
+        line = '{:<8} {:6.1f}s -> {:6.1f}s'.format(milestone, old, new)
+        if slower:
+            regressed = True
+            log_red(line + ' slower than ' + against)
+        else:
+            log_green(line)
+    if regressed or failed:
+        sys.exit(1)
+
+
+@task
+@timed_stage
 def up():
     """
     boots a new instance on the specified cloud provider
@@ -328,11 +1174,287 @@ def up():
         cloud = env.config['cloud']
         distro = Distribution(env.config['distribution'])
         region = env.config['region']
-        create_new_intance_from_config(cloud, distro, region)
-    else:
+
+        if _preflight_failures([(cloud, region, distro.value)]):
+            sys.exit(1)
+        build_fingerprint, inputs = _build_fingerprint(cloud, region, distro)
+        image = _image_with_fingerprint(cloud, region, distro,
+                                        build_fingerprint)
+        if image and not env.config.get('force'):
+            log_green('up to date: {} was built with fingerprint {}'.format(
+                image['image_id'], build_fingerprint))
+            save_state({'cloud': cloud,
+                        'region': region,
+                        'distro': distro.value,
+                        'up_to_date': image['image_id']})
+            return
+
+        builder = env.config.get('builder') and _choose_builder(
+            cloud, region, distro)
+        # the pooled instances are of the type of the config
+        if ((builder and builder['type'] != builder['configured']) or
+                not claim_instance_from_pool(cloud, distro, region)):
+            create_new_intance_from_config(cloud, distro, region)
+        update_state(fingerprint=build_fingerprint, build_inputs=inputs,
+                     builder=builder)
+    elif not _up_to_date():
         create_instance_from_saved_state()
 
 
+@task
+def report(days=30):
+    """ shows step durations, build trends and regressions from metrics.db
+
+    :param int days: how many days of history to show
+    """
+    metrics_report(days=int(days))
+
+
+def _matrix_targets():
+    """ every cloud, region and distribution in the cloud yaml files """
+    # listing them must not fail on the environment variables they need
+    return all_targets(dict((cloud, load_cloud_config(yaml_file)[0])
+                            for cloud, yaml_file in CLOUD_YAML_FILE.items()))
+
+
+def _preflight_failures(targets, images=False):
+    """ validates targets, logs their problems, returns the failing ones """
+    failures = []
+    for result in validate_targets(targets, CLOUD_YAML_FILE, images):
+        for warning in result['warnings']:
+            log_yellow('{}: {}'.format(result['target'], warning))
+        for error in result['errors']:
+            log_red('{}: {}'.format(result['target'], error))
+        if result['errors']:
+            failures.append(tuple(result['target'].split('/')))
+    return failures
+
+
+def _build_settings():
+    """ the settings tasks given before matrix or enqueue, for every build """
+    tasks = []
+    for setting in ('batch', 'upstream', 'force'):
+        if env.config.get(setting):
+            tasks.append(setting)
+    if env.config.get('parallel'):
+        tasks.append('parallel:{}'.format(env.config['parallel']))
+    if env.config.get('builder'):
+        tasks.append('builder:{}'.format(env.config['builder']))
+    return tasks
+
+
+@task
+def matrix(*targets, **kwargs):
+    """ builds the images of many targets, longest expected build first
+
+    :param string targets: cloud/region/distribution of every build, all
+        the targets of the cloud yaml files by default
+    :param int executors: how many builds run at once
+    :param int ec2, rackspace, gce: how many builds run at once per cloud
+    """
+    if targets:
+        targets = [tuple(target.split('/')) for target in targets]
+    else:
+        targets = _matrix_targets()
+    cloud_limits = dict(CLOUD_LIMITS)
+    for cloud in CLOUD_YAML_FILE:
+        if cloud in kwargs:
+            cloud_limits[cloud] = int(kwargs[cloud])
+    failures = _preflight_failures(targets)
+    targets = [target for target in targets if target not in failures]
+
+    try:
+        scheduler = MatrixScheduler(expected_durations(targets),
+                                    _build_settings(),
+                                    int(kwargs.get('executors', EXECUTORS)),
+                                    cloud_limits)
+    except ValueError as error:
+        log_red(str(error))
+        sys.exit(1)
+    results = scheduler.run()
+    for target, result in sorted(results.items(),
+                                 key=lambda item: -item[1]['duration']):
+        line = '{}: {} in {}s, expected {}s'.format(
+            target_name(target),
+            'passed' if result['passed'] else 'FAILED',
+            result['duration'], result['expected'])
+        if result['passed']:
+            log_green(line)
+        else:
+            log_red(line)
+    for target in failures:
+        log_red('{}: FAILED pre-flight'.format(target_name(target)))
+    if failures or not all(result['passed']
+                           for result in results.values()):
+        sys.exit(1)
+
+
+@task
+def enqueue(*targets):
+    """ adds builds to the work queue shared by the queue workers
+
+    :param string targets: cloud/region/distribution of every build, all
+        the targets of the cloud yaml files by default
+    """
+    if targets:
+        targets = [tuple(target.split('/')) for target in targets]
+    else:
+        targets = _matrix_targets()
+    failures = _preflight_failures(targets)
+    targets = [target for target in targets if target not in failures]
+    queue = open_queue()
+    expected = expected_durations(targets)
+    for target in targets:
+        if queue.enqueue(target, _build_settings(), expected[target]):
+            log_green('queued {}'.format('/'.join(target)))
+        else:
+            log_yellow('{} is already queued'.format('/'.join(target)))
+
+
+@task
+def queue_worker(slots=1, lease=LEASE):
+    """ builds the targets of the work queue until it is drained
+
+    :param int slots: how many builds this worker runs at once
+    :param int lease: seconds after which the build of a worker that
+        stopped renewing its claim goes to another worker
+    """
+    results = QueueWorker(open_queue(), int(slots), int(lease)).run()
+    if not all(result['passed'] for result in results.values()):
+        sys.exit(1)
+
+
+@task
+def queue_status():
+    """ lists the builds of the work queue """
+    for entry in open_queue().entries():
+        line = '{:>4} {:<36} {:<9} attempt {} {}'.format(
+            entry['id'], entry['target'], entry['status'],
+            entry['attempts'], entry['worker'] or '')
+        if entry['status'] == QUEUE_FAILED:
+            log_red(line)
+        else:
+            print(line)
+
+
+@task
+def preflight(*targets, **kwargs):
+    """ validates the config of targets in parallel, without booting
+
+    :param string targets: cloud/region/distribution of every target, all
+        the targets of the cloud yaml files by default
+    :param string images: 'yes' to look the ec2 AMIs up too, the answers
+        are cached for a day
+    """
+    started = time()
+    if targets:
+        targets = [tuple(target.split('/')) for target in targets]
+    else:
+        targets = _matrix_targets()
+    failures = _preflight_failures(targets, kwargs.get('images') == 'yes')
+    log_green('{} targets checked in {:.2f}s'.format(len(targets),
+                                                     time() - started))
+    if failures:
+        log_red('{} targets fail pre-flight: {}'.format(
+            len(failures), ', '.join('/'.join(target)
+                                     for target in failures)))
+        sys.exit(1)
+
+
+def _plan_target(target, history):
+    """ the plan of building target, see lib/plan.py """
+    cloud, region, distro_name = target
+    try:
+        distro = Distribution(distro_name)
+        config = _get_platform_config(cloud, region, distro)
+    except (KeyError, ValueError) as error:
+        return {'target': '/'.join(target),
+                'errors': ['no config: {}'.format(error)],
+                'stages': [],
+                'estimate': None}
+
+    steps = _bootstrap_steps(config['username'], distro)
+    # upstream revisions would need a remote, plan stays offline
+    build_fingerprint = fingerprint(build_inputs(config, distro))
+    image = None
+    if not env.config.get('force') and not env.config.get('upstream'):
+        image = _image_with_fingerprint(cloud, region, distro,
+                                        build_fingerprint)
+    plan = plan_build(target, steps, history, image,
+                      pooled_count(pool_key(cloud, region, distro)))
+    plan['fingerprint'] = build_fingerprint
+    plan['errors'] = check_config(cloud, config)
+    return plan
+
+
+@task
+def plan(*targets, **kwargs):
+    """ shows what building targets would do, without booting anything
+
+    :param string targets: cloud/region/distribution of every build, 'all'
+        for all the targets of the cloud yaml files, the target given with
+        cloud, region and distribution by default
+    :param string format: 'text' or 'json'
+    """
+    if targets == ('all',):
+        targets = _matrix_targets()
+    elif targets:
+        targets = [tuple(target.split('/')) for target in targets]
+    else:
+        targets = [(env.config['cloud'], env.config['region'],
+                    env.config['distribution'])]
+
+    history = History()
+    plans = [_plan_target(target, history) for target in targets]
+
+    if kwargs.get('format') == 'json':
+        print(json.dumps(plans, indent=2, sort_keys=True))
+    else:
+        for target_plan in plans:
+            print('\n'.join(format_plan(target_plan)))
+        estimates = [target_plan['estimate'] for target_plan in plans]
+        known = [estimate for estimate in estimates if estimate is not None]
+        log_green('{} builds, {:.1f} instance-hours estimated{}'.format(
+            len(plans), sum(known) / 3600.0,
+            '' if len(known) == len(plans) else
+            ', {} without history'.format(len(plans) - len(known))))
+    if any(target_plan['errors'] for target_plan in plans):
+        log_red('The config of some targets has errors')
+        sys.exit(1)
+
+
+@task
+def pool_fill(size=2, max_idle_age=MAX_IDLE_AGE):
+    """ boots base instances until the warm pool holds size of them
+
+    :param int size: how many booted instances to keep
+    :param int max_idle_age: seconds after which pooled instances are
+        destroyed and replaced
+    """
+    cloud = env.config['cloud']
+    distro = Distribution(env.config['distribution'])
+    region = env.config['region']
+    key = pool_key(cloud, region, distro)
+    config = _get_platform_config(cloud, region, distro)
+    instance_factory = _get_cloud_instance_factory(cloud, region, config)
+
+    stale, missing = configure_pool(key, int(size), int(max_idle_age))
+    for instance_state in stale:
+        log_green('Recycling a stale pooled instance...')
+        _destroy_pooled(instance_factory, config, instance_state)
+
+    for _ in range(missing):
+        log_green('Booting an instance for the {} pool...'.format(key))
+        pooled_config = dict(config)
+        pooled_config['instance_name'] = '{}-pool-{}'.format(
+            config['instance_name'],
+            datetime.utcnow().strftime("%Y%m%d%H%M%S"))
+        instance = instance_factory.create_from_config(pooled_config,
+                                                       distro, region)
+        add_to_pool(key, instance.get_state())
+    log_green('The {} pool holds {} instances'.format(key, size))
+
+
 @task
 def cloud(cloud_provider):
     env.config['cloud'] = cloud_provider
@@ -348,8 +1470,56 @@ def region(cloud_region):
     env.config['region'] = cloud_region
 
 
+@task
+def batch():
+    """ compile bootstrap segments into single remote scripts """
+    env.config['batch'] = True
+
+
+@task
+def upstream():
+    """ include upstream revisions in the build fingerprint """
+    env.config['upstream'] = True
+
+
+@task
+def force():
+    """ build a new image even if an up to date one exists """
+    env.config['force'] = True
+
+
+@task
+def full():
+    """ run every acceptance check, not only the ones a build affects """
+    env.config['full_checks'] = True
+
+
+@task
+def builder(objective='time'):
+    """ pick the builder instance type for the fastest or cheapest build """
+    if objective not in OBJECTIVES:
+        log_red('The builder objective is one of {}'.format(
+            ', '.join(OBJECTIVES)))
+        sys.exit(1)
+    env.config['builder'] = objective
+
+
+@task
+def profile():
+    """ profile the tasks that follow, see lib/profiling.py """
+    env.config['profile'] = True
+
+
+@task
+def parallel(max_steps=4):
+    """ run independent bootstrap steps concurrently """
+    env.config['parallel'] = int(max_steps)
+
+
 """
     ___main___
 """
 
 setup_fab_env()
+profile_tasks(globals())
+finish_import_profile()
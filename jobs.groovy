@@ -55,12 +55,27 @@ def clone_segredos = """
   """.stripIndent()
 
 
+// the workspace is cleaned by every checkout, the files every build shares
+// live outside of it, on the jenkins slave
+def shared_state = '''
+  export CI_SLAVE_SHARED=${HOME}/ci-slave-images
+  mkdir -p ${CI_SLAVE_SHARED}
+  export CI_SLAVE_IMAGES_FILE=${CI_SLAVE_SHARED}/images.json
+  export CI_SLAVE_METRICS_DB=${CI_SLAVE_SHARED}/metrics.db
+  export CI_SLAVE_POOL_FILE=${CI_SLAVE_SHARED}/pool.json
+  export CI_SLAVE_THROTTLE_FILE=${CI_SLAVE_SHARED}/throttle.json
+  export CI_SLAVE_POLL_FILE=${CI_SLAVE_SHARED}/poll.json
+  export CI_SLAVE_IMAGE_JOBS_FILE=${CI_SLAVE_SHARED}/image_jobs.json
+
+  '''.stripIndent()
+
+
 def run_fabric = '''
   fab cloud:$CLOUD distribution:$DISTRIBUTION region:$REGION up
   fab bootstrap
   fab tests
   fab create_image
-  fab destroy
+  fab verify
   '''.stripIndent()
 
 /*
@@ -85,9 +100,11 @@ def full_job_name(dashProject, dashBranchName, cloud, region, distribution) {
     cloud + '_' + region + '_' + distribution
 }
 
-// list of regions and distributions
+// list of regions and distributions, the same targets as the cloud yaml
+// files give 'fab matrix', see tests/test_targets.py
 def on_clouds = [
-  ec2:[regions: ['eu-central-1',
+  ec2:[regions: ['us-east-1',
+                 'eu-central-1',
                  'ap-southeast-1',
                  'ap-northeast-1',
                  'ap-southeast-2',
@@ -112,6 +129,7 @@ def with_steps = hashbang +
                  setup_venv +
                  pip_install +
                  clone_segredos +
+                 shared_state +
                  run_fabric
 
 // Jenkins Slave type
@@ -371,3 +389,48 @@ multiJob(job_name) {
     }
   }
 }
+
+// generate a job building every target from one executor, longest expected
+// build first, see 'fab matrix'
+job_name = dashProject + '/' + dashBranchName + '/' + '__matrix'
+
+job(job_name) {
+  parameters {
+    configure job_password_parameters()
+
+    jobs_common_parameters.each { k, v ->
+      stringParam(k, v.default_value)
+    }
+  }
+
+  scm {
+    git {
+      cloneTimeout(2)
+      remote {
+        name("upstream")
+        github(github_project)
+      }
+      branch("${RECONFIGURE_BRANCH}")
+      clean(true)
+      createTag(false)
+    }
+  }
+
+  wrappers {
+      timestamps()
+      colorizeOutput()
+      maskPasswords()
+  }
+
+  label(on_label)
+
+  steps {
+    shell(hashbang +
+          add_shell_functions +
+          setup_venv +
+          pip_install +
+          clone_segredos +
+          shared_state +
+          'fab matrix:executors=32\n')
+  }
+}
@@ -0,0 +1,203 @@
+# vim: ai ts=4 sts=4 et sw=4 ft=python fdm=indent et foldlevel=0
+
+""" Boot latency benchmark of the images we produce
+
+Jenkins boots slaves on demand, so how fast an image gets from the boot
+request to a usable slave matters as much as what is on it. A benchmark
+boots an image a few times and measures, from the boot request, when the
+instance is running, when we can log in, and when docker and nginx are
+ready. The results are kept under bench/, by image, so that an image can
+be compared with the one it replaces.
+"""
+
+import json
+import os
+import subprocess
+import threading
+from time import sleep, time
+
+from fabric.api import env, sudo
+from fabric.context_managers import hide, settings
+from bookshelf.api_v1 import wait_for_ssh
+
+from lib.metrics import percentile
+from lib.poller import MIN_INTERVAL, RUNNING, describe_named
+from lib.throttle import throttled_call
+
+
+BENCH_DIR = 'bench'
+MILESTONES = ['running', 'ssh', 'docker', 'nginx']
+READINESS = [('docker', 'docker info > /dev/null 2>&1'),
+             ('nginx', 'pgrep -x nginx > /dev/null')]
+READY_TIMEOUT = 10 * 60
+PROBE_INTERVAL = 1
+# a milestone this much slower than on the previous image is a regression
+REGRESSION = 1.2
+
+
+class CloudBackend(object):
+    """ boots an image on its cloud, through a bookshelf instance factory
+
+    create_from_config only returns once ssh is up, so it runs in a thread
+    while the instance is looked up by name until the cloud reports it
+    running.
+    """
+
+    def __init__(self, factory, config, distro, region, cloud):
+        self.factory = factory
+        self.config = config
+        self.distro = distro
+        self.region = region
+        self.cloud = cloud
+        self.instance = None
+        self.error = None
+        self.thread = None
+
+    def _create(self):
+        try:
+            self.instance = self.factory.create_from_config(
+                self.config, self.distro, self.region)
+        except Exception as error:
+            self.error = error
+
+    def boot(self):
+        """ returns once the instance is running """
+        self.thread = threading.Thread(target=self._create)
+        self.thread.daemon = True
+        self.thread.start()
+        while self.thread.is_alive():
+            state = throttled_call(self.cloud, self.region, self.config,
+                                   'describe', describe_named, self.cloud,
+                                   self.region, self.config,
+                                   self.config['instance_name'])
+            if state == RUNNING:
+                return
+            sleep(MIN_INTERVAL)
+        if self.error is not None:
+            raise self.error
+
+    def wait_for_login(self):
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        env.host_string = '{}@{}'.format(self.instance.username,
+                                         self.instance.ip_address)
+        env.user = self.instance.username
+        env.key_filename = self.instance.key_filename
+        wait_for_ssh(self.instance.ip_address)
+
+    def check(self, command):
+        with settings(hide('everything'), warn_only=True):
+            return sudo(command).succeeded
+
+    def destroy(self):
+        if self.thread is not None:
+            # the instance exists once create_from_config returned
+            self.thread.join()
+        if self.instance is not None:
+            self.instance.destroy()
+
+
+class LocalBackend(object):
+    """ stand-in booting a local docker image with systemd as its init
+
+    exercises the benchmark without a cloud account, docker exec stands in
+    for ssh.
+    """
+
+    def __init__(self, image):
+        self.image = image
+        self.container = None
+
+    def _docker(self, *args):
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.call(('docker',) + args,
+                                   stdout=devnull, stderr=devnull) == 0
+
+    def boot(self):
+        self.container = subprocess.check_output(
+            ['docker', 'run', '-d', '--privileged', self.image,
+             '/sbin/init']).decode('utf-8').strip()
+        while not self.check('true'):
+            sleep(PROBE_INTERVAL)
+
+    def wait_for_login(self):
+        pass
+
+    def check(self, command):
+        return self._docker('exec', self.container, 'sh', '-c', command)
+
+    def destroy(self):
+        if self.container is not None:
+            self._docker('rm', '-f', self.container)
+
+
+def measure_boot(backend):
+    """ boots once through backend, returns the seconds to each milestone """
+    started = time()
+    timings = {}
+    try:
+        backend.boot()
+        timings['running'] = time() - started
+        backend.wait_for_login()
+        timings['ssh'] = time() - started
+        pending = list(READINESS)
+        while pending:
+            for name, command in list(pending):
+                if backend.check(command):
+                    timings[name] = time() - started
+                    pending.remove((name, command))
+            if pending and time() > started + READY_TIMEOUT:
+                raise RuntimeError('{} not ready after {}s'.format(
+                    ', '.join(name for name, _ in pending), READY_TIMEOUT))
+            if pending:
+                sleep(PROBE_INTERVAL)
+    finally:
+        backend.destroy()
+    return timings
+
+
+def summarize(runs):
+    """ returns the p50, p90 and max of every milestone over the runs """
+    summary = {}
+    for milestone in MILESTONES:
+        values = [run[milestone] for run in runs if milestone in run]
+        if values:
+            summary[milestone] = {'runs': len(values),
+                                  'p50': percentile(values, 0.5),
+                                  'p90': percentile(values, 0.9),
+                                  'max': max(values)}
+    return summary
+
+
+def _bench_file(image_id):
+    """ docker references such as centos/systemd:latest make no file names """
+    return os.path.join(BENCH_DIR, '{}.json'.format(
+        image_id.replace('/', '_').replace(':', '_')))
+
+
+def save_bench(image_id, runs):
+    """ stores the runs of a benchmark of image_id """
+    if not os.path.isdir(BENCH_DIR):
+        os.makedirs(BENCH_DIR)
+    with open(_bench_file(image_id), 'w') as bench_file:
+        json.dump({'image_id': image_id,
+                   'runs': runs,
+                   'summary': summarize(runs)}, bench_file, indent=2)
+
+
+def load_bench(image_id):
+    """ returns the stored summary of image_id, or None """
+    if not os.path.isfile(_bench_file(image_id)):
+        return None
+    with open(_bench_file(image_id)) as bench_file:
+        return json.load(bench_file)['summary']
+
+
+def compare(summary, previous):
+    """ yields (milestone, previous p50, p50, regressed) """
+    for milestone in MILESTONES:
+        if milestone in summary and milestone in previous:
+            old = previous[milestone]['p50']
+            new = summary[milestone]['p50']
+            yield milestone, old, new, new > old * REGRESSION
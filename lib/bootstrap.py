@@ -1,199 +1,324 @@
 # vim: ai ts=4 sts=4 et sw=4 ft=python fdm=indent et foldlevel=0
 
 
-from fabric.api import sudo, run
-from fabric.context_managers import settings, cd
+from fabric.api import env
+from fabric.context_managers import settings
 from bookshelf.api_v1 import (add_epel_yum_repository,
                               add_usr_local_bin_to_path,
                               add_zfs_yum_repository,
                               apt_install,
                               apt_install_from_url,
                               yum_install_from_url,
-                              install_zfs_from_testing_repository,
                               install_os_updates,
                               install_ubuntu_development_tools,
-                              enable_selinux,
                               disable_requiretty_on_sudoers,
                               disable_env_reset_on_sudo,
                               disable_requiretty_on_sshd_config,
                               enable_firewalld_service,
                               enable_apt_repositories,
                               install_centos_development_tools,
-                              reboot,
+                              log_green,
                               systemd,
                               yum_install,
                               install_system_gem,
                               update_system_pip_to_latest_pip,
-                              wait_for_ssh,
                               create_docker_group,
-                              git_clone,
-                              cache_docker_image_locally,
                               install_recent_git_from_source)
 
-from lib.mycookbooks import (symlink_sh_to_bash,
-                             fix_umask,
-                             create_etc_slave_config,
-                             install_python_pypy,
+from lib.mycookbooks import (symlink_sh_to_bash_commands,
+                             fix_umask_commands,
+                             create_etc_slave_config_commands,
+                             create_root_known_hosts_commands,
+                             cache_docker_images_commands,
+                             enable_selinux_commands,
+                             fast_reboot,
+                             flocker_pip_cache_commands,
+                             install_python_pypy_commands,
                              add_user_to_docker_group,
-                             install_docker,
+                             install_docker_commands,
                              local_docker_images,
                              upgrade_kernel_and_grub,
                              install_nginx)
 
+from lib.footprint import log_largest_growth
+from lib.reboots import plan_boots, describe_plan
+from lib.zfs_kmod import install_zfs_with_kmod_cache
+from lib.scheduler import StepScheduler
+from lib.steps import Step, run_steps, PACKAGE_MANAGER, NETWORK, CPU
+from lib.watchdog import forget_watchdog
 
-def bootstrap_jenkins_slave_centos7(instance):
+
+def _run_segment(steps, name, done=()):
+    """ runs a reboot-free segment of the bootstrap
+
+    `fab batch bootstrap` compiles the shell steps of every segment into
+    a single uploaded script, `fab parallel bootstrap` runs independent
+    steps concurrently.
+
+    :param list done: names of the steps run in the earlier segments
+    """
+    if env.config.get('parallel'):
+        StepScheduler(steps, max_parallel=env.config['parallel'],
+                      done=done).run(name)
+    else:
+        run_steps(steps, name, batched=env.config.get('batch', False))
+
+
+def run_bootstrap(instance, steps, name):
+    """ runs the bootstrap steps, rebooting only where the plan requires it
+
+    :param instance: the cloud instance being bootstrapped
+    :param list steps: the Step objects, see lib/reboots.py
+    :param string name: name of the bootstrap, used for the segment names
+    """
     # ec2 hosts get their ip addresses using dhcp, we need to know the new
     # ip address of our box before we continue our provisioning tasks.
     # we load the state from disk, and store the ip in ec2_host#
     cloud_host = "%s@%s" % (instance.username, instance.ip_address)
-    distro = instance.distro
+    boots, pending = plan_boots(steps)
+    log_green('bootstrap plan: %s' % ', '.join(describe_plan(boots,
+                                                             pending)))
+
     with settings(host_string=cloud_host,
                   key_filename=instance.key_filename):
-        install_os_updates(distribution='centos7')
+        done = []
+        for index, boot in enumerate(boots):
+            if index:
+                fast_reboot(instance.ip_address)
+                forget_watchdog()
+            _run_segment(boot, '%s-%d' % (name, index), done)
+            done.extend(step.name for step in boot)
+        if pending:
+            fast_reboot(instance.ip_address)
+            forget_watchdog()
+    log_largest_growth()
 
-        # make sure our umask is set to 022
-        fix_umask(instance.username)
 
-        # ttys are tricky, lets make sure we don't need them
-        disable_requiretty_on_sudoers()
+def bootstrap_jenkins_slave_centos7(instance):
+    run_bootstrap(instance,
+                  centos7_bootstrap_steps(instance.username, instance.distro),
+                  'centos7')
 
-        # when we sudo, we want to keep our original environment variables
-        disable_env_reset_on_sudo()
 
-        add_epel_yum_repository()
+def bootstrap_jenkins_slave_ubuntu14(instance):
+    run_bootstrap(instance,
+                  ubuntu14_bootstrap_steps(instance.username,
+                                           instance.distro),
+                  'ubuntu14')
 
-        install_centos_development_tools()
 
-        # installs a bunch of required packages
-        yum_install(packages=centos7_required_packages())
+def centos7_bootstrap_steps(username, distro):
+    return [
+        Step('install_os_updates',
+             func=lambda: install_os_updates(distribution='centos7'),
+             timeout=90 * 60,
+             resources=[PACKAGE_MANAGER, NETWORK],
+             reboot_after=True),
 
-        # installing the source for the centos kernel is a bit of an odd
-        # process these days.
-        yum_install_from_url(
-            "http://vault.centos.org/7.1.1503/updates/Source/SPackages/"
-            "kernel-3.10.0-229.11.1.el7.src.rpm",
-            "non-available-kernel-src")
+        # make sure our umask is set to 022
+        Step('fix_umask', fix_umask_commands(username)),
 
-        # we want to be running the latest kernel before installing ZFS
-        # so, lets reboot and make sure we do.
-        with settings(warn_only=True):
-            reboot()
-        wait_for_ssh(instance.ip_address)
+        # ttys are tricky, lets make sure we don't need them
+        Step('disable_requiretty_on_sudoers',
+             func=disable_requiretty_on_sudoers),
+
+        # when we sudo, we want to keep our original environment
+        # variables
+        Step('disable_env_reset_on_sudo',
+             func=disable_env_reset_on_sudo,
+             requires=['disable_requiretty_on_sudoers']),
+
+        Step('add_epel_yum_repository', func=add_epel_yum_repository,
+             requires=['install_os_updates'],
+             resources=[PACKAGE_MANAGER, NETWORK]),
+
+        Step('install_centos_development_tools',
+             func=install_centos_development_tools,
+             requires=['add_epel_yum_repository'],
+             resources=[PACKAGE_MANAGER, NETWORK]),
+
+        # installs a bunch of required packages, including the latest
+        # kernel
+        Step('install_required_packages',
+             func=lambda: yum_install(packages=centos7_required_packages()),
+             requires=['add_epel_yum_repository'],
+             resources=[PACKAGE_MANAGER, NETWORK],
+             reboot_after=True),
+
+        # installing the source for the centos kernel is a bit of an
+        # odd process these days.
+        Step('install_kernel_source',
+             func=lambda: yum_install_from_url(
+                 "http://vault.centos.org/7.1.1503/updates/Source/"
+                 "SPackages/kernel-3.10.0-229.11.1.el7.src.rpm",
+                 "non-available-kernel-src"),
+             requires=['install_required_packages'],
+             resources=[PACKAGE_MANAGER, NETWORK]),
+
+        # the filesystem gets relabelled on the next boot if selinux was
+        # disabled
+        Step('enable_selinux', enable_selinux_commands(),
+             reboot_after=True),
 
         # install the latest ZFS from testing
-        add_zfs_yum_repository()
-        yum_install_from_url(
-            "http://archive.zfsonlinux.org/epel/zfs-release.el7.noarch.rpm",
-            "zfs-release")
-        install_zfs_from_testing_repository()
+        Step('add_zfs_yum_repository', func=add_zfs_yum_repository,
+             requires=['install_os_updates'],
+             resources=[PACKAGE_MANAGER, NETWORK]),
+        Step('install_zfs_release',
+             func=lambda: yum_install_from_url(
+                 "http://archive.zfsonlinux.org/epel/"
+                 "zfs-release.el7.noarch.rpm",
+                 "zfs-release"),
+             requires=['add_zfs_yum_repository'],
+             resources=[PACKAGE_MANAGER, NETWORK]),
+
+        # we want to be running the latest kernel before installing ZFS,
+        # the modules built for that kernel are cached on the controller
+        Step('install_zfs_from_testing_repository',
+             func=install_zfs_with_kmod_cache,
+             timeout=60 * 60,
+             requires=['install_zfs_release', 'install_kernel_source'],
+             resources=[PACKAGE_MANAGER, NETWORK, CPU],
+             after_reboot=['install_os_updates',
+                           'install_required_packages']),
 
-        # note: will reboot the host for us if selinux is disabled
-        enable_selinux()
-        wait_for_ssh(instance.ip_address)
-
-    # these are likely to happen after a reboot
-
-    with settings(host_string=cloud_host,
-                  key_filename=instance.key_filename):
         # brings up the firewall
-        enable_firewalld_service()
+        Step('enable_firewalld_service', func=enable_firewalld_service,
+             resources=[PACKAGE_MANAGER],
+             after_reboot=['enable_selinux']),
 
         # we create a docker group ourselves, as we want to be part
         # of that group when the daemon first starts.
-        create_docker_group()
-        add_user_to_docker_group(distro)
-        install_docker()
+        Step('create_docker_group', func=create_docker_group),
+        Step('add_user_to_docker_group',
+             func=lambda: add_user_to_docker_group(distro),
+             requires=['create_docker_group']),
+        Step('install_docker', install_docker_commands(),
+             timeout=20 * 60, idle_timeout=5 * 60,
+             requires=['add_user_to_docker_group',
+                       'install_required_packages'],
+             resources=[PACKAGE_MANAGER, NETWORK],
+             after_reboot=['enable_selinux']),
 
         # ubuntu uses dash which causes jenkins jobs to fail
-        symlink_sh_to_bash(distro)
+        Step('symlink_sh_to_bash', symlink_sh_to_bash_commands(distro)),
 
         # some flocker acceptance tests fail when we don't have
         # a know_hosts file
-        sudo("mkdir -p /root/.ssh")
-        sudo("touch /root/.ssh/known_hosts")
-
-        # generate a id_rsa_flocker
-        sudo("test -e  $HOME/.ssh/id_rsa_flocker || ssh-keygen -N '' "
-             "-f $HOME/.ssh/id_rsa_flocker")
-
-        # and fix perms on /root/.ssh
-        sudo("chmod -R 0600 /root/.ssh")
-
-        # TODO: this may not be needed, as packaging is done on a docker img
-        install_system_gem('fpm')
-
-        systemd(service='docker', restart=True)
-        systemd(service='nginx', start=True, unmask=True)
-
-        # cache some docker images locally to speed up some of our tests
-        for docker_image in local_docker_images():
-            cache_docker_image_locally(docker_image)
+        Step('create_root_known_hosts', create_root_known_hosts_commands()),
+
+        # TODO: this may not be needed, as packaging is done on a
+        # docker img
+        Step('install_fpm', func=lambda: install_system_gem('fpm'),
+             requires=['install_required_packages'],
+             resources=[NETWORK]),
+
+        Step('restart_docker',
+             func=lambda: systemd(service='docker', restart=True),
+             requires=['install_docker']),
+        Step('start_nginx',
+             func=lambda: systemd(service='nginx', start=True, unmask=True),
+             requires=['install_required_packages'],
+             after_reboot=['enable_selinux']),
+
+        # cache some docker images locally to speed up some of our
+        # tests
+        Step('cache_docker_images',
+             cache_docker_images_commands(local_docker_images()),
+             requires=['restart_docker'],
+             resources=[NETWORK]),
 
         # centos has a fairly old git, so we install the latest version
         # in every box.
-        install_recent_git_from_source()
-        add_usr_local_bin_to_path()
+        Step('install_recent_git_from_source',
+             func=install_recent_git_from_source,
+             requires=['install_required_packages'],
+             resources=[PACKAGE_MANAGER, NETWORK, CPU]),
+        Step('add_usr_local_bin_to_path', func=add_usr_local_bin_to_path,
+             requires=['install_recent_git_from_source']),
 
         # to use wheels, we want the latest pip
-        update_system_pip_to_latest_pip()
+        Step('update_system_pip_to_latest_pip',
+             func=update_system_pip_to_latest_pip,
+             requires=['install_required_packages'],
+             resources=[NETWORK]),
 
         # cache the latest python modules and dependencies in the local
         # user cache
-        git_clone('https://github.com/ClusterHQ/flocker.git', 'flocker')
-        with cd('flocker'):
-            run('pip install --quiet --user .')
-            run('pip install --quiet '
-                '--user --process-dependency-links ".[dev]"')
-            run('pip install --quiet --user python-subunit junitxml')
+        Step('cache_flocker_pip_dependencies', flocker_pip_cache_commands(),
+             as_user=True,
+             requires=['add_usr_local_bin_to_path',
+                       'update_system_pip_to_latest_pip'],
+             resources=[NETWORK, CPU]),
 
         # nginx is used during the acceptance tests, the VM built by
         # flocker provision will connect to the jenkins slave on p 80
         # and retrieve the just generated rpm/deb file
-        install_nginx(instance.username)
+        Step('install_nginx', func=lambda: install_nginx(username),
+             requires=['enable_firewalld_service', 'start_nginx'],
+             resources=[PACKAGE_MANAGER]),
 
         # /etc/slave_config is used by the jenkins_slave plugin to
         # transfer files from the master to the slave
-        create_etc_slave_config()
-
-        # installs python-pypy onto /opt/python-pypy/2.6.1 and symlinks it
-        # to /usr/local/bin/pypy
-        install_python_pypy('2.6.1')
+        Step('create_etc_slave_config', create_etc_slave_config_commands()),
 
+        # installs python-pypy onto /opt/python-pypy/2.6.1 and symlinks
+        # it to /usr/local/bin/pypy
+        Step('install_python_pypy', install_python_pypy_commands('2.6.1'),
+             timeout=15 * 60, idle_timeout=5 * 60,
+             requires=['install_required_packages'],
+             resources=[NETWORK]),
+    ]
 
-def bootstrap_jenkins_slave_ubuntu14(instance):
-    # ec2 hosts get their ip addresses using dhcp, we need to know the new
-    # ip address of our box before we continue our provisioning tasks.
-    # we load the state from disk, and store the ip in ec2_host#
 
-    cloud_host = "%s@%s" % (instance.username, instance.ip_address)
-    distro = instance.distro
+def ubuntu14_bootstrap_steps(username, distro):
+    return [
+        Step('install_os_updates',
+             func=lambda: install_os_updates(distribution='ubuntu14.04'),
+             timeout=90 * 60,
+             resources=[PACKAGE_MANAGER, NETWORK]),
 
-    with settings(host_string=cloud_host,
-                  key_filename=instance.key_filename):
-        install_os_updates(distribution='ubuntu14.04')
         # we want to be running the latest kernel
-        upgrade_kernel_and_grub(do_reboot=True)
-        wait_for_ssh(instance.ip_address)
-
-        enable_apt_repositories('deb',
-                                'http://archive.ubuntu.com/ubuntu',
-                                '$(lsb_release -sc)',
-                                'main universe restricted multiverse')
+        Step('upgrade_kernel_and_grub', func=upgrade_kernel_and_grub,
+             timeout=90 * 60,
+             requires=['install_os_updates'],
+             resources=[PACKAGE_MANAGER, NETWORK],
+             reboot_after=True),
+
+        Step('enable_apt_repositories',
+             func=lambda: enable_apt_repositories(
+                 'deb',
+                 'http://archive.ubuntu.com/ubuntu',
+                 '$(lsb_release -sc)',
+                 'main universe restricted multiverse'),
+             requires=['upgrade_kernel_and_grub'],
+             resources=[PACKAGE_MANAGER]),
 
         # make sure our umask is set to 022
-        fix_umask(instance.username)
+        Step('fix_umask', fix_umask_commands(username)),
 
         # ttys are tricky, lets make sure we don't need them
-        disable_requiretty_on_sudoers()
-        disable_requiretty_on_sshd_config()
-
-        # when we sudo, we want to keep our original environment variables
-        disable_env_reset_on_sudo()
-
-        install_ubuntu_development_tools()
+        Step('disable_requiretty_on_sudoers',
+             func=disable_requiretty_on_sudoers),
+        Step('disable_requiretty_on_sshd_config',
+             func=disable_requiretty_on_sshd_config),
+
+        # when we sudo, we want to keep our original environment
+        # variables
+        Step('disable_env_reset_on_sudo',
+             func=disable_env_reset_on_sudo,
+             requires=['disable_requiretty_on_sudoers']),
+
+        Step('install_ubuntu_development_tools',
+             func=install_ubuntu_development_tools,
+             requires=['enable_apt_repositories'],
+             resources=[PACKAGE_MANAGER, NETWORK]),
 
         # installs a bunch of required packages
-        apt_install(packages=ubuntu14_required_packages())
+        Step('install_required_packages',
+             func=lambda: apt_install(packages=ubuntu14_required_packages()),
+             requires=['enable_apt_repositories'],
+             resources=[PACKAGE_MANAGER, NETWORK]),
 
         # install the latest ZFS from testing
         # add_zfs_ubuntu_repository()
@@ -201,68 +326,92 @@ def bootstrap_jenkins_slave_ubuntu14(instance):
 
         # we create a docker group ourselves, as we want to be part
         # of that group when the daemon first starts.
-        create_docker_group()
-        add_user_to_docker_group(distro)
-        install_docker()
+        Step('create_docker_group', func=create_docker_group),
+        Step('add_user_to_docker_group',
+             func=lambda: add_user_to_docker_group(distro),
+             requires=['create_docker_group']),
+
+        # docker installs the aufs module for the running kernel, so we
+        # want to be running the latest kernel by then
+        Step('install_docker', install_docker_commands(),
+             timeout=20 * 60, idle_timeout=5 * 60,
+             requires=['add_user_to_docker_group',
+                       'install_required_packages'],
+             resources=[PACKAGE_MANAGER, NETWORK],
+             after_reboot=['upgrade_kernel_and_grub']),
 
         # ubuntu uses dash which causes jenkins jobs to fail
-        symlink_sh_to_bash(distro)
+        Step('symlink_sh_to_bash', symlink_sh_to_bash_commands(distro)),
 
         # some flocker acceptance tests fail when we don't have
         # a know_hosts file
-        sudo("mkdir -p /root/.ssh")
-        sudo("touch /root/.ssh/known_hosts")
-
-        # generate a id_rsa_flocker
-        sudo("test -e  $HOME/.ssh/id_rsa_flocker || ssh-keygen -N '' "
-             "-f $HOME/.ssh/id_rsa_flocker")
-
-        # and fix perms on /root/.ssh
-        sudo("chmod -R 0600 /root/.ssh")
-
-        apt_install_from_url('rpmlint',
-                             'https://launchpad.net/ubuntu/+archive/'
-                             'primary/+files/rpmlint_1.5-1_all.deb')
-
-        # TODO: this may not be needed, as packaging is done on a docker img
-        install_system_gem('fpm')
+        Step('create_root_known_hosts', create_root_known_hosts_commands()),
+
+        Step('install_rpmlint',
+             func=lambda: apt_install_from_url(
+                 'rpmlint',
+                 'https://launchpad.net/ubuntu/+archive/'
+                 'primary/+files/rpmlint_1.5-1_all.deb'),
+             requires=['install_required_packages'],
+             resources=[PACKAGE_MANAGER, NETWORK]),
+
+        # TODO: this may not be needed, as packaging is done on a
+        # docker img
+        Step('install_fpm', func=lambda: install_system_gem('fpm'),
+             requires=['install_required_packages'],
+             resources=[NETWORK]),
 
         # systemd(service='docker', restart=True)
         # systemd(service='nginx', start=True, unmask=True)
 
-        # cache some docker images locally to speed up some of our tests
-        for docker_image in local_docker_images():
-            cache_docker_image_locally(docker_image)
+        # cache some docker images locally to speed up some of our
+        # tests
+        Step('cache_docker_images',
+             cache_docker_images_commands(local_docker_images()),
+             requires=['install_docker'],
+             resources=[NETWORK]),
 
         # centos has a fairly old git, so we install the latest version
         # in every box.
-        install_recent_git_from_source()
-        add_usr_local_bin_to_path()
+        Step('install_recent_git_from_source',
+             func=install_recent_git_from_source,
+             requires=['install_required_packages'],
+             resources=[PACKAGE_MANAGER, NETWORK, CPU]),
+        Step('add_usr_local_bin_to_path', func=add_usr_local_bin_to_path,
+             requires=['install_recent_git_from_source']),
 
         # to use wheels, we want the latest pip
-        update_system_pip_to_latest_pip()
+        Step('update_system_pip_to_latest_pip',
+             func=update_system_pip_to_latest_pip,
+             requires=['install_required_packages'],
+             resources=[NETWORK]),
 
         # cache the latest python modules and dependencies in the local
         # user cache
-        git_clone('https://github.com/ClusterHQ/flocker.git', 'flocker')
-        with cd('flocker'):
-            run('pip install --quiet --user .')
-            run('pip install --quiet --user'
-                ' --process-dependency-links ".[dev]"')
-            run('pip install --quiet --user python-subunit junitxml')
+        Step('cache_flocker_pip_dependencies', flocker_pip_cache_commands(),
+             as_user=True,
+             requires=['add_usr_local_bin_to_path',
+                       'update_system_pip_to_latest_pip'],
+             resources=[NETWORK, CPU]),
 
         # nginx is used during the acceptance tests, the VM built by
         # flocker provision will connect to the jenkins slave on p 80
         # and retrieve the just generated rpm/deb file
-        install_nginx(instance.username)
+        Step('install_nginx', func=lambda: install_nginx(username),
+             requires=['install_required_packages'],
+             resources=[PACKAGE_MANAGER]),
 
         # /etc/slave_config is used by the jenkins_slave plugin to
         # transfer files from the master to the slave
-        create_etc_slave_config()
+        Step('create_etc_slave_config', create_etc_slave_config_commands()),
 
-        # installs python-pypy onto /opt/python-pypy/2.6.1 and symlinks it
-        # to /usr/local/bin/pypy
-        install_python_pypy('2.6.1')
+        # installs python-pypy onto /opt/python-pypy/2.6.1 and symlinks
+        # it to /usr/local/bin/pypy
+        Step('install_python_pypy', install_python_pypy_commands('2.6.1'),
+             timeout=15 * 60, idle_timeout=5 * 60,
+             requires=['install_required_packages'],
+             resources=[NETWORK]),
+    ]
 
 
 def centos7_required_packages():
@@ -311,7 +460,8 @@ def centos7_required_packages():
             "openssl-devel",
             "nginx",
             "subversion-perl",
-            "ruby-devel"]
+            "ruby-devel",
+            "kexec-tools"]
 
 
 def ubuntu14_required_packages():
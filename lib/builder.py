@@ -0,0 +1,95 @@
+# vim: ai ts=4 sts=4 et sw=4 ft=python fdm=indent et foldlevel=0
+
+""" Choice of the instance type a build runs on
+
+The image works on any instance size, so the builder doesn't have to be
+the instance type of the platform config. With `fab builder:time` or
+`fab builder:cost`, up picks the type of the builder_types table of the
+cloud yaml file with the shortest or the cheapest predicted build.
+
+A type with MIN_BUILDS past builds of the same cloud and distribution is
+predicted to take as long as they did. Otherwise the prediction starts
+from the type with the most builds, and scales the time of its CPU-bound
+steps by the ratio of their vCPUs, the other stages and steps are mostly
+waiting on the network and the package manager and stay as they are.
+Without any history the builder keeps the type of the platform config.
+"""
+
+from time import time
+
+from lib.metrics import instance_type_history, percentile
+from lib.steps import CPU
+
+
+OBJECTIVES = ['time', 'cost']
+HISTORY_DAYS = 60
+MIN_BUILDS = 3
+
+# the config key of the instance type, by cloud
+TYPE_KEYS = {'ec2': 'instance_type',
+             'rackspace': 'instance_type',
+             'gce': 'machine_type'}
+
+
+def cpu_bound_steps(steps):
+    """ the names of the bootstrap steps that use the CPU """
+    return set(step.name for step in steps if CPU in step.resources)
+
+
+def predict(history, builder_types, cpu_steps):
+    """ returns the predicted build seconds of every builder type
+
+    :param dict history: from instance_type_history()
+    :param dict builder_types: {type: {'price': hourly, 'cpus': vcpus}}
+    :param set cpu_steps: the names of the CPU-bound steps
+    :return dict: {type: (seconds, how it was predicted)}, only the
+        types that could be predicted
+    """
+    measured = dict((instance_type, entry) for instance_type, entry
+                    in history.items()
+                    if instance_type in builder_types and
+                    len(entry['builds']) >= MIN_BUILDS)
+    predictions = {}
+    for instance_type, entry in measured.items():
+        predictions[instance_type] = (percentile(entry['builds'], 0.5),
+                                      'measured')
+    if not measured:
+        return predictions
+
+    reference = max(measured, key=lambda name: len(measured[name]['builds']))
+    build = percentile(measured[reference]['builds'], 0.5)
+    cpu = sum(percentile(durations, 0.5) for step, durations
+              in measured[reference]['steps'].items() if step in cpu_steps)
+    for instance_type, spec in builder_types.items():
+        if instance_type in predictions:
+            continue
+        ratio = (float(builder_types[reference]['cpus']) / spec['cpus'])
+        predictions[instance_type] = (
+            build - cpu + cpu * ratio,
+            'scaled from {}'.format(reference))
+    return predictions
+
+
+def choose(predictions, builder_types, objective):
+    """ returns the candidates, best first, as dicts with the type, the
+    predicted seconds and cost, and how they were predicted """
+    candidates = []
+    for instance_type, (seconds, basis) in predictions.items():
+        candidates.append({
+            'type': instance_type,
+            'seconds': seconds,
+            'cost': seconds / 3600.0 * builder_types[instance_type]['price'],
+            'basis': basis})
+    if objective == 'cost':
+        candidates.sort(key=lambda entry: (entry['cost'], entry['seconds']))
+    else:
+        candidates.sort(key=lambda entry: (entry['seconds'], entry['cost']))
+    return candidates
+
+
+def builder_candidates(cloud, distro, steps, builder_types, objective):
+    """ the builder types of cloud and distro, best first for objective """
+    history = instance_type_history(
+        cloud, distro.value, time() - HISTORY_DAYS * 24 * 60 * 60)
+    return choose(predict(history, builder_types, cpu_bound_steps(steps)),
+                  builder_types, objective)
@@ -0,0 +1,82 @@
+# vim: ai ts=4 sts=4 et sw=4 ft=python fdm=indent et foldlevel=0
+
+""" Selection of the acceptance checks a build needs to run
+
+A build that only changed a few bootstrap steps since the previous image of
+its target runs the checks tagged with those steps or with the changed
+inputs, plus the smoke checks. The inputs being compared are the
+build_inputs() recorded with the previous image and with the build, see
+lib/fingerprint.py.
+
+Every check runs when there is nothing to compare with, when an input no
+check covers changed (the platform config, an upstream revision), when the
+bootstrap code changed outside of what the step hashes cover, its
+'residue:' inputs, or when the last full run of the target is older than
+FULL_RUN_EVERY.
+"""
+
+from time import time
+
+
+FULL_RUN_EVERY = 7 * 24 * 60 * 60
+
+# the effect of a change to these files shows in the hashes of the steps,
+# or in their 'residue:' inputs
+SOURCE_INPUTS = ['lib/bootstrap.py',
+                 'lib/mycookbooks.py',
+                 'lib/zfs_kmod.py']
+RESIDUE = 'residue:'
+
+
+def changed_inputs(previous, current):
+    """ returns the names of the inputs that differ between two builds """
+    names = set(previous) | set(current)
+    return sorted(name for name in names
+                  if previous.get(name) != current.get(name))
+
+
+def full_run_due(full_checks_at, now=None):
+    """ True when the last full run is older than FULL_RUN_EVERY """
+    if not full_checks_at:
+        return True
+    return (now or time()) - full_checks_at > FULL_RUN_EVERY
+
+
+def select_checks(checks, previous_inputs, inputs):
+    """ returns the checks to run, and why
+
+    :param list checks: the checks of the distribution, tagged with the
+        steps and inputs they cover, see tests/acceptance.py
+    :param dict previous_inputs: the build_inputs of the previous image,
+        or None
+    :param dict inputs: the build_inputs of this build, or None
+    :return tuple: (list of checks, reason)
+    """
+    if not previous_inputs or not inputs:
+        return checks, 'no previous build inputs to compare with'
+    changed = changed_inputs(previous_inputs, inputs)
+    steps = set(name[len('step:'):] for name in changed
+                if name.startswith('step:'))
+    residues = [name[len(RESIDUE):] for name in changed
+                if name.startswith(RESIDUE)]
+    others = set(name for name in changed
+                 if not name.startswith('step:') and
+                 not name.startswith(RESIDUE) and
+                 name not in SOURCE_INPUTS)
+    if residues:
+        return checks, '{} changed outside of its steps'.format(
+            ', '.join(residues))
+    if not steps and set(changed) & set(SOURCE_INPUTS):
+        return checks, 'the bootstrap code changed outside of its steps'
+    covered = set()
+    for check in checks:
+        covered.update(check.inputs)
+    if others - covered:
+        return checks, '{} changed'.format(', '.join(sorted(others -
+                                                            covered)))
+
+    selected = [check for check in checks
+                if check.smoke or
+                steps & set(check.steps) or
+                others & set(check.inputs)]
+    return selected, 'changed: {}'.format(', '.join(changed) or 'nothing')
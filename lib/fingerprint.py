@@ -0,0 +1,188 @@
+# vim: ai ts=4 sts=4 et sw=4 ft=python fdm=indent et foldlevel=0
+
+""" Fingerprints of the inputs that go into an image
+
+An image only needs rebuilding when something that goes into it changed:
+the platform config, the bootstrap code and the pinned URLs and versions it
+contains, the package lists or the docker images we cache, and optionally
+the upstream revisions we install from. Each of these inputs is hashed on
+its own, so that we can tell which of them changed, and the fingerprint of
+the build is the hash of all of them. Every bootstrap step is hashed too,
+under 'step:<name>', which tells the acceptance checks a change affects.
+The steps with a callable hash its source, and the source of the functions
+of SOURCES it calls. What is left of each of SOURCES once those, and the
+helpers whose output the steps and the package lists hash, are taken out,
+is hashed under 'residue:<file>': a change there affects every check.
+"""
+
+import importlib
+import inspect
+import json
+import re
+import subprocess
+from hashlib import sha256
+
+from lib.bootstrap import (centos7_bootstrap_steps,
+                           centos7_required_packages,
+                           ubuntu14_bootstrap_steps,
+                           ubuntu14_required_packages)
+from lib.mycookbooks import local_docker_images
+
+
+SOURCES = ['lib/bootstrap.py',
+           'lib/mycookbooks.py',
+           'lib/zfs_kmod.py']
+
+UPSTREAMS = {'flocker': 'https://github.com/ClusterHQ/flocker.git'}
+
+# their output is hashed, in the steps and the packages input
+EXPLAINED = re.compile(r'_(commands|bootstrap_steps|required_packages)$')
+
+# credentials change without changing the image, leave them out
+SECRET_KEYS = ['credentials',
+               'credentials_email',
+               'credentials_private_key',
+               'access_key_id',
+               'secret_access_key',
+               'key_filename',
+               'key_pair',
+               'public_key_filename',
+               'private_key_filename']
+
+
+def _hash(value):
+    data = json.dumps(value, sort_keys=True).encode('utf-8')
+    return sha256(data).hexdigest()
+
+
+def _hash_file(filename):
+    with open(filename, 'rb') as source:
+        return sha256(source.read()).hexdigest()
+
+
+def _module_of(source):
+    return importlib.import_module(source[:-len('.py')].replace('/', '.'))
+
+
+def _code_names(code):
+    """ the global names code refers to, in nested code objects too """
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            names |= _code_names(const)
+    return names
+
+
+def called_functions(func, seen=None):
+    """ returns func and the functions of SOURCES it calls, transitively
+
+    a lambda only has the source of its line, the helpers it calls carry
+    the code that goes into the image.
+    """
+    modules = set(_module_of(source).__name__ for source in SOURCES)
+    seen = seen if seen is not None else []
+    if func in seen:
+        return seen
+    seen.append(func)
+    code = getattr(func, '__code__', None)
+    if code is None:
+        return seen
+    for name in sorted(_code_names(code)):
+        value = func.__globals__.get(name)
+        if inspect.isfunction(value) and value.__module__ in modules:
+            called_functions(value, seen)
+    return seen
+
+
+def _source(func):
+    try:
+        return inspect.getsource(func)
+    except (IOError, TypeError):
+        return '{}.{}'.format(func.__module__, func.__name__)
+
+
+def _hash_step(step):
+    """ hashes the commands of a step, or the source of its callable and
+    of the functions it calls """
+    declaration = [step.as_user, step.requires, step.resources,
+                   step.reboot_after, step.after_reboot]
+    if step.func is None:
+        return _hash([step.commands] + declaration)
+    return _hash([_source(func) for func in called_functions(step.func)] +
+                 declaration)
+
+
+def step_hashes(steps):
+    """ returns the hash of every step, keyed by 'step:<name>' """
+    return dict(('step:' + step.name, _hash_step(step)) for step in steps)
+
+
+def source_residues(steps):
+    """ hashes what the step hashes don't cover of each of SOURCES, keyed
+    by 'residue:<file>' """
+    explained = []
+    for step in steps:
+        if step.func is not None:
+            called_functions(step.func, explained)
+    residues = {}
+    for source in SOURCES:
+        module = _module_of(source)
+        functions = [value for name, value in vars(module).items()
+                     if inspect.isfunction(value) and
+                     value.__module__ == module.__name__ and
+                     EXPLAINED.search(name)]
+        with open(source) as source_file:
+            lines = source_file.readlines()
+        for func in explained + functions:
+            if getattr(func, '__module__', None) != module.__name__:
+                continue
+            try:
+                func_lines, start = inspect.getsourcelines(func)
+            except (IOError, TypeError):
+                continue
+            start = max(start, 1)
+            for index in range(start - 1, start - 1 + len(func_lines)):
+                lines[index] = '\n'
+        residues['residue:' + source] = _hash(''.join(lines))
+    return residues
+
+
+def upstream_revision(url):
+    """ returns the revision HEAD points to in a remote git repository """
+    output = subprocess.check_output(['git', 'ls-remote', url, 'HEAD'])
+    return output.decode('utf-8').split()[0]
+
+
+def build_inputs(config, distro, upstream=False):
+    """ returns the hash of every input of a build, keyed by input name
+
+    :param dict config: the platform config, from _get_platform_config()
+    :param Distribution distro: the distribution being built
+    :param bool upstream: include the revisions of the upstream repositories
+    """
+    if 'centos' in distro.value:
+        packages = centos7_required_packages()
+        steps = centos7_bootstrap_steps(config.get('username'), distro)
+    else:
+        packages = ubuntu14_required_packages()
+        steps = ubuntu14_bootstrap_steps(config.get('username'), distro)
+
+    inputs = {
+        'config': _hash(dict((key, value) for key, value in config.items()
+                             if key not in SECRET_KEYS)),
+        'packages': _hash(packages),
+        'docker_images': _hash(local_docker_images()),
+    }
+    for source in SOURCES:
+        inputs[source] = _hash_file(source)
+    inputs.update(step_hashes(steps))
+    inputs.update(source_residues(steps))
+    if upstream:
+        for name, url in UPSTREAMS.items():
+            inputs['upstream:' + name] = upstream_revision(url)
+    return inputs
+
+
+def fingerprint(inputs):
+    """ returns the fingerprint of a build from its build_inputs() """
+    return _hash(inputs)
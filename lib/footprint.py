@@ -0,0 +1,123 @@
+# vim: ai ts=4 sts=4 et sw=4 ft=python fdm=indent et foldlevel=0
+
+""" Disk footprint of the images we produce
+
+The disk usage of the root filesystem is sampled around every bootstrap
+step: inside the progress markers of the shell-command steps, with a df
+call before and after the steps with a python func. The growth of each
+step is recorded under 'disk_usage' in the build state, from where
+create_image copies it into the image registry.
+
+The optional slim stage removes what the bootstrap leaves behind before
+the image is created: package caches, downloaded tarballs and sources,
+build trees and logs. It then zeroes the free space so that the snapshot
+compresses well.
+"""
+
+from fabric.api import sudo
+from fabric.context_managers import hide, settings
+from bookshelf.api_v1 import log_green, log_yellow
+
+from lib.mycookbooks import has_state, load_state, locked_state, update_state
+
+
+DISK_USED_COMMAND = 'df -B1 --output=used / | tail -n 1'
+
+
+def disk_used():
+    """ returns the bytes used on the root filesystem, or None """
+    with settings(hide('everything'), warn_only=True):
+        output = sudo(DISK_USED_COMMAND)
+    if output.succeeded and output.strip().isdigit():
+        return int(output.strip())
+    return None
+
+
+def instance_disk_used(instance):
+    """ returns the bytes used on the root filesystem of instance """
+    with settings(host_string='%s@%s' % (instance.username,
+                                         instance.ip_address),
+                  key_filename=instance.key_filename):
+        return disk_used()
+
+
+def record_disk_delta(step_name, before, after):
+    """ records how much step_name grew the root filesystem """
+    if before is None or after is None or not has_state():
+        return
+    with locked_state() as state:
+        state.setdefault('disk_usage', {})[step_name] = after - before
+
+
+def log_largest_growth(count=5):
+    """ logs the steps that grew the root filesystem the most """
+    if not has_state():
+        return
+    usage = load_state().get('disk_usage', {})
+    for step_name, delta in sorted(usage.items(),
+                                   key=lambda item: -item[1])[:count]:
+        log_yellow('%s added %s' % (step_name, human_bytes(delta)))
+
+
+def human_bytes(count):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(count) < 1024 or unit == 'GB':
+            return '%.1f%s' % (count, unit)
+        count /= 1024.0
+
+
+def slim_commands(distro, username):
+    """ the cleanups of the slim stage, as (name, shell commands) pairs
+
+    :param Distribution distro: the distribution of the instance
+    :param string username: the login user, the flocker checkout lives in
+        its home directory
+    """
+    if 'centos' in distro.value:
+        package_caches = ['yum clean all',
+                          'rm -rf /var/cache/yum/*']
+    else:
+        package_caches = ['apt-get clean']
+    return [
+        ('package caches', package_caches),
+        ('build leftovers', [
+            'rm -f /opt/python-pypy/*.tar.bz2',
+            'rm -f /root/*.src.rpm /tmp/*.src.rpm',
+            'rm -rf /root/rpmbuild',
+            # the pip cache built from it stays
+            'rm -rf ~%s/flocker' % username,
+            'rm -rf /tmp/* /var/tmp/*']),
+        ('logs', [
+            'find /var/log -type f \\( -name "*.gz" -o -name "*.[0-9]" \\) '
+            '-delete',
+            'find /var/log -type f -exec truncate -s 0 {} +',
+            'if command -v journalctl; then '
+            'journalctl --vacuum-time=1s; fi']),
+        # dd stops with ENOSPC once the disk is full
+        ('free space', ['dd if=/dev/zero of=/zero.fill bs=1M || true',
+                        'rm -f /zero.fill',
+                        'sync']),
+    ]
+
+
+def slim(instance):
+    """ runs the slim stage on instance, returns the bytes it saved """
+    with settings(host_string='%s@%s' % (instance.username,
+                                         instance.ip_address),
+                  key_filename=instance.key_filename):
+        started = before = disk_used()
+        for name, commands in slim_commands(instance.distro,
+                                            instance.username):
+            log_green('removing %s' % name)
+            with settings(hide('stdout')):
+                for command in commands:
+                    sudo(command)
+            after = disk_used()
+            if before is not None and after is not None:
+                log_green('... saved %s' % human_bytes(before - after))
+            before = after
+    if started is None or before is None:
+        return None
+    if has_state():
+        update_state(slimmed=started - before)
+    return started - before
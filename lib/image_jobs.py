@@ -0,0 +1,148 @@
+# vim: ai ts=4 sts=4 et sw=4 ft=python fdm=indent et foldlevel=0
+
+""" Image creations running in the background
+
+create_image:wait=no records a job under a handle and leaves the imaging
+to a background worker, so that the build gives its controller slot back
+while the provider finalizes the image. The worker records the outcome in
+the job, and wait_images gathers the outcomes of the jobs it is given.
+A destroy requested while the image is still being created is carried out
+by the worker once it is done.
+
+The worker records its pid and a heartbeat in its job. A pending job whose
+worker died, or stopped beating for STALE_AFTER, is failed by whoever waits
+for it, and the instance it was given is destroyed.
+
+Point CI_SLAVE_IMAGE_JOBS_FILE at a shared path to share the jobs between
+jenkins workspaces on the same controller.
+"""
+
+import errno
+import json
+import os
+import socket
+import threading
+from contextlib import contextmanager
+from time import sleep, time
+
+from lib.mycookbooks import locked_json
+
+
+IMAGE_JOBS_FILE_NAME = os.environ.get('CI_SLAVE_IMAGE_JOBS_FILE',
+                                      '.image_jobs.json')
+POLL_INTERVAL = 10
+HEARTBEAT_INTERVAL = 30
+STALE_AFTER = 5 * 60
+# how long wait_images and verify wait for an image by default
+WAIT_TIMEOUT = 2 * 60 * 60
+
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def load_jobs():
+    """ returns every job, keyed by handle """
+    if not os.path.isfile(IMAGE_JOBS_FILE_NAME):
+        return {}
+    with open(IMAGE_JOBS_FILE_NAME) as jobs_file:
+        return json.load(jobs_file)
+
+
+def add_job(handle, job):
+    """ records a pending job under handle """
+    with locked_json(IMAGE_JOBS_FILE_NAME, {}) as jobs:
+        jobs[handle] = dict(job, status=PENDING, started=time())
+
+
+def update_job(handle, **kwargs):
+    """ updates the job of handle, returns it as updated
+
+    the update and the returned job are atomic, so that a worker finishing
+    and a destroy request never miss each other.
+    """
+    with locked_json(IMAGE_JOBS_FILE_NAME, {}) as jobs:
+        jobs[handle].update(kwargs)
+        return dict(jobs[handle])
+
+
+def unreported_handles():
+    """ the jobs wait_images didn't report yet """
+    return sorted(handle for handle, job in load_jobs().items()
+                  if not job.get('reported'))
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as error:
+        return error.errno == errno.EPERM
+    return True
+
+
+def is_stale(job, now=None):
+    """ True when job is pending but its worker is gone """
+    if job['status'] != PENDING:
+        return False
+    if (job.get('pid') and job.get('host') == socket.gethostname() and
+            not _alive(job['pid'])):
+        return True
+    return (now or time()) - job.get('heartbeat', job['started']) > STALE_AFTER
+
+
+def fail_stale_jobs(handles):
+    """ fails the stale jobs of handles, returns them keyed by handle """
+    stale = {}
+    with locked_json(IMAGE_JOBS_FILE_NAME, {}) as jobs:
+        for handle in handles:
+            if handle in jobs and is_stale(jobs[handle]):
+                jobs[handle].update(status=FAILED,
+                                    error='the image worker is gone')
+                stale[handle] = dict(jobs[handle])
+    return stale
+
+
+@contextmanager
+def heartbeat(handle, interval=HEARTBEAT_INTERVAL):
+    """ records the worker of the job of handle, and keeps the job from
+    going stale while the block runs """
+    update_job(handle, pid=os.getpid(), host=socket.gethostname(),
+               heartbeat=time())
+    stop = threading.Event()
+
+    def beat():
+        while not stop.wait(interval):
+            update_job(handle, heartbeat=time())
+
+    thread = threading.Thread(target=beat)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def wait_for_jobs(handles, timeout=None, interval=POLL_INTERVAL,
+                  on_stale=None):
+    """ blocks until none of the jobs of handles is pending
+
+    :param callable on_stale: called with the handle and the job of every
+        job failed for being stale
+    :return dict: the jobs, keyed by handle
+    """
+    deadline = timeout and time() + timeout
+    while True:
+        for handle, job in sorted(fail_stale_jobs(handles).items()):
+            if on_stale is not None:
+                on_stale(handle, job)
+        jobs = load_jobs()
+        missing = [handle for handle in handles if handle not in jobs]
+        if missing:
+            raise KeyError('no image job {}'.format(', '.join(missing)))
+        if all(jobs[handle]['status'] != PENDING for handle in handles):
+            return dict((handle, jobs[handle]) for handle in handles)
+        if deadline and time() > deadline:
+            return dict((handle, jobs[handle]) for handle in handles)
+        sleep(interval)
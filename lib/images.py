@@ -0,0 +1,72 @@
+# vim: ai ts=4 sts=4 et sw=4 ft=python fdm=indent et foldlevel=0
+
+""" Registry of the images produced by create_image
+
+Every image we bake is recorded with the cloud, region and distribution it
+was built for. Point CI_SLAVE_IMAGES_FILE at a shared path to have several
+jenkins workspaces share the same registry; the jobs of jobs.groovy keep it
+outside of the workspace, which every checkout cleans.
+
+A new image is promoted once the verify stage booted it and its acceptance
+tests passed. Images recorded before the verify stage existed count as
+promoted.
+"""
+
+import json
+import os
+
+from lib.mycookbooks import locked_json
+
+
+IMAGES_FILE_NAME = os.environ.get('CI_SLAVE_IMAGES_FILE', 'images.json')
+
+
+def load_images():
+    """ returns every recorded image, oldest first """
+    if not os.path.isfile(IMAGES_FILE_NAME):
+        return []
+    with open(IMAGES_FILE_NAME) as images_file:
+        return json.load(images_file)
+
+
+def record_image(image):
+    """ records a newly created image
+
+    :param dict image: with at least cloud, region, distro, image_basename,
+        image_name, image_id and created keys
+    """
+    with locked_json(IMAGES_FILE_NAME, []) as images:
+        images.append(image)
+
+
+def update_image(image_id, **kwargs):
+    """ updates the record of image_id """
+    with locked_json(IMAGES_FILE_NAME, []) as images:
+        for image in images:
+            if image['image_id'] == image_id:
+                image.update(kwargs)
+
+
+def find_image(image_id):
+    """ returns the record of image_id, or None """
+    for image in load_images():
+        if image['image_id'] == image_id:
+            return image
+    return None
+
+
+def is_promoted(image):
+    """ True when image passed its verification, see the verify task """
+    return image.get('promoted', True)
+
+
+def latest_images(promoted_only=False):
+    """ returns the newest image per cloud, region and image_basename """
+    latest = {}
+    for image in load_images():
+        if promoted_only and not is_promoted(image):
+            continue
+        key = (image['cloud'], image['region'], image['image_basename'])
+        if key not in latest or image['created'] > latest[key]['created']:
+            latest[key] = image
+    return [latest[key] for key in sorted(latest)]
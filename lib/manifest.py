@@ -0,0 +1,151 @@
+# vim: ai ts=4 sts=4 et sw=4 ft=python fdm=indent et foldlevel=0
+
+""" Content manifests of the images we bake
+
+A manifest is a sorted list of 'section<TAB>key<TAB>value' lines describing
+an instance: installed packages, cached docker images, pip freeze, tool
+versions and hashes of key config files. It is captured with a single
+remote command just before the image is created, and stored gzipped under
+manifests/. Two sorted manifests are compared in a single linear pass.
+"""
+
+import gzip
+import os
+
+from fabric.api import sudo
+from fabric.context_managers import settings, hide
+
+
+MANIFEST_DIR = 'manifests'
+
+CONFIG_FILES = ['/etc/sudoers',
+                '/etc/login.defs',
+                '/etc/ssh/sshd_config',
+                '/etc/sysconfig/spl',
+                '/etc/sysconfig/zfs',
+                '/etc/selinux/config']
+
+TOOLS = {'git': 'git --version',
+         'pypy': 'pypy --version 2>&1 | tr "\\n" " "',
+         'docker': 'docker --version',
+         'pip': 'pip --version',
+         'kernel': 'uname -r'}
+
+
+def manifest_command(distro):
+    """ returns the shell command printing the manifest of an instance """
+    if 'centos' in distro.value:
+        packages = "rpm -qa --qf '%{NAME}.%{ARCH}\\t%{VERSION}-%{RELEASE}\\n'"
+    else:
+        packages = "dpkg-query -W -f='${Package}\\t${Version}\\n'"
+
+    commands = [
+        "%s | sed 's/^/package\\t/'" % packages,
+        "docker images --digests --no-trunc | "
+        "awk 'NR > 1 {print \"docker\\t\" $1 \":\" $2 \"\\t\" $3 \" \" $4}'",
+        "pip freeze 2>/dev/null | sed -e 's/==/\\t/' -e 's/^/pip\\t/'",
+    ]
+    for tool in sorted(TOOLS):
+        commands.append('echo "tool\t%s\t$(%s)"' % (tool, TOOLS[tool]))
+    for config_file in CONFIG_FILES:
+        commands.append("test -e {0} && sha256sum {0} | "
+                        "awk '{{print \"file\\t\" $2 \"\\t\" $1}}'".format(
+                            config_file))
+    return '; '.join(commands) + '; true'
+
+
+def capture_manifest(instance):
+    """ returns the sorted manifest lines of a running instance """
+    cloud_host = "%s@%s" % (instance.username, instance.ip_address)
+    with settings(hide('running', 'stdout'),
+                  host_string=cloud_host,
+                  key_filename=instance.key_filename,
+                  warn_only=True):
+        output = sudo(manifest_command(instance.distro))
+    return sorted(set(line.rstrip('\r') for line in output.splitlines()
+                      if line.count('\t') >= 2))
+
+
+def save_manifest(name, lines):
+    """ stores a manifest, returns its path """
+    if not os.path.isdir(MANIFEST_DIR):
+        os.makedirs(MANIFEST_DIR)
+    path = os.path.join(MANIFEST_DIR, '%s.manifest.gz' % name)
+    manifest = gzip.open(path, 'wb')
+    try:
+        manifest.write(('\n'.join(lines) + '\n').encode('utf-8'))
+    finally:
+        manifest.close()
+    return path
+
+
+def load_manifest(path):
+    """ returns the sorted lines of a stored manifest """
+    manifest = gzip.open(path, 'rb')
+    try:
+        return manifest.read().decode('utf-8').splitlines()
+    finally:
+        manifest.close()
+
+
+def _split(line):
+    section, key, value = line.split('\t', 2)
+    return (section, key), value
+
+
+def _entries(lines):
+    """ yields (key, values) from sorted lines
+
+    installonly packages, such as several kernel versions, have a line per
+    version under the same key.
+    """
+    key, values = None, []
+    for line in lines:
+        line_key, value = _split(line)
+        if line_key != key and values:
+            yield key, values
+            values = []
+        key = line_key
+        values.append(value)
+    if values:
+        yield key, values
+
+
+def _diff_values(key, old_values, new_values):
+    if len(old_values) == 1 and len(new_values) == 1:
+        if old_values != new_values:
+            yield '~', key, old_values[0], new_values[0]
+        return
+    for value in old_values:
+        if value not in new_values:
+            yield '-', key, value, None
+    for value in new_values:
+        if value not in old_values:
+            yield '+', key, None, value
+
+
+def diff_manifests(old, new):
+    """ compares two sorted manifests
+
+    yields ('+', key, None, value) for added entries, ('-', key, value, None)
+    for removed ones and ('~', key, old_value, new_value) for changed ones,
+    where key is a (section, name) tuple. A key with several values, such
+    as an installonly package, yields the values added and removed.
+    """
+    old, new = _entries(old), _entries(new)
+    old_entry, new_entry = next(old, None), next(new, None)
+    while old_entry is not None or new_entry is not None:
+        if new_entry is None or (old_entry is not None and
+                                 old_entry[0] < new_entry[0]):
+            for value in old_entry[1]:
+                yield '-', old_entry[0], value, None
+            old_entry = next(old, None)
+        elif old_entry is None or new_entry[0] < old_entry[0]:
+            for value in new_entry[1]:
+                yield '+', new_entry[0], None, value
+            new_entry = next(new, None)
+        else:
+            for change in _diff_values(old_entry[0], old_entry[1],
+                                       new_entry[1]):
+                yield change
+            old_entry, new_entry = next(old, None), next(new, None)
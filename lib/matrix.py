@@ -0,0 +1,221 @@
+# vim: ai ts=4 sts=4 et sw=4 ft=python fdm=indent et foldlevel=0
+
+""" Makespan-aware scheduling of matrix builds
+
+A matrix run builds the images of many clouds, regions and distributions
+on one controller. The builds are started longest-expected-first, using
+the durations recorded in the metrics database, so that the slow targets
+don't start last and set the total time. Every time a build finishes the
+longest remaining build whose cloud is below its concurrency cap starts,
+so builds that finish early or late rebalance the rest of the run.
+"""
+
+import os
+import signal
+import subprocess
+from time import sleep, time
+
+from bookshelf.api_v1 import log_green, log_red, log_yellow
+
+from lib.metrics import build_durations, percentile
+
+
+EXECUTORS = 32
+# concurrent builds per cloud, to stay below the API quotas
+CLOUD_LIMITS = {'ec2': 12, 'rackspace': 4, 'gce': 8}
+# assumed for targets that never built before
+DEFAULT_DURATION = 45 * 60
+HISTORY_DAYS = 60
+POLL_INTERVAL = 5
+LOG_DIR = os.path.join('logs', 'matrix')
+
+STAGES = ['up', 'bootstrap', 'tests', 'create_image', 'verify']
+
+
+def target_name(target):
+    return '{}-{}-{}'.format(*target)
+
+
+def expected_durations(targets, since=None):
+    """ returns the median past duration of every (cloud, region, distro)
+
+    targets without history get the median of their cloud and
+    distribution, or else DEFAULT_DURATION.
+    """
+    if since is None:
+        since = time() - HISTORY_DAYS * 24 * 60 * 60
+    by_target = {}
+    by_cloud = {}
+    for started, cloud, region, distro, duration in build_durations(since):
+        by_target.setdefault((cloud, region, distro), []).append(duration)
+        by_cloud.setdefault((cloud, distro), []).append(duration)
+
+    expected = {}
+    for target in targets:
+        durations = (by_target.get(target) or
+                     by_cloud.get((target[0], target[2])))
+        if durations:
+            expected[target] = percentile(durations, 0.5)
+        else:
+            expected[target] = DEFAULT_DURATION
+    return expected
+
+
+def check_limits(targets, executors, cloud_limits):
+    """ makes sure every target can get an executor, else no build of its
+    cloud would ever start """
+    if executors < 1:
+        raise ValueError('executors is {}, at least 1 build must run at '
+                         'once'.format(executors))
+    for cloud in sorted(set(target[0] for target in targets)):
+        if cloud_limits.get(cloud, executors) < 1:
+            raise ValueError('the limit of {} is {}, at least 1 of its builds '
+                             'must run at once'.format(cloud,
+                                                       cloud_limits[cloud]))
+
+
+def next_target(pending, running, executors, cloud_limits):
+    """ the first pending target with a free executor and room in its cloud
+
+    :param list pending: the targets left, longest expected first
+    :param list running: the targets being built
+    """
+    if len(running) >= executors:
+        return None
+    per_cloud = {}
+    for target in running:
+        per_cloud[target[0]] = per_cloud.get(target[0], 0) + 1
+    for target in pending:
+        if per_cloud.get(target[0], 0) < cloud_limits.get(target[0],
+                                                          executors):
+            return target
+    return None
+
+
+def predicted_makespan(expected, executors, cloud_limits):
+    """ returns the makespan if every build takes as long as expected """
+    check_limits(expected, executors, cloud_limits)
+    pending = sorted(expected, key=expected.get, reverse=True)
+    running = []
+    now = 0
+    while pending or running:
+        target = next_target(pending, [entry[1] for entry in running],
+                             executors, cloud_limits)
+        if target is not None:
+            pending.remove(target)
+            running.append((now + expected[target], target))
+            continue
+        running.sort()
+        now = running.pop(0)[0]
+    return now
+
+
+def start_fab(target, tasks, state_file, log_path):
+    """ starts fab running tasks for target, returns the process
+
+    fab leads a process group of its own, see kill_fab.
+
+    :param tuple target: (cloud, region, distribution)
+    :param string state_file: the state file of the build
+    :param string log_path: where the output of fab goes
+    """
+    cloud, region, distro = target
+    environment = dict(os.environ, CI_SLAVE_STATE_FILE=state_file)
+    log_file = open(log_path, 'a')
+    return subprocess.Popen(['fab',
+                             'cloud:{}'.format(cloud),
+                             'region:{}'.format(region),
+                             'distribution:{}'.format(distro)] + tasks,
+                            env=environment,
+                            stdout=log_file, stderr=subprocess.STDOUT,
+                            close_fds=True, preexec_fn=os.setsid)
+
+
+def kill_fab(process):
+    """ kills a fab of start_fab with every process it started """
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        # gone already
+        pass
+    process.wait()
+
+
+class MatrixScheduler(object):
+    """ runs the build of every target, longest expected first
+
+    :param dict expected: the expected duration of every target
+    :param list tasks: the fab tasks to run before the build stages,
+        e.g. ['batch', 'parallel:4']
+    :param int executors: how many builds run at once
+    :param dict cloud_limits: how many builds run at once per cloud
+    """
+
+    def __init__(self, expected, tasks=(), executors=EXECUTORS,
+                 cloud_limits=CLOUD_LIMITS, poll_interval=POLL_INTERVAL):
+        check_limits(expected, executors, cloud_limits)
+        self.expected = expected
+        self.tasks = list(tasks)
+        self.executors = executors
+        self.cloud_limits = cloud_limits
+        self.poll_interval = poll_interval
+        self.pending = sorted(expected, key=expected.get, reverse=True)
+        self.running = {}
+        self.cleanups = []
+        self.results = {}
+
+    def _state_file(self, target):
+        return os.path.abspath('.state-{}.json'.format(target_name(target)))
+
+    def _fab(self, target, tasks):
+        """ starts fab for target, with a state file of its own """
+        return start_fab(target, self.tasks + tasks, self._state_file(target),
+                         os.path.join(LOG_DIR, target_name(target) + '.log'))
+
+    def _start(self, target):
+        self.pending.remove(target)
+        log_green('starting {} (expected {}s)'.format(
+            target_name(target), int(self.expected[target])))
+        self.running[target] = (self._fab(target, STAGES), time())
+
+    def _finish(self, target, returncode):
+        process, started = self.running.pop(target)
+        duration = int(time() - started)
+        if returncode == 0:
+            log_green('{} succeeded in {}s'.format(target_name(target),
+                                                   duration))
+        else:
+            log_red('{} failed after {}s, see {}'.format(
+                target_name(target), duration,
+                os.path.join(LOG_DIR, target_name(target) + '.log')))
+            if os.path.isfile(self._state_file(target)):
+                # don't leak the instance of a failed build
+                self.cleanups.append(self._fab(target, ['destroy']))
+        self.results[target] = {'passed': returncode == 0,
+                                'duration': duration,
+                                'expected': int(self.expected[target])}
+
+    def run(self):
+        """ runs all the builds, returns their results keyed by target """
+        if not os.path.isdir(LOG_DIR):
+            os.makedirs(LOG_DIR)
+        log_yellow('predicted makespan: {}s for {} builds'.format(
+            int(predicted_makespan(self.expected, self.executors,
+                                   self.cloud_limits)),
+            len(self.expected)))
+        started = time()
+        while self.pending or self.running:
+            while True:
+                target = next_target(self.pending, list(self.running),
+                                     self.executors, self.cloud_limits)
+                if target is None:
+                    break
+                self._start(target)
+            sleep(self.poll_interval)
+            for target, (process, _) in list(self.running.items()):
+                if process.poll() is not None:
+                    self._finish(target, process.returncode)
+        log_yellow('makespan: {}s'.format(int(time() - started)))
+        for process in self.cleanups:
+            process.wait()
+        return self.results
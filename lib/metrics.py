@@ -0,0 +1,338 @@
+# vim: ai ts=4 sts=4 et sw=4 ft=python fdm=indent et foldlevel=0
+
+""" Historical build metrics
+
+Every build appends its stage and step durations, together with the cloud,
+region, distribution and instance type it ran on, to a local SQLite
+database. Point CI_SLAVE_METRICS_DB at a shared path to collect the
+metrics of several jenkins workspaces, as the jobs of jobs.groovy do. The
+calls to the providers are buffered and written once per stage, and when
+the process exits.
+"""
+
+import atexit
+import os
+import sqlite3
+import threading
+from contextlib import closing
+from datetime import datetime
+from functools import wraps
+from time import time
+
+from fabric.api import env
+from bookshelf.api_v1 import log_green, log_red
+
+from lib.mycookbooks import has_state, load_state
+
+
+METRICS_DB = os.environ.get('CI_SLAVE_METRICS_DB', 'metrics.db')
+# api calls kept in memory before they are written
+API_CALLS_BUFFER = 200
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS builds (
+    build_id TEXT PRIMARY KEY,
+    started REAL,
+    cloud TEXT,
+    region TEXT,
+    distro TEXT,
+    instance_type TEXT,
+    result TEXT
+);
+CREATE TABLE IF NOT EXISTS stages (
+    build_id TEXT,
+    stage TEXT,
+    started REAL,
+    duration REAL,
+    result TEXT
+);
+CREATE TABLE IF NOT EXISTS steps (
+    build_id TEXT,
+    stage TEXT,
+    step TEXT,
+    started REAL,
+    duration REAL,
+    result TEXT,
+    remote_calls INTEGER
+);
+CREATE INDEX IF NOT EXISTS steps_by_step ON steps (step, started);
+CREATE TABLE IF NOT EXISTS api_calls (
+    cloud TEXT,
+    region TEXT,
+    method TEXT,
+    started REAL,
+    duration REAL,
+    throttles INTEGER,
+    result TEXT
+);
+"""
+
+
+def connect():
+    """ returns a connection to the metrics database """
+    connection = sqlite3.connect(METRICS_DB, timeout=30)
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def _execute(query, parameters=()):
+    with closing(connect()) as connection:
+        with connection:
+            connection.execute(query, parameters)
+
+
+def _current_build_id():
+    if has_state():
+        return load_state().get('build_id')
+    return None
+
+
+def record_build(build_id, cloud, region, distro, instance_type):
+    """ records the start of a build """
+    _execute('INSERT OR IGNORE INTO builds VALUES (?, ?, ?, ?, ?, ?, ?)',
+             (build_id, time(), cloud, region, distro.value, instance_type,
+              'running'))
+
+
+def finish_build(result, build_id=None):
+    """ records the outcome of the current build """
+    build_id = build_id or _current_build_id()
+    if build_id:
+        _execute('UPDATE builds SET result = ? WHERE build_id = ?',
+                 (result, build_id))
+
+
+def record_step(step, started, duration, result, remote_calls=None):
+    """ records the duration of a step of the current build and stage """
+    build_id = _current_build_id()
+    if build_id:
+        _execute('INSERT INTO steps VALUES (?, ?, ?, ?, ?, ?, ?)',
+                 (build_id, env.get('command'), step, started, duration,
+                  result, remote_calls))
+
+
+_api_calls = []
+_api_calls_lock = threading.Lock()
+
+
+def record_api_call(cloud, region, method, started, duration, throttles,
+                    result):
+    """ records a call to a cloud provider, see lib.throttle
+
+    the calls are buffered, see flush_api_calls.
+    """
+    with _api_calls_lock:
+        _api_calls.append((cloud, region, method, started, duration,
+                           throttles, result))
+        full = len(_api_calls) >= API_CALLS_BUFFER
+    if full:
+        flush_api_calls()
+
+
+def flush_api_calls():
+    """ writes the buffered api calls in a single transaction """
+    with _api_calls_lock:
+        calls = list(_api_calls)
+        del _api_calls[:]
+    if calls:
+        with closing(connect()) as connection:
+            with connection:
+                connection.executemany(
+                    'INSERT INTO api_calls VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    calls)
+
+
+# multiprocessing workers skip atexit, they flush themselves
+atexit.register(flush_api_calls)
+
+
+def timed_stage(func):
+    """ decorator recording the duration of a fab task as a build stage
+
+    a failing stage marks the whole build as failed.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        started = time()
+        result = 'failed'
+        # up creates the state, destroy removes it
+        build_id = _current_build_id()
+        try:
+            value = func(*args, **kwargs)
+            result = 'succeeded'
+            return value
+        finally:
+            flush_api_calls()
+            build_id = _current_build_id() or build_id
+            if build_id:
+                _execute('INSERT INTO stages VALUES (?, ?, ?, ?, ?)',
+                         (build_id, func.__name__, started,
+                          time() - started, result))
+                if result == 'failed':
+                    finish_build('failed', build_id)
+    return wrapper
+
+
+def percentile(values, fraction):
+    """ returns the given percentile of values, by nearest rank """
+    values = sorted(values)
+    if not values:
+        return None
+    index = int(round(fraction * (len(values) - 1)))
+    return values[index]
+
+
+def step_history(since=0):
+    """ returns {(stage, step): [durations]} for steps started since """
+    history = {}
+    with closing(connect()) as connection:
+        rows = connection.execute(
+            'SELECT stage, step, duration FROM steps '
+            'WHERE started >= ? AND result = ?', (since, 'succeeded'))
+        for stage, step, duration in rows:
+            history.setdefault((stage, step), []).append(duration)
+    return history
+
+
+def stage_history(since=0):
+    """ returns {stage: [durations]} for stages started since """
+    history = {}
+    with closing(connect()) as connection:
+        rows = connection.execute(
+            'SELECT stage, duration FROM stages '
+            'WHERE started >= ? AND result = ?', (since, 'succeeded'))
+        for stage, duration in rows:
+            history.setdefault(stage, []).append(duration)
+    return history
+
+
+def step_history_by(column, since=0, until=None):
+    """ returns {(value of column, step): [durations]}
+
+    :param string column: a column of the builds table, e.g. 'region'
+    """
+    assert column in ('cloud', 'region', 'distro', 'instance_type')
+    history = {}
+    with closing(connect()) as connection:
+        rows = connection.execute(
+            'SELECT builds.%s, steps.step, steps.duration FROM steps '
+            'JOIN builds ON builds.build_id = steps.build_id '
+            'WHERE steps.started >= ? AND steps.started < ? '
+            'AND steps.result = ?' % column,
+            (since, until or time(), 'succeeded'))
+        for value, step, duration in rows:
+            history.setdefault((value, step), []).append(duration)
+    return history
+
+
+def build_durations(since=0):
+    """ returns [(started, cloud, region, distro, seconds)] of the builds
+
+    the duration of a build is the sum of its stages.
+    """
+    with closing(connect()) as connection:
+        return connection.execute(
+            'SELECT builds.started, builds.cloud, builds.region, '
+            'builds.distro, SUM(stages.duration) FROM builds '
+            'JOIN stages ON stages.build_id = builds.build_id '
+            'WHERE builds.started >= ? AND builds.result = ? '
+            'GROUP BY builds.build_id ORDER BY builds.started',
+            (since, 'succeeded')).fetchall()
+
+
+def instance_type_history(cloud, distro, since=0):
+    """ returns the builds of cloud and distro, by instance type
+
+    :return dict: {instance_type: {'builds': [seconds],
+                                   'steps': {step: [seconds]}}}
+    """
+    history = {}
+    with closing(connect()) as connection:
+        rows = connection.execute(
+            'SELECT builds.instance_type, SUM(stages.duration) FROM builds '
+            'JOIN stages ON stages.build_id = builds.build_id '
+            'WHERE builds.cloud = ? AND builds.distro = ? '
+            'AND builds.started >= ? AND builds.result = ? '
+            'GROUP BY builds.build_id',
+            (cloud, distro, since, 'succeeded'))
+        for instance_type, duration in rows:
+            history.setdefault(instance_type, {'builds': [], 'steps': {}})
+            history[instance_type]['builds'].append(duration)
+        rows = connection.execute(
+            'SELECT builds.instance_type, steps.step, steps.duration '
+            'FROM steps JOIN builds ON builds.build_id = steps.build_id '
+            'WHERE builds.cloud = ? AND builds.distro = ? '
+            'AND builds.started >= ? AND builds.result = ? '
+            'AND steps.result = ?',
+            (cloud, distro, since, 'succeeded', 'succeeded'))
+        for instance_type, step, duration in rows:
+            if instance_type in history:
+                history[instance_type]['steps'].setdefault(
+                    step, []).append(duration)
+    return history
+
+
+def api_call_history(since=0):
+    """ returns {(cloud, region): [(duration, throttles, result)]} """
+    history = {}
+    with closing(connect()) as connection:
+        rows = connection.execute(
+            'SELECT cloud, region, duration, throttles, result '
+            'FROM api_calls WHERE started >= ?', (since,))
+        for cloud, region, duration, throttles, result in rows:
+            history.setdefault((cloud, region), []).append(
+                (duration, throttles, result))
+    return history
+
+
+def _median(values):
+    return percentile(values, 0.5)
+
+
+def report(days=30, regression_days=7, threshold=1.25):
+    """ prints step percentiles, build trends and regressions per region
+
+    :param int days: how far back to look
+    :param int regression_days: recent window compared to the rest
+    :param float threshold: slowdown ratio reported as a regression
+    """
+    now = time()
+    since = now - days * 24 * 60 * 60
+    recent = now - regression_days * 24 * 60 * 60
+
+    log_green('step durations over the last %d days' % days)
+    print('%-12s %-40s %6s %8s %8s' % ('stage', 'step', 'runs', 'p50', 'p95'))
+    for (stage, step), durations in sorted(step_history(since).items()):
+        print('%-12s %-40s %6d %7ds %7ds' % (
+            stage, step, len(durations),
+            percentile(durations, 0.5), percentile(durations, 0.95)))
+
+    log_green('median build duration per week')
+    weeks = {}
+    for started, cloud, region, distro, duration in build_durations(since):
+        week = datetime.utcfromtimestamp(started).strftime('%Y-w%W')
+        weeks.setdefault((week, distro), []).append(duration)
+    for (week, distro), durations in sorted(weeks.items()):
+        print('%-10s %-12s %6d builds %7ds' % (
+            week, distro, len(durations), _median(durations)))
+
+    log_green('cloud API calls over the last %d days' % days)
+    print('%-10s %-16s %8s %10s %8s' % ('cloud', 'region', 'calls',
+                                        'throttles', 'p95'))
+    for (cloud, region), calls in sorted(api_call_history(since).items()):
+        print('%-10s %-16s %8d %10d %7.1fs' % (
+            cloud, region, len(calls), sum(call[1] for call in calls),
+            percentile([call[0] for call in calls], 0.95)))
+
+    log_green('steps more than %d%% slower over the last %d days' % (
+        (threshold - 1) * 100, regression_days))
+    baseline = step_history_by('region', since=since, until=recent)
+    for key, durations in sorted(step_history_by('region',
+                                                 since=recent).items()):
+        if key not in baseline or not _median(baseline[key]):
+            continue
+        ratio = _median(durations) / _median(baseline[key])
+        if ratio > threshold:
+            log_red('%s %s: %ds -> %ds (x%.1f)' % (
+                key[0], key[1], _median(baseline[key]), _median(durations),
+                ratio))
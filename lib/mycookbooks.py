@@ -12,39 +12,39 @@ import sys
 import yaml
 import re
 import json
+import fcntl
 
+from contextlib import contextmanager
+from datetime import datetime
 from time import sleep
 
 from fabric.api import sudo, env
-from fabric.context_managers import settings, cd, hide
-from fabric.contrib.files import (sed,
-                                  exists as file_exists,
-                                  append as file_append)
+from fabric.context_managers import settings, hide
+from fabric.network import disconnect_all
 
 from cuisine import (user_ensure,
                      group_ensure,
                      group_user_ensure)
 
-from bookshelf.api_v1 import (dir_ensure,
-                              file_attribs,
-                              log_green,
+from bookshelf.api_v1 import (log_green,
                               enable_firewalld_service,
                               log_yellow,
                               add_firewalld_port,
                               systemd,
                               reboot,
+                              wait_for_ssh,
                               yum_install)
 
 
-STATE_FILE_NAME = '.state.json'
+# matrix builds give every build of a controller its own state file
+STATE_FILE_NAME = os.environ.get('CI_SLAVE_STATE_FILE', '.state.json')
 
 
 def add_user_to_docker_group(distro):
     """ make sure the user running jenkins is part of the docker group """
     log_green('adding the user running jenkins into the docker group')
 
-    with settings(hide('warnings', 'running', 'stdout', 'stderr'),
-                  warn_only=True, capture=True):
+    with settings(hide('warnings'), warn_only=True):
         if 'centos' in distro.value:
             user_ensure('centos', home='/home/centos', shell='/bin/bash')
             group_ensure('docker', gid=55)
@@ -56,6 +56,11 @@ def add_user_to_docker_group(distro):
             group_user_ensure('docker', 'ubuntu')
 
 
+def cache_docker_images_commands(docker_images):
+    """ shell commands pulling docker images into the local docker cache """
+    return ['docker pull %s' % docker_image for docker_image in docker_images]
+
+
 def create_etc_slave_config():
     """ creates /etc/slave_config directory on master
 
@@ -66,9 +71,72 @@ def create_etc_slave_config():
     # TODO: fix these permissions, likely ubuntu/centos/jenkins users
     # need read/write permissions.
     log_green('create /etc/slave_config')
-    with settings(hide('warnings', 'running', 'stdout', 'stderr'),
-                  warn_only=True, capture=True):
-        dir_ensure('/etc/slave_config', mode="777", use_sudo=True)
+    with settings(hide('warnings'), warn_only=True):
+        for command in create_etc_slave_config_commands():
+            sudo(command)
+
+
+def create_etc_slave_config_commands():
+    """ shell commands for create_etc_slave_config() """
+    return ['mkdir -p /etc/slave_config',
+            'chmod 777 /etc/slave_config']
+
+
+def create_root_known_hosts_commands():
+    """ shell commands creating /root/.ssh/known_hosts and id_rsa_flocker
+
+    some flocker acceptance tests fail when we don't have a known_hosts file.
+    """
+    return ['mkdir -p /root/.ssh',
+            'touch /root/.ssh/known_hosts',
+            "test -e  $HOME/.ssh/id_rsa_flocker || ssh-keygen -N '' "
+            "-f $HOME/.ssh/id_rsa_flocker",
+            'chmod -R 0600 /root/.ssh']
+
+
+def enable_selinux_commands():
+    """ shell commands setting SELinux to enforcing
+
+    when SELinux is disabled, the filesystem gets relabelled on the next
+    boot and SELinux is enforcing after that reboot.
+    """
+    return ["sed -i -e 's/^SELINUX=.*/SELINUX=enforcing/' "
+            "/etc/selinux/config",
+            'if [ "$(getenforce)" = "Disabled" ]; then '
+            'touch /.autorelabel; else setenforce 1; fi']
+
+
+def fast_reboot(ip_address):
+    """ reboots the host and waits for ssh to come back
+
+    uses kexec to skip the firmware and the bootloader when the running
+    kernel supports it and systemd can shut down cleanly into the new
+    kernel, falls back to a normal reboot otherwise.
+    """
+    with settings(hide('running', 'stdout'), warn_only=True):
+        kexec = sudo('test -e /sys/kernel/kexec_loaded && '
+                     'command -v kexec && '
+                     'command -v systemctl && '
+                     'command -v grubby')
+        if kexec.succeeded:
+            kexec = sudo('kernel=$(grubby --default-kernel) && '
+                         'kexec -l $kernel '
+                         '--initrd=$(grubby --info=$kernel | '
+                         'sed -n "s/^initrd=//p") '
+                         '--reuse-cmdline')
+
+    if kexec.succeeded:
+        log_yellow('rebooting host with kexec')
+        with settings(warn_only=True):
+            sudo('nohup systemctl kexec > /dev/null 2>&1 &', pty=False)
+        disconnect_all()
+        # give the host some time to go down
+        sleep(20)
+    else:
+        log_yellow('rebooting host')
+        with settings(warn_only=True):
+            reboot()
+    wait_for_ssh(ip_address)
 
 
 def fix_umask(username):
@@ -77,22 +145,41 @@ def fix_umask(username):
     fix an issue with the the build package process where it fails, due
     the files in the produced package have the wrong permissions.
     """
-    with settings(hide('warnings', 'running', 'stdout', 'stderr'),
-                  warn_only=True, capture=True):
+    with settings(hide('warnings'), warn_only=True):
+        for command in fix_umask_commands(username):
+            sudo(command)
+
+
+def fix_umask_commands(username):
+    """ shell commands for fix_umask() """
+    commands = ["sed -i.bak -r -e "
+                "'s/USERGROUPS_ENAB.*yes/USERGROUPS_ENAB no/g' "
+                "/etc/login.defs",
+                "sed -i.bak -r -e 's/UMASK.*/UMASK  022/g' /etc/login.defs"]
+
+    homedir = '/home/' + username + '/'
+    for f in [homedir + '.bash_profile',
+              homedir + '.bashrc']:
+        commands.append("grep -qx 'umask 022' %s || "
+                        "echo 'umask 022' >> %s" % (f, f))
+        commands.append('chmod 750 %s' % f)
+        commands.append('chown %s %s' % (username, f))
+    return commands
 
-        sed('/etc/login.defs',
-            'USERGROUPS_ENAB.*yes', 'USERGROUPS_ENAB no',
-            use_sudo=True)
 
-        sed('/etc/login.defs',
-            'UMASK.*', 'UMASK  022',
-            use_sudo=True)
+def flocker_pip_cache_commands():
+    """ shell commands caching flocker and its dependencies
 
-        homedir = '/home/' + username + '/'
-        for f in [homedir + '.bash_profile',
-                  homedir + '.bashrc']:
-            file_append(filename=f, text='umask 022')
-            file_attribs(f, mode=750, owner=username)
+    installs the latest flocker modules and dependencies into the user's
+    pip cache, these commands are meant to run as the login user.
+    """
+    return ['test -d flocker || '
+            'git clone https://github.com/ClusterHQ/flocker.git flocker',
+            'cd flocker && pip install --quiet --user .',
+            'cd flocker && pip install --quiet --user '
+            '--process-dependency-links ".[dev]"',
+            'cd flocker && pip install --quiet --user '
+            'python-subunit junitxml']
 
 
 def get_cloud_environment():
@@ -114,7 +201,13 @@ def get_cloud_environment():
 
 def install_docker():
     """ installs latest docker """
-    sudo('curl -sSL https://get.docker.com/ | sh')
+    for command in install_docker_commands():
+        sudo(command)
+
+
+def install_docker_commands():
+    """ shell commands for install_docker() """
+    return ['curl -sSL https://get.docker.com/ | sh']
 
 
 def install_nginx(username):
@@ -165,10 +258,17 @@ def symlink_sh_to_bash(distro):
     to set, so in order to force ubuntu nodes to execute jobs
     using bash, let's symlink /bin/sh -> /bin/bash
     """
+    for command in symlink_sh_to_bash_commands(distro):
+        sudo(command)
+
+
+def symlink_sh_to_bash_commands(distro):
+    """ shell commands for symlink_sh_to_bash() """
     # read distribution from state file
     if 'ubuntu' in distro.value.lower():
-        sudo('/bin/rm /bin/sh')
-        sudo('/bin/ln -s /bin/bash /bin/sh')
+        return ['/bin/rm /bin/sh',
+                '/bin/ln -s /bin/bash /bin/sh']
+    return []
 
 
 def install_python_pypy(version,
@@ -176,18 +276,32 @@ def install_python_pypy(version,
                         pypy_home='/opt/python-pypy',
                         mode='755'):
     """ installs python pypy """
-    dir_ensure(pypy_home, mode=mode, use_sudo=True)
+    for command in install_python_pypy_commands(version,
+                                                pypy_home=pypy_home,
+                                                mode=mode):
+        sudo(command)
+
+
+def install_python_pypy_commands(version,
+                                 pypy_home='/opt/python-pypy',
+                                 mode='755'):
+    """ shell commands for install_python_pypy() """
     pypy_path = "%s/%s/bin/pypy" % (pypy_home, version)
     pathname = "pypy-%s-linux_x86_64-portable" % version
     tgz = "%s.tar.bz2" % pathname
     url = "https://bitbucket.org/squeaky/portable-pypy/downloads/%s" % tgz
 
-    if not file_exists(pypy_path):
-        with cd(pypy_home):
-            sudo('wget -c %s' % url)
-            sudo('tar xjf %s' % tgz)
-            sudo('mv %s %s' % (pathname, version))
-            sudo('ln -s %s /usr/local/bin/pypy' % pypy_path)
+    return ['mkdir -p %s' % pypy_home,
+            'chmod %s %s' % (mode, pypy_home),
+            'test -e %s || ( cd %s && '
+            'wget -c %s && '
+            'tar xjf %s && '
+            'mv %s %s && '
+            'ln -s %s /usr/local/bin/pypy )' % (pypy_path, pypy_home,
+                                                 url,
+                                                 tgz,
+                                                 pathname, version,
+                                                 pypy_path)]
 
 
 def upgrade_kernel_and_grub(do_reboot=False, log=True):
@@ -196,19 +310,18 @@ def upgrade_kernel_and_grub(do_reboot=False, log=True):
     if log:
         log_yellow('upgrading kernel')
 
-    with settings(hide('running', 'stdout')):
-        sudo('unset UCF_FORCE_CONFFOLD; '
-             'export UCF_FORCE_CONFFNEW=YES; '
-             'ucf --purge /boot/grub/menu.lst; '
-             'export DEBIAN_FRONTEND=noninteractive ; '
-             'apt-get update; '
-             'apt-get -o Dpkg::Options::="--force-confnew" --force-yes -fuy '
-             'dist-upgrade')
-        with settings(warn_only=True):
-            if do_reboot:
-                if log:
-                    log_yellow('rebooting host')
-                reboot()
+    sudo('unset UCF_FORCE_CONFFOLD; '
+         'export UCF_FORCE_CONFFNEW=YES; '
+         'ucf --purge /boot/grub/menu.lst; '
+         'export DEBIAN_FRONTEND=noninteractive ; '
+         'apt-get update; '
+         'apt-get -o Dpkg::Options::="--force-confnew" --force-yes -fuy '
+         'dist-upgrade')
+    with settings(warn_only=True):
+        if do_reboot:
+            if log:
+                log_yellow('rebooting host')
+            reboot()
 
 
 def parse_config(filename):
@@ -271,3 +384,43 @@ def load_state():
 def save_state(state):
     with open(STATE_FILE_NAME, "w") as data_file:
         json.dump(state, data_file)
+
+
+@contextmanager
+def locked_json(filename, default):
+    """ read-modify-write of a json file shared between processes
+
+    yields the decoded content, or default when the file doesn't exist yet,
+    for the caller to modify in place. The file is rewritten atomically
+    once the caller is done, while holding an exclusive lock.
+    """
+    with open(filename + '.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            data = default
+            if os.path.isfile(filename):
+                with open(filename) as data_file:
+                    data = json.load(data_file)
+            yield data
+            with open(filename + '.tmp', 'w') as data_file:
+                json.dump(data, data_file, indent=2, sort_keys=True)
+            os.rename(filename + '.tmp', filename)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def locked_state():
+    """ read-modify-write of the saved state, see locked_json """
+    return locked_json(STATE_FILE_NAME, {})
+
+
+def update_state(**kwargs):
+    """ updates some keys of the saved state, keeping the others """
+    with locked_state() as state:
+        state.update(kwargs)
+
+
+def new_build_id(cloud, region, distro):
+    """ returns a unique id for a new build of the cloud/region/distro """
+    return "{}-{}-{}-{}".format(cloud, region, distro.value,
+                                datetime.utcnow().strftime("%Y%m%d%H%M%S"))
@@ -0,0 +1,134 @@
+# vim: ai ts=4 sts=4 et sw=4 ft=python fdm=indent et foldlevel=0
+
+""" Execution plans of builds, worked out without booting anything
+
+A plan lists the stages and bootstrap steps a build of a target would run,
+the ones it would skip because an image with the same fingerprint exists
+or a pooled instance is waiting, and how long each of them took in the
+past according to the metrics database. Problems in the platform config
+that would only show once an instance boots are reported as errors.
+"""
+
+import os
+from time import time
+
+from lib.metrics import percentile, stage_history, step_history
+from lib.reboots import plan_boots
+
+
+STAGES = ['up', 'bootstrap', 'tests', 'create_image', 'verify']
+HISTORY_DAYS = 60
+
+# the config keys every build of a cloud needs
+REQUIRED_KEYS = {'ec2': ['ami', 'instance_type', 'key_pair', 'key_filename',
+                         'username', 'image_basename'],
+                 'rackspace': ['ami', 'instance_type', 'key_pair',
+                               'private_key_filename', 'username',
+                               'image_basename'],
+                 'gce': ['base_image_prefix', 'base_image_project',
+                         'machine_type', 'project', 'private_key_filename',
+                         'username', 'image_basename']}
+KEY_FILES = ['key_filename', 'private_key_filename', 'public_key_filename']
+
+
+def check_config(cloud, config):
+    """ returns the problems of a platform config, as messages """
+    problems = []
+    for key in REQUIRED_KEYS[cloud]:
+        if not config.get(key):
+            problems.append('{} is not set'.format(key))
+    for key in KEY_FILES:
+        path = config.get(key)
+        if path and not os.path.isfile(os.path.expanduser(path)):
+            problems.append('{} {} does not exist'.format(key, path))
+        elif path and not os.access(os.path.expanduser(path), os.R_OK):
+            problems.append('{} {} is not readable'.format(key, path))
+    return problems
+
+
+class History(object):
+    """ past stage and step durations, from the metrics database """
+
+    def __init__(self, days=HISTORY_DAYS):
+        since = time() - days * 24 * 60 * 60
+        self.stages = stage_history(since)
+        self.steps = {}
+        for (stage, step), durations in step_history(since).items():
+            self.steps.setdefault(step, []).extend(durations)
+
+    def stage(self, name):
+        return percentile(self.stages.get(name, []), 0.5)
+
+    def step(self, name):
+        return percentile(self.steps.get(name, []), 0.5)
+
+
+def plan_build(target, steps, history, up_to_date=None, pooled=0):
+    """ returns the plan of building target
+
+    :param tuple target: (cloud, region, distribution)
+    :param list steps: the bootstrap steps of the target
+    :param History history: the past durations
+    :param dict up_to_date: the image with the same fingerprint, if any
+    :param int pooled: the fresh instances in the warm pool of the target
+    """
+    plan = {'target': '/'.join(target), 'stages': [], 'estimate': 0}
+    for stage in STAGES:
+        entry = {'stage': stage, 'estimate': history.stage(stage)}
+        if up_to_date is not None and stage != 'up':
+            entry['skip'] = 'up to date with {}'.format(
+                up_to_date['image_id'])
+            entry['estimate'] = 0
+        elif stage == 'up' and up_to_date is not None:
+            entry['note'] = 'finds {}'.format(up_to_date['image_id'])
+            entry['estimate'] = 0
+        elif stage == 'up' and pooled:
+            entry['note'] = 'claims one of {} pooled instances'.format(
+                pooled)
+        elif stage == 'bootstrap':
+            entry['boots'] = []
+            boots, pending = plan_boots(steps)
+            for boot in boots:
+                entry['boots'].append([{'step': step.name,
+                                        'estimate': history.step(step.name)}
+                                       for step in boot])
+            entry['reboots'] = len(boots) - 1 + int(pending)
+            entry['reboot_pending'] = pending
+            if entry['estimate'] is None:
+                known = [step['estimate'] for boot in entry['boots']
+                         for step in boot if step['estimate'] is not None]
+                entry['estimate'] = sum(known) if known else None
+        plan['stages'].append(entry)
+        if entry['estimate'] is None:
+            plan['estimate'] = None
+        elif plan['estimate'] is not None:
+            plan['estimate'] += entry['estimate']
+    return plan
+
+
+def _seconds(value):
+    return '?' if value is None else '{}s'.format(int(value))
+
+
+def format_plan(plan):
+    """ returns the plan of a build as text lines """
+    lines = ['{}: {}'.format(plan['target'], _seconds(plan['estimate']))]
+    for problem in plan.get('errors', []):
+        lines.append('  ERROR {}'.format(problem))
+    for stage in plan['stages']:
+        line = '  {:<14} {:>7}'.format(stage['stage'],
+                                       _seconds(stage['estimate']))
+        if 'skip' in stage:
+            line += '  skipped, {}'.format(stage['skip'])
+        if 'note' in stage:
+            line += '  {}'.format(stage['note'])
+        lines.append(line)
+        for index, boot in enumerate(stage.get('boots', [])):
+            if index:
+                lines.append('    -- reboot --')
+            for step in boot:
+                lines.append('    {:<40} {:>7}'.format(
+                    step['step'], _seconds(step['estimate'])))
+        if stage.get('reboot_pending'):
+            lines.append('    -- reboot --')
+    return lines
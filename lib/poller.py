@@ -0,0 +1,346 @@
+# vim: ai ts=4 sts=4 et sw=4 ft=python fdm=indent et foldlevel=0
+
+""" Batched polling of instance and image states, shared between builds
+
+Every build waiting for an instance or an image registers its id in the
+poll file, under the cloud and region it lives in. Whichever waiter finds
+a poll due takes the lease and describes all registered ids of that cloud
+and region with one API call per kind, and the other waiters pick their
+state up from the poll file. The interval starts short, grows while nothing
+changes and drops back once a state changed.
+
+Point CI_SLAVE_POLL_FILE at a shared path to share polls between jenkins
+workspaces on the same controller.
+"""
+
+import os
+from time import sleep, time
+
+from lib.mycookbooks import locked_json
+from lib.throttle import throttled_call
+
+
+POLL_FILE_NAME = os.environ.get('CI_SLAVE_POLL_FILE', '.poll.json')
+MIN_INTERVAL = 2
+MAX_INTERVAL = 30
+BACKOFF = 1.5
+# how often waiters look at the poll file, which costs no API call
+CHECK_INTERVAL = 1
+# a poller that died holding the lease loses it after this long
+LEASE = 120
+TIMEOUT = 30 * 60
+
+INSTANCE = 'instance'
+IMAGE = 'image'
+
+# the states of all clouds map to these
+PENDING = 'pending'
+RUNNING = 'running'
+STOPPED = 'stopped'
+TERMINATED = 'terminated'
+AVAILABLE = 'available'
+FAILED = 'failed'
+MISSING = 'missing'
+
+EC2_STATES = {'pending': PENDING,
+              'running': RUNNING,
+              'stopping': PENDING,
+              'stopped': STOPPED,
+              'shutting-down': PENDING,
+              'terminated': TERMINATED,
+              'available': AVAILABLE,
+              'failed': FAILED}
+
+RACKSPACE_STATES = {'BUILD': PENDING,
+                    'REBOOT': PENDING,
+                    'HARD_REBOOT': PENDING,
+                    'ACTIVE': RUNNING,
+                    'SHUTOFF': STOPPED,
+                    'DELETED': TERMINATED,
+                    'ERROR': FAILED,
+                    'SAVING': PENDING,
+                    'QUEUED': PENDING}
+
+GCE_STATES = {'PROVISIONING': PENDING,
+              'STAGING': PENDING,
+              'RUNNING': RUNNING,
+              'STOPPING': PENDING,
+              'TERMINATED': STOPPED,
+              'PENDING': PENDING,
+              'READY': AVAILABLE,
+              'FAILED': FAILED}
+
+
+def instance_id(cloud, instance_state):
+    """ returns the provider id of an instance from its saved state """
+    if cloud == 'gce':
+        return instance_state['instance_name']
+    return instance_state['instance_id']
+
+
+def image_id(image):
+    """ returns the provider id of an image from the image registry """
+    if image['cloud'] == 'gce':
+        return image['image_name']
+    return image['image_id']
+
+
+def _ec2_connection(region, config):
+    import boto.ec2
+
+    credentials = config.get('credentials', {})
+    return boto.ec2.connect_to_region(
+        region,
+        aws_access_key_id=credentials.get('access_key_id'),
+        aws_secret_access_key=credentials.get('secret_access_key'))
+
+
+def _rackspace_servers(region, config):
+    import pyrax
+
+    pyrax.set_setting('identity_type', 'rackspace')
+    pyrax.set_credentials(config['access_key_id'],
+                          password=config['secret_access_key'])
+    return pyrax.connect_to_cloudservers(
+        region=None if region == 'default' else region)
+
+
+def _gce_compute(config):
+    from googleapiclient import discovery
+    from oauth2client.client import (GoogleCredentials,
+                                     SignedJwtAssertionCredentials)
+
+    if config.get('credentials_email'):
+        credentials = SignedJwtAssertionCredentials(
+            config['credentials_email'],
+            config['credentials_private_key'],
+            scope='https://www.googleapis.com/auth/compute.readonly')
+    else:
+        credentials = GoogleCredentials.get_application_default()
+    return discovery.build('compute', 'v1', credentials=credentials)
+
+
+def _describe_ec2(region, config, ids):
+    connection = _ec2_connection(region, config)
+    states = {}
+    # filters, unlike ids, don't fail the whole call for a missing id
+    if ids[INSTANCE]:
+        for instance in connection.get_only_instances(
+                filters={'instance-id': ids[INSTANCE]}):
+            states[instance.id] = EC2_STATES.get(instance.state, PENDING)
+    if ids[IMAGE]:
+        for image in connection.get_all_images(
+                filters={'image-id': ids[IMAGE]}):
+            states[image.id] = EC2_STATES.get(image.state, PENDING)
+    return states
+
+
+def _describe_rackspace(region, config, ids):
+    servers = _rackspace_servers(region, config)
+    states = {}
+    if ids[INSTANCE]:
+        for server in servers.servers.list():
+            states[server.id] = RACKSPACE_STATES.get(server.status, PENDING)
+    if ids[IMAGE]:
+        for image in servers.images.list():
+            if image.status == 'ACTIVE':
+                states[image.id] = AVAILABLE
+            else:
+                states[image.id] = RACKSPACE_STATES.get(image.status,
+                                                        PENDING)
+    return states
+
+
+def _gce_pages(collection, method, **kwargs):
+    """ yields every page of a GCE list call, following nextPageToken """
+    request = getattr(collection, method)(**kwargs)
+    while request is not None:
+        response = request.execute()
+        yield response
+        request = getattr(collection, method + '_next')(request, response)
+
+
+def _gce_names(names):
+    """ returns the list filter matching any of names """
+    return 'name eq ({})'.format('|'.join(names))
+
+
+def _describe_gce(region, config, ids):
+    compute = _gce_compute(config)
+    states = {}
+    if ids[INSTANCE]:
+        for page in _gce_pages(compute.instances(), 'aggregatedList',
+                               project=config['project'],
+                               filter=_gce_names(ids[INSTANCE])):
+            for zone in page.get('items', {}).values():
+                for instance in zone.get('instances', []):
+                    states[instance['name']] = GCE_STATES.get(
+                        instance['status'], PENDING)
+    if ids[IMAGE]:
+        for page in _gce_pages(compute.images(), 'list',
+                               project=config['project'],
+                               filter=_gce_names(ids[IMAGE])):
+            for image in page.get('items', []):
+                states[image['name']] = GCE_STATES.get(image['status'],
+                                                       PENDING)
+    return states
+
+
+DESCRIBE = {'ec2': _describe_ec2,
+            'rackspace': _describe_rackspace,
+            'gce': _describe_gce}
+
+
+def describe(cloud, region, config, ids):
+    """ returns the state of every id in one API call per kind
+
+    :param dict ids: lists of ids, keyed by INSTANCE and IMAGE
+    :return dict: the state of every id, MISSING for the unknown ones
+    """
+    states = DESCRIBE[cloud](region, config, ids)
+    return dict((resource_id, states.get(resource_id, MISSING))
+                for resource_id in ids[INSTANCE] + ids[IMAGE])
+
+
+def _named_ec2(region, config, name):
+    for instance in _ec2_connection(region, config).get_only_instances(
+            filters={'tag:Name': name}):
+        if instance.state not in ('shutting-down', 'terminated'):
+            return EC2_STATES.get(instance.state, PENDING)
+    return MISSING
+
+
+def _named_rackspace(region, config, name):
+    for server in _rackspace_servers(region, config).servers.list(
+            search_opts={'name': name}):
+        if server.name == name:
+            return RACKSPACE_STATES.get(server.status, PENDING)
+    return MISSING
+
+
+def _named_gce(region, config, name):
+    for page in _gce_pages(_gce_compute(config).instances(), 'aggregatedList',
+                           project=config['project'],
+                           filter=_gce_names([name])):
+        for zone in page.get('items', {}).values():
+            for instance in zone.get('instances', []):
+                if instance['name'] == name:
+                    return GCE_STATES.get(instance['status'], PENDING)
+    return MISSING
+
+
+DESCRIBE_NAMED = {'ec2': _named_ec2,
+                  'rackspace': _named_rackspace,
+                  'gce': _named_gce}
+
+
+def describe_named(cloud, region, config, name):
+    """ returns the state of the instance named name, before we know its
+    id, MISSING while there is none """
+    return DESCRIBE_NAMED[cloud](region, config, name)
+
+
+class SharedPoller(object):
+    """ waits for states of the instances and images in a cloud region
+
+    :param string cloud: 'ec2', 'rackspace' or 'gce'
+    :param string region: the region of the instances and images
+    :param dict config: the platform config, for the provider credentials
+    """
+
+    def __init__(self, cloud, region, config, poll_file=POLL_FILE_NAME):
+        self.cloud = cloud
+        self.region = region
+        self.config = config
+        self.poll_file = poll_file
+        self.key = '{}/{}'.format(cloud, region)
+
+    def _entry(self, polls):
+        return polls.setdefault(self.key, {'waiting': {},
+                                           'states': {},
+                                           'polled': 0,
+                                           'interval': MIN_INTERVAL,
+                                           'lease': 0})
+
+    def _release(self, states=None):
+        """ gives the lease back, publishing the states of a poll """
+        with locked_json(self.poll_file, {}) as polls:
+            entry = self._entry(polls)
+            now = time()
+            entry['lease'] = 0
+            entry['polled'] = now
+            changed = False
+            for resource_id, state in (states or {}).items():
+                previous = entry['states'].get(resource_id)
+                changed = changed or previous is None or previous[0] != state
+                entry['states'][resource_id] = [state, now]
+            if changed:
+                entry['interval'] = MIN_INTERVAL
+            else:
+                entry['interval'] = min(MAX_INTERVAL,
+                                        entry['interval'] * BACKOFF)
+            # forget the ids of waiters that went away
+            for resource_id, (kind, seen) in list(entry['waiting'].items()):
+                if seen < now - LEASE:
+                    del entry['waiting'][resource_id]
+            for resource_id, (state, observed) in list(
+                    entry['states'].items()):
+                if (resource_id not in entry['waiting'] and
+                        observed < now - LEASE):
+                    del entry['states'][resource_id]
+
+    def _poll(self, waiting):
+        """ describes the waiting ids in one go """
+        ids = {INSTANCE: [], IMAGE: []}
+        for resource_id, (kind, seen) in waiting.items():
+            ids[kind].append(resource_id)
+        try:
+            states = throttled_call(self.cloud, self.region, self.config,
+                                    'describe', describe, self.cloud,
+                                    self.region, self.config, ids)
+        except Exception:
+            self._release()
+            raise
+        self._release(states)
+
+    def wait_for(self, resource_id, kind, states, timeout=TIMEOUT):
+        """ blocks until resource_id reaches one of states
+
+        only states observed after the call are considered.
+
+        :param string kind: INSTANCE or IMAGE
+        :param tuple states: the states to wait for
+        :return string: the state reached
+        """
+        since = time()
+        while True:
+            due = False
+            with locked_json(self.poll_file, {}) as polls:
+                entry = self._entry(polls)
+                observed = entry['states'].get(resource_id)
+                if (observed and observed[1] >= since and
+                        observed[0] in states):
+                    entry['waiting'].pop(resource_id, None)
+                    return observed[0]
+                if time() > since + timeout:
+                    entry['waiting'].pop(resource_id, None)
+                    raise RuntimeError(
+                        'timed out waiting for {} {} to be {}'.format(
+                            kind, resource_id, ' or '.join(states)))
+                now = time()
+                entry['waiting'][resource_id] = [kind, now]
+                if (now >= entry['polled'] + entry['interval'] and
+                        now >= entry['lease']):
+                    due = True
+                    entry['lease'] = now + LEASE
+                    waiting = dict(entry['waiting'])
+            if due:
+                self._poll(waiting)
+            else:
+                sleep(CHECK_INTERVAL)
+
+    def state_of(self, resource_id, kind):
+        """ returns the current state of resource_id """
+        return self.wait_for(resource_id, kind,
+                             (PENDING, RUNNING, STOPPED, TERMINATED,
+                              AVAILABLE, FAILED, MISSING))
@@ -0,0 +1,98 @@
+# vim: ai ts=4 sts=4 et sw=4 ft=python fdm=indent et foldlevel=0
+
+""" Warm pool of booted base instances
+
+pool_fill keeps a number of freshly booted base instances per cloud, region
+and distribution, recorded in the pool file. up claims one of them instead
+of waiting for a new instance to boot. Instances that sat idle for longer
+than their max idle age are never claimed, pool_fill destroys them.
+
+Point CI_SLAVE_POOL_FILE at a shared path to share a pool between jenkins
+workspaces on the same controller.
+"""
+
+import os
+from time import time
+
+from lib.mycookbooks import locked_json
+
+
+POOL_FILE_NAME = os.environ.get('CI_SLAVE_POOL_FILE', '.pool.json')
+MAX_IDLE_AGE = 6 * 60 * 60
+
+
+def pool_key(cloud, region, distro):
+    return '{}/{}/{}'.format(cloud, region, distro.value)
+
+
+def _pool(pools, key):
+    return pools.setdefault(key, {'size': 0,
+                                  'max_idle_age': MAX_IDLE_AGE,
+                                  'instances': []})
+
+
+def _split_stale(pool):
+    """ removes the stale instances from pool, returns them """
+    oldest = time() - pool['max_idle_age']
+    stale = [entry for entry in pool['instances']
+             if entry['created'] < oldest]
+    pool['instances'] = [entry for entry in pool['instances']
+                         if entry['created'] >= oldest]
+    return stale
+
+
+def configure_pool(key, size, max_idle_age=MAX_IDLE_AGE):
+    """ sets how many instances to keep for key, returns the stale ones
+
+    :return tuple: the instance states to destroy, and how many instances
+        need booting to fill the pool
+    """
+    with locked_json(POOL_FILE_NAME, {}) as pools:
+        pool = _pool(pools, key)
+        pool['size'] = size
+        pool['max_idle_age'] = max_idle_age
+        stale = _split_stale(pool)
+        missing = size - len(pool['instances'])
+        return [entry['state'] for entry in stale], max(0, missing)
+
+
+def add_to_pool(key, instance_state):
+    """ records a newly booted instance in the pool """
+    with locked_json(POOL_FILE_NAME, {}) as pools:
+        _pool(pools, key)['instances'].append({'state': instance_state,
+                                               'created': time()})
+
+
+def claim_from_pool(key):
+    """ atomically takes the newest fresh instance out of the pool
+
+    :return tuple: the claimed instance state or None, and the size the
+        pool should be refilled to
+    """
+    if not os.path.isfile(POOL_FILE_NAME):
+        return None, 0
+    with locked_json(POOL_FILE_NAME, {}) as pools:
+        if key not in pools:
+            return None, 0
+        pool = pools[key]
+        oldest = time() - pool['max_idle_age']
+        fresh = [entry for entry in pool['instances']
+                 if entry['created'] >= oldest]
+        if not fresh:
+            return None, pool['size']
+        claimed = max(fresh, key=lambda entry: entry['created'])
+        pool['instances'].remove(claimed)
+        return claimed['state'], pool['size']
+
+
+def pooled_count(key):
+    """ returns how many fresh instances the pool of key holds """
+    if not os.path.isfile(POOL_FILE_NAME):
+        return 0
+    with locked_json(POOL_FILE_NAME, {}) as pools:
+        pool = pools.get(key)
+        if pool is None:
+            return 0
+        oldest = time() - pool['max_idle_age']
+        return len([entry for entry in pool['instances']
+                    if entry['created'] >= oldest])
@@ -0,0 +1,279 @@
+# vim: ai ts=4 sts=4 et sw=4 ft=python fdm=indent et foldlevel=0
+
+""" Pre-flight validation of build targets
+
+Finds out, for every (cloud, region, distribution) target and without
+booting anything, what a build would otherwise only find out minutes in:
+the environment variables missing for its cloud yaml file, a region or a
+distribution that doesn't resolve or falls back to 'default', the keys its
+cloud needs, key files that can't be read, malformed base images, and
+names that don't match the other targets of the same cloud. Optionally
+the ec2 AMIs are looked up, and the answers cached in
+CI_SLAVE_PREFLIGHT_FILE for a day.
+"""
+
+import os
+import re
+from multiprocessing.pool import ThreadPool
+from time import time
+
+import yaml
+
+from lib.mycookbooks import locked_json
+from lib.plan import check_config
+from lib.poller import AVAILABLE, IMAGE, INSTANCE, describe
+
+
+PREFLIGHT_FILE_NAME = os.environ.get('CI_SLAVE_PREFLIGHT_FILE',
+                                     '.preflight.json')
+IMAGE_CACHE_TTL = 24 * 60 * 60
+THREADS = 16
+
+DISTRIBUTIONS = {'centos7': 'centos', 'ubuntu1404': 'ubuntu'}
+AMI_ID = re.compile(r'^ami-([0-9a-f]{8}|[0-9a-f]{17})$')
+# the environment references parse_config expands
+ENV_REFERENCE = re.compile(r'^\<%= ENV\[\'(.*)\'\] %\>(.*)$')
+NAME_KEYS = ['image_basename', 'instance_name']
+
+
+class MissingEnv(object):
+    """ stands for an environment reference that can't be expanded """
+
+    def __init__(self, name):
+        self.name = name
+
+
+class _Loader(yaml.Loader):
+    """ expands environment references like parse_config, without failing
+    on the missing ones """
+
+
+def _env_constructor(loader, node):
+    name, remaining = ENV_REFERENCE.match(
+        loader.construct_scalar(node)).groups()
+    if name not in os.environ:
+        return MissingEnv(name)
+    return os.environ[name] + remaining
+
+
+_Loader.add_implicit_resolver('!pathex', ENV_REFERENCE, None)
+_Loader.add_constructor('!pathex', _env_constructor)
+
+
+def load_cloud_config(filename):
+    """ returns the parsed cloud yaml file, or the problem parsing it """
+    try:
+        with open(filename) as config_file:
+            return yaml.load(config_file, Loader=_Loader), None
+    except (IOError, yaml.YAMLError) as error:
+        return None, 'unable to parse {}: {}'.format(filename, error)
+
+
+def all_targets(cloud_configs):
+    """ every (cloud, region, distribution) of the parsed cloud configs
+
+    'default' is the fallback of the regions not listed, not a target.
+    """
+    targets = []
+    for cloud, config in cloud_configs.items():
+        if not config:
+            continue
+        for region, region_config in config['configs']['regions'].items():
+            if region == 'default':
+                continue
+            for distro in region_config['distribution']:
+                targets.append((cloud, region, distro))
+    return sorted(targets)
+
+
+def resolve(cloud_config, filename, region, distro):
+    """ resolves the config of a target like _get_platform_config
+
+    :return tuple: (config or None, errors, warnings)
+    """
+    regions = cloud_config['configs']['regions']
+    if region in regions:
+        region_config = regions[region]
+    elif 'default' in regions:
+        return None, [], ['region {} is not in {}, it falls back to '
+                          'default'.format(region, filename)]
+    else:
+        return None, ['region {} is not in {}'.format(region, filename)], []
+
+    configs = region_config['distribution']
+    if distro in configs:
+        return configs[distro], [], []
+    if 'default' in configs:
+        return configs['default'], [], [
+            '{} has no {} config for {}, it falls back to default'.format(
+                filename, distro, region)]
+    return None, ['{} has no {} config for {}'.format(filename, distro,
+                                                      region)], []
+
+
+def missing_env(config, prefix=''):
+    """ yields (key, environment variable) of the references that can't be
+    expanded """
+    for key, value in sorted(config.items()):
+        if isinstance(value, MissingEnv):
+            yield prefix + key, value.name
+        elif isinstance(value, dict):
+            for item in missing_env(value, prefix + key + '.'):
+                yield item
+
+
+def _without_missing_env(config):
+    return dict((key, None if isinstance(value, MissingEnv) else value)
+                for key, value in config.items())
+
+
+def check_target(target, cloud_config, filename):
+    """ returns the result of the static checks of target
+
+    :return dict: with the target, its resolved config, errors and
+        warnings
+    """
+    cloud, region, distro = target
+    result = {'target': '/'.join(target), 'config': None,
+              'errors': [], 'warnings': []}
+    if distro not in DISTRIBUTIONS:
+        result['errors'].append('unknown distribution {}'.format(distro))
+        return result
+    config, errors, warnings = resolve(cloud_config, filename, region,
+                                       distro)
+    result['errors'].extend(errors)
+    result['warnings'].extend(warnings)
+    if config is None:
+        # a region falling back to default resolves to the default one
+        if warnings:
+            config, _, _ = resolve(cloud_config, filename, 'default', distro)
+        if config is None:
+            return result
+    result['config'] = config
+
+    unset = set()
+    for key, name in missing_env(config):
+        result['errors'].append('{} needs ${}, which is not set'.format(
+            key, name))
+        unset.add(key)
+    for problem in check_config(cloud, _without_missing_env(config)):
+        if problem.split()[0] not in unset:
+            result['errors'].append(problem)
+
+    ami = config.get('ami')
+    if cloud == 'ec2' and ami and not isinstance(ami, MissingEnv):
+        if not AMI_ID.match(ami):
+            result['errors'].append('ami {} is not an AMI id'.format(ami))
+    family = DISTRIBUTIONS[distro]
+    for key in NAME_KEYS:
+        value = config.get(key)
+        if not value or isinstance(value, MissingEnv):
+            continue
+        for other in set(DISTRIBUTIONS.values()) - set([family]):
+            if other in value:
+                result['errors'].append('{} {} names {}, not {}'.format(
+                    key, value, other, family))
+    return result
+
+
+def check_consistency(results):
+    """ warns about targets lacking keys the other targets of the same
+    cloud and distribution set """
+    groups = {}
+    for result in results:
+        if result['config'] is not None:
+            cloud, _, distro = result['target'].split('/')
+            groups.setdefault((cloud, distro), []).append(result)
+    for group in groups.values():
+        keys = set()
+        for result in group:
+            keys.update(result['config'])
+        for result in group:
+            for key in sorted(keys - set(result['config'])):
+                result['warnings'].append(
+                    '{} is not set, other regions set it'.format(key))
+
+
+def _describe_amis(job):
+    region, config, amis = job
+    try:
+        return region, describe('ec2', region, config,
+                                {INSTANCE: [], IMAGE: amis}), None
+    except Exception as error:
+        return region, {}, str(error)
+
+
+def check_images(results):
+    """ looks the AMIs of the ec2 targets up, one call per region """
+    now = time()
+    with locked_json(PREFLIGHT_FILE_NAME, {}) as cache:
+        jobs = {}
+        for result in results:
+            cloud, region, _ = result['target'].split('/')
+            if cloud != 'ec2' or result['errors']:
+                continue
+            config = result['config']
+            cached = cache.get('{}/{}'.format(region, config['ami']))
+            if cached and now - cached['checked'] < IMAGE_CACHE_TTL:
+                continue
+            job = jobs.setdefault(region, (region, config, []))
+            if config['ami'] not in job[2]:
+                job[2].append(config['ami'])
+
+        pool = ThreadPool(min(THREADS, len(jobs) or 1))
+        try:
+            described = pool.map(_describe_amis, list(jobs.values()))
+        finally:
+            pool.close()
+        for region, states, error in described:
+            if error:
+                for result in results:
+                    if result['target'].split('/')[:2] == ['ec2', region]:
+                        result['warnings'].append(
+                            'unable to look the AMI up: {}'.format(error))
+            for ami, state in states.items():
+                cache['{}/{}'.format(region, ami)] = {'state': state,
+                                                      'checked': now}
+
+        for result in results:
+            cloud, region, _ = result['target'].split('/')
+            entry = (cloud == 'ec2' and result['config'] and
+                     cache.get('{}/{}'.format(region,
+                                              result['config'].get('ami'))))
+            if entry and entry['state'] != AVAILABLE:
+                result['errors'].append('ami {} is {} in {}'.format(
+                    result['config']['ami'], entry['state'], region))
+
+
+def validate_targets(targets, yaml_files, images=False):
+    """ validates targets, returns their results in the same order
+
+    :param list targets: (cloud, region, distribution) tuples
+    :param dict yaml_files: the yaml file of every cloud
+    :param bool images: look the ec2 AMIs up
+    """
+    cloud_configs = {}
+    parse_errors = {}
+    for cloud in set(target[0] for target in targets):
+        if cloud not in yaml_files:
+            parse_errors[cloud] = 'unknown cloud {}'.format(cloud)
+            continue
+        cloud_configs[cloud], parse_errors[cloud] = load_cloud_config(
+            yaml_files[cloud])
+
+    def check(target):
+        if parse_errors.get(target[0]):
+            return {'target': '/'.join(target), 'config': None,
+                    'errors': [parse_errors[target[0]]], 'warnings': []}
+        return check_target(target, cloud_configs[target[0]],
+                            yaml_files[target[0]])
+
+    pool = ThreadPool(min(THREADS, len(targets) or 1))
+    try:
+        results = pool.map(check, targets)
+    finally:
+        pool.close()
+    check_consistency(results)
+    if images:
+        check_images(results)
+    return results
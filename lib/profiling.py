@@ -0,0 +1,156 @@
+# vim: ai ts=4 sts=4 et sw=4 ft=python fdm=indent et foldlevel=0
+
+""" Profiles of the fab tasks, on the controller
+
+`fab profile <tasks>`, or FAB_PROFILE=1 in the environment, runs every task
+under cProfile. The profile of each task goes to profiles/, as a .prof file
+for pstats or snakeviz, with a summary of the functions with the most
+cumulative time next to it. The summary splits their time into Python time
+and network wait: sockets, select, sleeps and the locks we block on while
+the paramiko threads talk to the instance. With FAB_PROFILE the imports of
+the fabfile are profiled too, as an 'imports' profile.
+"""
+
+import cProfile
+import os
+import pstats
+import re
+from datetime import datetime
+from functools import wraps
+from time import time
+
+from fabric.api import env
+
+
+PROFILE_DIR = os.environ.get('CI_SLAVE_PROFILE_DIR', 'profiles')
+TOP = 20
+# the settings tasks don't leave a profile
+MIN_DURATION = 0.1
+
+# the builtins we spend network waits in
+WAIT_NAMES = re.compile(r"\b(recv\w*|send\w*|connect\w*|accept|select|poll|"
+                        r"sleep|acquire|wait|getaddrinfo|gethostbyname\w*)\b")
+SSL_IO = re.compile(r"'(read|write|do_handshake)' of '_ssl\.")
+
+IMPORTS = cProfile.Profile() if os.environ.get('FAB_PROFILE') else None
+if IMPORTS is not None:
+    IMPORTS.enable()
+
+
+def enabled():
+    return bool(os.environ.get('FAB_PROFILE') or env.config.get('profile'))
+
+
+def is_wait(func):
+    """ True for the builtins whose time is spent waiting on the network """
+    filename, _, name = func
+    return filename == '~' and bool(WAIT_NAMES.search(name) or
+                                    SSL_IO.search(name))
+
+
+def wait_times(stats):
+    """ returns the network wait of every function, itself or in the
+    functions it called, keyed like stats.stats
+
+    the wait of a callee is shared among its callers in proportion to the
+    time they spent in it.
+    """
+    callees = {}
+    for func, (_, _, _, _, callers) in stats.stats.items():
+        for caller, timing in callers.items():
+            callees.setdefault(caller, []).append((func, timing[3]))
+
+    waits = {}
+
+    def wait(func, stack):
+        if func in waits:
+            return waits[func]
+        if func in stack:
+            return 0
+        total = stats.stats[func][2] if is_wait(func) else 0
+        for callee, cumulative in callees.get(func, []):
+            callee_cumulative = stats.stats[callee][3]
+            if callee_cumulative:
+                total += (wait(callee, stack | set([func])) *
+                          min(1, cumulative / callee_cumulative))
+        waits[func] = total
+        return total
+
+    for func in stats.stats:
+        wait(func, set())
+    return waits
+
+
+def _location(func):
+    filename, line, name = func
+    if filename == '~':
+        return name
+    return '{}:{}({})'.format(os.path.basename(filename), line, name)
+
+
+def summarize(stats, top=TOP):
+    """ returns the summary of stats as text lines """
+    waits = wait_times(stats)
+    network = sum(stats.stats[func][2] for func in stats.stats
+                  if is_wait(func))
+    lines = ['total {:.2f}s: python {:.2f}s, network wait {:.2f}s'.format(
+        stats.total_tt, stats.total_tt - network, network),
+        '{:>9} {:>9} {:>9}  function'.format('cumul', 'python', 'network')]
+    by_cumulative = sorted(stats.stats,
+                           key=lambda func: -stats.stats[func][3])
+    for func in by_cumulative[:top]:
+        cumulative = stats.stats[func][3]
+        lines.append('{:>8.2f}s {:>8.2f}s {:>8.2f}s  {}'.format(
+            cumulative, max(0, cumulative - waits[func]), waits[func],
+            _location(func)))
+    return lines
+
+
+def save_profile(profile, name):
+    """ writes profile and its summary to PROFILE_DIR, returns the summary
+    """
+    if not os.path.isdir(PROFILE_DIR):
+        os.makedirs(PROFILE_DIR)
+    path = os.path.join(PROFILE_DIR, '{}-{}-{}'.format(
+        name, datetime.utcnow().strftime('%Y%m%d%H%M%S'), os.getpid()))
+    profile.dump_stats(path + '.prof')
+    lines = summarize(pstats.Stats(path + '.prof'))
+    with open(path + '.txt', 'w') as summary_file:
+        summary_file.write('\n'.join(lines) + '\n')
+    print('profile of {}: {}.prof'.format(name, path))
+    for line in lines:
+        print('  ' + line)
+    return lines
+
+
+def finish_import_profile():
+    """ stops profiling the imports of the fabfile and saves the profile """
+    global IMPORTS
+    if IMPORTS is not None:
+        IMPORTS.disable()
+        save_profile(IMPORTS, 'imports')
+        IMPORTS = None
+
+
+def profiled(func, name):
+    """ wraps func to run under cProfile while profiling is enabled """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not enabled():
+            return func(*args, **kwargs)
+        profile = cProfile.Profile()
+        started = time()
+        try:
+            return profile.runcall(func, *args, **kwargs)
+        finally:
+            if time() - started >= MIN_DURATION:
+                save_profile(profile, name)
+    return wrapper
+
+
+def profile_tasks(namespace):
+    """ makes every fab task of namespace profile itself when enabled """
+    for value in namespace.values():
+        # fabric's @task wraps the function, and calls it through .wrapped
+        if hasattr(value, 'wrapped') and hasattr(value, 'name'):
+            value.wrapped = profiled(value.wrapped, value.name)
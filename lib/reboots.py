@@ -0,0 +1,54 @@
+# vim: ai ts=4 sts=4 et sw=4 ft=python fdm=indent et foldlevel=0
+
+""" Plans the reboots of a bootstrap
+
+Steps don't reboot the instance themselves. A step that leaves a reboot
+pending, such as a kernel update, declares reboot_after, and a step that
+must run after that reboot lists the step in its after_reboot. The planner
+places every step in the earliest boot where its requirements hold, so that
+the reboot-free work moves ahead and all the pending reboots are coalesced
+into as few reboots as the after_reboot chains allow.
+"""
+
+from lib.steps import check_dependencies
+
+
+def plan_boots(steps):
+    """ splits the steps into the boots they run in
+
+    :param list steps: the Step objects, each declared after its requires
+        and after the steps listed in its after_reboot
+    :return tuple: the list of boots, each a list of steps in declared
+        order, and whether a reboot is still pending after the last one
+    """
+    check_dependencies(steps)
+    boot_of = {}
+    for step in steps:
+        boot = 0
+        for required in step.requires:
+            boot = max(boot, boot_of[required])
+        for rebooted in step.after_reboot:
+            if rebooted not in boot_of:
+                raise ValueError('step %s runs after the reboot of %s, which '
+                                 'is not declared before it' % (step.name,
+                                                                rebooted))
+            boot = max(boot, boot_of[rebooted] + 1)
+        boot_of[step.name] = boot
+
+    boots = [[] for _ in range(max(boot_of.values() or [0]) + 1)]
+    for step in steps:
+        boots[boot_of[step.name]].append(step)
+    pending = any(step.reboot_after for step in boots[-1])
+    return boots, pending
+
+
+def describe_plan(boots, pending):
+    """ returns a human readable summary of a plan """
+    lines = []
+    for index, boot in enumerate(boots):
+        if index:
+            lines.append('-- reboot --')
+        lines.extend(step.name for step in boot)
+    if pending:
+        lines.append('-- reboot pending --')
+    return lines
@@ -0,0 +1,269 @@
+# vim: ai ts=4 sts=4 et sw=4 ft=python fdm=indent et foldlevel=0
+
+""" Compiles bootstrap steps into a single remote shell script
+
+Every sudo() call through fabric is a network round trip with its own
+channel setup. A RemoteScript collects the shell commands of several
+bootstrap steps, uploads them to the instance once and executes them there,
+echoing progress markers that are parsed back into per-step status on the
+controller. The output of each step is streamed into its own step log.
+Every step runs under the watchdog of lib/watchdog.py.
+"""
+
+import sys
+from io import BytesIO
+from pipes import quote
+from time import sleep, time
+
+from fabric.api import sudo, run, put
+from fabric.context_managers import settings
+from fabric.utils import abort
+from bookshelf.api_v1 import log_green, log_red, log_yellow
+
+from lib.footprint import DISK_USED_COMMAND, record_disk_delta
+from lib.metrics import record_step
+from lib.steplog import current_build_logs, report_failure
+from lib.watchdog import (DEFAULT_IDLE_TIMEOUT,
+                          DEFAULT_TIMEOUT,
+                          REMOTE_PATH as WATCHDOG_PATH,
+                          RETRIES,
+                          install_watchdog,
+                          is_transient,
+                          killed_reason,
+                          retry_delay,
+                          watched)
+
+
+STEP_MARKER = '##ci-slave-step'
+
+
+def _bytes(fields):
+    """ the disk usage a marker carries, if any """
+    if fields and fields[0].isdigit():
+        return int(fields[0])
+    return None
+
+
+def disk_marker(event, step_name):
+    """ returns the command echoing the event marker of step_name, with the
+    disk usage it starts or ends with """
+    return 'echo "%s %s %s $(%s)"' % (STEP_MARKER, event, step_name,
+                                      DISK_USED_COMMAND)
+
+
+def marker_disk_used(output, step_name):
+    """ returns the disk usage the start and done markers of step_name carry
+    in output, None for a marker that is missing """
+    used = {}
+    for line in output.splitlines():
+        if STEP_MARKER not in line:
+            continue
+        fields = line.split(STEP_MARKER, 1)[1].split()
+        if len(fields) > 1 and fields[1] == step_name:
+            used[fields[0]] = _bytes(fields[2:])
+    return used.get('start'), used.get('done')
+
+
+class ProgressStream(object):
+    """ file-like object handed to fabric as the stdout of a remote script
+
+    lines carrying a STEP_MARKER are turned into log messages, everything
+    else is streamed into the StepLog of the step being executed.
+
+    :param BuildLogs logs: the build the step logs belong to
+    """
+
+    def __init__(self, logs):
+        self.logs = logs
+        self.stream = sys.stdout
+        self.buffer = ''
+        self.current_step = None
+        self.current_log = None
+        self.started = None
+        self.disk_used = None
+        self.failed_step = None
+        self.failed_output = ''
+        self.completed = []
+
+    def write(self, data):
+        self.buffer += data
+        while '\n' in self.buffer:
+            line, self.buffer = self.buffer.split('\n', 1)
+            self._handle_line(line + '\n')
+
+    def flush(self):
+        if self.buffer:
+            self._handle_line(self.buffer)
+            self.buffer = ''
+        (self.current_log or self.stream).flush()
+
+    def close(self):
+        self.flush()
+        if self.current_log is not None:
+            self.current_log.close()
+            # the step that didn't complete
+            self.failed_output = self.current_log.tail()
+            if self.failed_step is not None:
+                report_failure(self.failed_step, self.current_log)
+            self.current_log = None
+
+    def _handle_line(self, line):
+        if STEP_MARKER not in line:
+            (self.current_log or self.stream).write(line)
+            return
+        fields = line.split(STEP_MARKER, 1)[1].split()
+        if len(fields) < 2:
+            return
+        event, step_name = fields[0], fields[1]
+        if event == 'start':
+            self.current_step = step_name
+            self.current_log = self.logs.open(step_name)
+            self.started = time()
+            self.disk_used = _bytes(fields[2:])
+            log_green('... %s' % step_name)
+        elif event == 'done':
+            self.completed.append(step_name)
+            record_disk_delta(step_name, self.disk_used, _bytes(fields[2:]))
+            record_step(step_name, self.started, time() - self.started,
+                        'succeeded')
+            if self.current_log is not None:
+                self.current_log.close()
+                self.current_log = None
+        elif event == 'failed':
+            self.failed_step = step_name
+            record_step(step_name, self.started, time() - self.started,
+                        'failed')
+            log_red('... %s failed with exit code %s' % (
+                step_name, ' '.join(fields[2:])))
+
+
+class RemoteScript(object):
+    """ a shell script assembled from named bootstrap steps
+
+    :param string name: name of the script, used for the remote file name
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.steps = []
+
+    def add(self, step_name, commands, as_user=False,
+            timeout=DEFAULT_TIMEOUT, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+            retries=RETRIES):
+        """ appends a step made of a list of shell commands
+
+        :param string step_name: name reported in the progress markers
+        :param list commands: shell commands, executed in order
+        :param bool as_user: run the commands as the login user, from its
+            home directory, instead of as root
+        :param int timeout: seconds after which the step is killed
+        :param int idle_timeout: seconds without output after which the
+            step is killed
+        :param int retries: how often a transient failure is retried
+        """
+        self.steps.append((step_name, list(commands), as_user, timeout,
+                           idle_timeout, retries))
+
+    def __len__(self):
+        return len(self.steps)
+
+    def render(self):
+        """ returns the script source """
+        lines = ['#!/bin/bash',
+                 '# generated by lib/remote_script.py: %s' % self.name,
+                 'set -o pipefail',
+                 'disk_used() { %s; }' % DISK_USED_COMMAND,
+                 '']
+        for index, (step_name, commands, as_user, timeout, idle_timeout,
+                    _) in enumerate(self.steps):
+            lines.append('step_%d() {' % index)
+            lines.append('    set -e')
+            if as_user:
+                body = '\n'.join(['cd ~'] + commands)
+                lines.append('    sudo -u "$SUDO_USER" -H bash -lec %s' %
+                             quote(body))
+            else:
+                lines.extend('    %s' % command for command in commands)
+            lines.append('}')
+            lines.append('echo "%s start %s $(disk_used)"' % (STEP_MARKER,
+                                                            step_name))
+            lines.append('export -f step_%d' % index)
+            lines.append('bash %s %d %d step_%d; rc=$?' % (
+                WATCHDOG_PATH, timeout, idle_timeout, index))
+            lines.append('if [ $rc -ne 0 ]; then')
+            lines.append('    echo "%s failed %s $rc"' % (STEP_MARKER,
+                                                          step_name))
+            lines.append('    exit $rc')
+            lines.append('fi')
+            lines.append('echo "%s done %s $(disk_used)"' % (STEP_MARKER,
+                                                           step_name))
+            lines.append('')
+        return '\n'.join(lines) + '\n'
+
+    def execute(self):
+        """ uploads the script and runs it with a single sudo call
+
+        a step failing transiently is retried, with the steps after it.
+        """
+        if not self.steps:
+            return
+        install_watchdog()
+        remote_path = '/tmp/ci-slave-%s.sh' % self.name
+        attempts = {}
+        while True:
+            log_green('running %d steps as %s' % (len(self.steps),
+                                                  remote_path))
+            put(BytesIO(self.render()), remote_path, use_sudo=True,
+                mode=0o700)
+            stream = ProgressStream(current_build_logs())
+            with settings(warn_only=True):
+                result = sudo('bash %s' % remote_path, stdout=stream)
+            stream.close()
+            if not result.failed:
+                break
+            failed = stream.failed_step or stream.current_step
+            names = [step[0] for step in self.steps]
+            retries = self.steps[names.index(failed)][5] if (
+                failed in names) else 0
+            attempts[failed] = attempts.get(failed, 0) + 1
+            reason = killed_reason(stream.failed_output)
+            if (attempts[failed] > retries or
+                    not is_transient(stream.failed_output)):
+                abort('%s failed in step %s%s' % (
+                    remote_path, failed,
+                    ', killed: %s' % reason if reason else ''))
+            log_yellow('step %s failed transiently, retrying in %ds' % (
+                failed, retry_delay(attempts[failed])))
+            sleep(retry_delay(attempts[failed]))
+            self.steps = self.steps[names.index(failed):]
+        sudo('rm -f %s' % remote_path)
+
+    def execute_each(self):
+        """ runs every command with its own fabric call
+
+        the first and last command of a step carry its disk markers.
+        """
+        install_watchdog()
+        for (step_name, commands, as_user, timeout, idle_timeout,
+             _) in self.steps:
+            log_green('... %s' % step_name)
+            started = time()
+            last = len(commands) - 1
+            markers = ''
+            for index, command in enumerate(commands):
+                # the deadline is the step's, shared by its commands
+                command = watched(command, timeout - (time() - started),
+                                  idle_timeout)
+                if index == 0:
+                    command = '%s; %s' % (disk_marker('start', step_name),
+                                          command)
+                if index == last:
+                    command = '%s && %s' % (command,
+                                            disk_marker('done', step_name))
+                if as_user:
+                    output = run(command)
+                else:
+                    output = sudo(command)
+                if index in (0, last):
+                    markers += output + '\n'
+            record_disk_delta(step_name, *marker_disk_used(markers, step_name))
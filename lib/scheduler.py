@@ -0,0 +1,233 @@
+# vim: ai ts=4 sts=4 et sw=4 ft=python fdm=indent et foldlevel=0
+
+""" Runs the steps of a bootstrap segment as a dependency graph
+
+Steps whose dependencies are met are started as soon as the parallelism cap
+and their resource tags allow it. Shell-command steps are started detached
+on the instance and polled for completion. Steps with a python func drive
+fabric themselves, so they run inline on the controller, one at a time,
+while the detached steps carry on in the background. A detached step that
+failed transiently goes back to the pending steps, to start again once its
+backoff has passed.
+"""
+
+from io import BytesIO
+from time import sleep, time
+
+from fabric.api import sudo, put
+from fabric.context_managers import settings, hide
+from fabric.utils import abort
+from bookshelf.api_v1 import log_green, log_red, log_yellow
+
+from lib.footprint import record_disk_delta
+from lib.metrics import record_step
+from lib.remote_script import RemoteScript, marker_disk_used
+from lib.steplog import current_build_logs, report_failure
+from lib.steps import check_dependencies, PACKAGE_MANAGER, NETWORK, CPU
+from lib.watchdog import (install_watchdog,
+                          is_transient,
+                          killed_reason,
+                          retry_delay)
+
+
+MAX_PARALLEL = 4
+POLL_INTERVAL = 5
+
+# how many running steps may hold each resource tag at the same time
+RESOURCE_LIMITS = {
+    PACKAGE_MANAGER: 1,
+    NETWORK: 3,
+    CPU: 2,
+}
+
+
+def critical_path(steps, durations):
+    """ returns the longest chain of dependent steps, and its duration
+
+    :param list steps: the Step objects, in a valid topological order
+    :param dict durations: seconds taken by each step
+    """
+    longest = {}
+    for step in steps:
+        total, path = 0, []
+        for required in step.requires:
+            # steps of an earlier boot aren't on the path
+            if required in longest and longest[required][0] > total:
+                total, path = longest[required]
+        longest[step.name] = (total + durations.get(step.name, 0),
+                              path + [step.name])
+    if not longest:
+        return 0, []
+    return max(longest.values())
+
+
+class StepScheduler(object):
+    """ schedules a list of steps over their dependencies
+
+    :param list steps: the Step objects, each declared after its requires
+    :param int max_parallel: maximum number of steps running at once
+    :param dict resource_limits: overrides for RESOURCE_LIMITS
+    :param list done: names of the steps that ran in an earlier boot
+    """
+
+    def __init__(self, steps, max_parallel=MAX_PARALLEL,
+                 resource_limits=None, poll_interval=POLL_INTERVAL,
+                 done=()):
+        check_dependencies(steps, done)
+        self.done = set(done)
+        self.steps = list(steps)
+        self.max_parallel = max(1, max_parallel)
+        self.limits = dict(RESOURCE_LIMITS)
+        self.limits.update(resource_limits or {})
+        self.poll_interval = poll_interval
+        self.pending = list(steps)
+        self.running = {}
+        self.started = {}
+        self.durations = {}
+        self.attempts = {}
+        self.not_before = {}
+
+    def _in_use(self, resource):
+        return len([step for step in self.running.values()
+                    if resource in step.resources])
+
+    def _can_start(self, step):
+        if len(self.running) >= self.max_parallel:
+            return False
+        if time() < self.not_before.get(step.name, 0):
+            return False
+        if any(required not in self.durations and
+               required not in self.done
+               for required in step.requires):
+            return False
+        return all(self._in_use(resource) < self.limits.get(
+                   resource, self.max_parallel)
+                   for resource in step.resources)
+
+    def _remote_path(self, name, step, suffix):
+        return '/tmp/ci-slave-%s-%s.%s' % (name, step.name, suffix)
+
+    def _launch(self, step, name):
+        """ starts a shell-command step detached on the instance """
+        log_green('... starting %s' % step.name)
+        install_watchdog()
+        script = RemoteScript('%s-%s' % (name, step.name))
+        script.add(step.name, step.commands, as_user=step.as_user,
+                   timeout=step.timeout, idle_timeout=step.idle_timeout)
+        path = self._remote_path(name, step, 'sh')
+        put(BytesIO(script.render()), path, use_sudo=True, mode=0o700)
+        with settings(hide('running')):
+            sudo("rm -f %s; nohup sh -c 'bash %s > %s 2>&1; echo $? > %s' "
+                 "> /dev/null 2>&1 &" % (self._remote_path(name, step, 'rc'),
+                                         path,
+                                         self._remote_path(name, step, 'log'),
+                                         self._remote_path(name, step, 'rc')),
+                 pty=False)
+        self.pending.remove(step)
+        self.running[step.name] = step
+        self.started[step.name] = time()
+
+    def _run_inline(self, step):
+        self.pending.remove(step)
+        self.running[step.name] = step
+        self.started[step.name] = time()
+        step.run()
+        self._finish(step)
+
+    def _finish(self, step):
+        del self.running[step.name]
+        self.durations[step.name] = time() - self.started[step.name]
+        log_green('... %s done in %ds' % (step.name,
+                                          self.durations[step.name]))
+
+    def _poll(self, name):
+        """ collects the detached steps that completed """
+        detached = [step for step in self.running.values()
+                    if step.func is None]
+        if not detached:
+            return
+        checks = ' '.join(
+            'test -e {rc} && echo {step} $(cat {rc});'.format(
+                rc=self._remote_path(name, step, 'rc'), step=step.name)
+            for step in detached)
+        with settings(hide('running', 'stdout'), warn_only=True):
+            output = sudo(checks + ' true')
+        for line in output.splitlines():
+            fields = line.split()
+            if len(fields) != 2 or fields[0] not in self.running:
+                continue
+            step = self.running[fields[0]]
+            log = current_build_logs().open(step.name)
+            with settings(hide('running')):
+                step_output = sudo('cat %s' % self._remote_path(name, step,
+                                                                'log'),
+                                   stdout=log)
+            log.close()
+            if fields[1] != '0':
+                record_step(step.name, self.started[step.name],
+                            time() - self.started[step.name], 'failed')
+                report_failure(step.name, log)
+                output = log.tail()
+                attempt = self.attempts.get(step.name, 0) + 1
+                if attempt <= step.retries and is_transient(output):
+                    self._retry(step, name, attempt)
+                    continue
+                reason = killed_reason(output)
+                if reason:
+                    log_red('step %s was killed: %s' % (step.name, reason))
+                abort('step %s failed with exit code %s' % (step.name,
+                                                            fields[1]))
+            sudo('rm -f /tmp/ci-slave-%s-%s.*' % (name, step.name))
+            record_disk_delta(step.name,
+                              *marker_disk_used(step_output, step.name))
+            self._finish(step)
+            record_step(step.name, self.started[step.name],
+                        self.durations[step.name], 'succeeded')
+
+    def _retry(self, step, name, attempt):
+        """ puts a step that failed transiently back into pending """
+        log_yellow('step %s failed transiently, retrying in %ds' % (
+            step.name, retry_delay(attempt)))
+        sudo('rm -f /tmp/ci-slave-%s-%s.*' % (name, step.name))
+        del self.running[step.name]
+        self.pending.append(step)
+        self.attempts[step.name] = attempt
+        self.not_before[step.name] = time() + retry_delay(attempt)
+
+    def run(self, name):
+        """ runs all the steps, returns the seconds taken by each of them
+
+        :param string name: name of the segment, used for remote file names
+        """
+        log_green('scheduling %d steps, up to %d at once' % (
+            len(self.steps), self.max_parallel))
+        begin = time()
+        while self.pending or self.running:
+            progressed = False
+            for step in list(self.pending):
+                if step.func is None and self._can_start(step):
+                    self._launch(step, name)
+                    progressed = True
+
+            for step in self.pending:
+                if step.func is not None and self._can_start(step):
+                    self._run_inline(step)
+                    progressed = True
+                    break
+
+            if self.running:
+                if not progressed:
+                    sleep(self.poll_interval)
+                self._poll(name)
+            elif not progressed and any(step.name in self.not_before
+                                        for step in self.pending):
+                # waiting out the backoff of a retry
+                sleep(self.poll_interval)
+            elif not progressed:
+                abort('unable to schedule steps: %s' % ', '.join(
+                    step.name for step in self.pending))
+
+        total, path = critical_path(self.steps, self.durations)
+        log_yellow('%s took %ds, critical path (%ds): %s' % (
+            name, time() - begin, total, ' -> '.join(path)))
+        return self.durations
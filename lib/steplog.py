@@ -0,0 +1,180 @@
+# vim: ai ts=4 sts=4 et sw=4 ft=python fdm=indent et foldlevel=0
+
+""" Streaming, bounded-memory capture of the remote output of each step
+
+The output of every bootstrap step is streamed into its own gzip file under
+logs/<build_id>/ on the controller. Only the last few lines are kept in
+memory, so that they can be shown when a step fails.
+"""
+
+import gzip
+import os
+import re
+import sys
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+from bookshelf.api_v1 import log_red
+
+from lib.mycookbooks import has_state, load_state, locked_state
+
+
+LOG_DIR = 'logs'
+TAIL_LINES = 40
+
+# what fabric prints for every remote command it runs
+REMOTE_CALLS = ('] sudo: ', '] run: ', '] put: ', '] get: ')
+
+LOG_NAME = re.compile(r'^\d+-(.+?)(\.attempt\d+)?\.log\.gz$')
+
+
+class StepLog(object):
+    """ file-like sink for the output of one step
+
+    :param string path: path of the gzip file to stream into
+    :param int tail_lines: number of trailing lines kept in memory
+    """
+
+    def __init__(self, path, tail_lines=TAIL_LINES):
+        self.path = path
+        self._file = gzip.open(path, 'wb')
+        self._tail = deque(maxlen=tail_lines)
+        self._partial = ''
+        self.remote_calls = 0
+
+    def write(self, data):
+        if not isinstance(data, bytes):
+            self._file.write(data.encode('utf-8'))
+        else:
+            self._file.write(data)
+            data = data.decode('utf-8', 'replace')
+        lines = (self._partial + data).split('\n')
+        self._partial = lines.pop()
+        self._tail.extend(lines)
+        self.remote_calls += len([line for line in lines
+                                  if any(call in line
+                                         for call in REMOTE_CALLS)])
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        if self._partial:
+            self._tail.append(self._partial)
+            self._partial = ''
+        self._file.close()
+
+    def tail(self):
+        """ returns the last lines written to this log """
+        lines = list(self._tail)
+        if self._partial:
+            lines.append(self._partial)
+        return '\n'.join(lines)
+
+
+class BuildLogs(object):
+    """ the step logs of a single build
+
+    the path of every log is recorded under 'logs' in the build state. The
+    logs are numbered in the order they were opened, counting the logs
+    already in the directory, so that the numbering carries on across the
+    fab tasks of the build. A retried step gets a log per attempt.
+
+    :param string build_id: identifies the build, see new_build_id()
+    """
+
+    def __init__(self, build_id, log_dir=LOG_DIR):
+        self.build_id = build_id
+        self.directory = os.path.join(log_dir, build_id)
+
+    def _next_path(self, step_name):
+        names = [LOG_NAME.match(name) for name in os.listdir(self.directory)]
+        names = [match.group(1) for match in names if match]
+        attempt = names.count(step_name) + 1
+        name = '%02d-%s' % (len(names) + 1, step_name)
+        if attempt > 1:
+            name += '.attempt%d' % attempt
+        return os.path.join(self.directory, name + '.log.gz')
+
+    def open(self, step_name):
+        """ returns a new StepLog for step_name """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        if not has_state():
+            return StepLog(self._next_path(step_name))
+        # steps starting at the same time get a number each
+        with locked_state() as state:
+            log = StepLog(self._next_path(step_name))
+            state.setdefault('logs', {})[step_name] = log.path
+        return log
+
+
+def current_build_logs():
+    """ returns the BuildLogs of the build recorded in the state file """
+    build_id = 'adhoc'
+    if has_state():
+        build_id = load_state().get('build_id', build_id)
+    return BuildLogs(build_id)
+
+
+class _StepStream(object):
+    """ stands for sys.stdout or sys.stderr, writing what the thread of a
+    step prints into the log of that step
+
+    fabric prints the remote output from threads of its own, whose output
+    goes to the log of the step when a single step is running, and to the
+    console otherwise.
+
+    :param file stream: the console stream
+    :param dict logs: the log of every thread that ran a step, None once
+        its step is done
+    """
+
+    def __init__(self, stream, logs):
+        self.stream = stream
+        self.logs = logs
+
+    def _target(self):
+        logs = self.logs.copy()
+        thread = threading.current_thread().ident
+        if thread in logs:
+            return logs[thread] or self.stream
+        running = [log for log in logs.values() if log is not None]
+        if len(running) == 1:
+            return running[0]
+        return self.stream
+
+    def write(self, data):
+        self._target().write(data)
+
+    def flush(self):
+        self._target().flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+_step_logs = {}
+
+
+@contextmanager
+def redirect_output(log):
+    """ streams everything fabric prints for the step of the current thread
+    into log instead of the console """
+    if not isinstance(sys.stdout, _StepStream):
+        sys.stdout = _StepStream(sys.stdout, _step_logs)
+    if not isinstance(sys.stderr, _StepStream):
+        sys.stderr = _StepStream(sys.stderr, _step_logs)
+    thread = threading.current_thread().ident
+    _step_logs[thread] = log
+    try:
+        yield log
+    finally:
+        _step_logs[thread] = None
+
+
+def report_failure(step_name, log):
+    """ shows the tail of a failed step's log on the console """
+    log_red('step %s failed, last lines of %s:' % (step_name, log.path))
+    sys.stderr.write(log.tail() + '\n')
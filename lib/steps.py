@@ -0,0 +1,177 @@
+# vim: ai ts=4 sts=4 et sw=4 ft=python fdm=indent et foldlevel=0
+
+""" Bootstrap steps and the runner that executes them
+
+A bootstrap is described as lists of named steps. A step either carries the
+shell commands it runs on the instance, or a python callable for the steps
+built on top of bookshelf helpers that need to inspect remote state.
+
+Steps declare the steps they depend on and the resources they use, so that
+independent steps can be scheduled concurrently, see lib/scheduler.py.
+Steps also carry their deadline, idle timeout and retries, see
+lib/watchdog.py.
+"""
+
+from time import sleep, time
+
+from fabric.context_managers import settings
+from fabric.exceptions import CommandTimeout
+from bookshelf.api_v1 import log_green, log_red, log_yellow
+
+from lib.footprint import disk_used, record_disk_delta
+from lib.metrics import record_step
+from lib.remote_script import RemoteScript
+from lib.steplog import current_build_logs, redirect_output, report_failure
+from lib.watchdog import (DEFAULT_IDLE_TIMEOUT,
+                          DEFAULT_TIMEOUT,
+                          RETRIES,
+                          is_transient,
+                          killed_reason,
+                          retry_delay)
+
+
+# resource tags, see RESOURCE_LIMITS in lib/scheduler.py
+PACKAGE_MANAGER = 'package-manager'
+NETWORK = 'network'
+CPU = 'cpu'
+
+
+class Step(object):
+    """ a named unit of bootstrap work
+
+    :param string name: the name used when reporting progress
+    :param list commands: shell commands making up this step
+    :param callable func: callable driving fabric directly
+    :param bool as_user: run commands as the login user instead of root
+    :param list requires: names of the steps that must complete first
+    :param list resources: resource tags used by this step
+    :param bool reboot_after: the step leaves a reboot pending
+    :param list after_reboot: names of steps whose pending reboot must have
+        happened before this step runs, see lib/reboots.py
+    :param int timeout: seconds after which the step is killed
+    :param int idle_timeout: seconds without output after which the shell
+        commands of the step are killed
+    :param int retries: how often a transient failure is retried
+    """
+
+    def __init__(self, name, commands=None, func=None, as_user=False,
+                 requires=(), resources=(), reboot_after=False,
+                 after_reboot=(), timeout=DEFAULT_TIMEOUT,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT, retries=RETRIES):
+        if (commands is None) == (func is None):
+            raise ValueError('step %s needs either commands or a func' % name)
+        self.name = name
+        self.commands = commands
+        self.func = func
+        self.as_user = as_user
+        self.requires = tuple(requires)
+        self.resources = tuple(resources)
+        self.reboot_after = reboot_after
+        self.after_reboot = tuple(after_reboot)
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.retries = retries
+        # the tail of the log of the last failed attempt
+        self.output = ''
+
+    def __repr__(self):
+        return '<Step %s>' % self.name
+
+    def run(self):
+        """ runs the step, issuing one fabric call per command
+
+        the output of the step is streamed into its step log. A transient
+        failure is retried, with backoff.
+        """
+        attempt = 0
+        while True:
+            try:
+                return self._run_once()
+            except (Exception, SystemExit) as error:
+                attempt += 1
+                if attempt > self.retries or not (
+                        isinstance(error, CommandTimeout) or
+                        is_transient(self.output)):
+                    raise
+                log_yellow('step %s failed transiently, retrying in %ds' % (
+                    self.name, retry_delay(attempt)))
+                sleep(retry_delay(attempt))
+
+    def _run_once(self):
+        log_green('... %s' % self.name)
+        log = current_build_logs().open(self.name)
+        started = time()
+        self.output = ''
+        try:
+            with redirect_output(log):
+                if self.func is not None:
+                    before = disk_used()
+                    # bounds every remote command of the func
+                    with settings(command_timeout=self.timeout):
+                        self.func()
+                    record_disk_delta(self.name, before, disk_used())
+                else:
+                    script = RemoteScript(self.name)
+                    script.add(self.name, self.commands,
+                               as_user=self.as_user, timeout=self.timeout,
+                               idle_timeout=self.idle_timeout)
+                    script.execute_each()
+        except BaseException as error:
+            log.close()
+            self.output = log.tail()
+            record_step(self.name, started, time() - started, 'failed',
+                        log.remote_calls)
+            report_failure(self.name, log)
+            reason = killed_reason(self.output)
+            if isinstance(error, CommandTimeout):
+                reason = 'a command hung for %ds' % self.timeout
+            if reason:
+                log_red('step %s was killed: %s' % (self.name, reason))
+            raise
+        log.close()
+        record_step(self.name, started, time() - started, 'succeeded',
+                    log.remote_calls)
+
+
+def check_dependencies(steps, done=()):
+    """ makes sure every step is declared after the steps it requires
+
+    the declared order is then a valid topological order of the steps.
+
+    :param list done: names of the steps that already ran, in an earlier
+        boot
+    """
+    declared = set(done)
+    for step in steps:
+        for required in step.requires:
+            if required not in declared:
+                raise ValueError('step %s requires %s, which is not declared '
+                                 'before it' % (step.name, required))
+        declared.add(step.name)
+
+
+def run_steps(steps, name, batched=False):
+    """ runs a reboot-free list of steps in order
+
+    when batched, every run of consecutive shell-command steps is compiled
+    into a single RemoteScript, uploaded once and executed remotely.
+
+    :param list steps: the Step objects to run
+    :param string name: name of this segment, used for the script names
+    :param bool batched: compile shell-command steps into scripts
+    """
+    scripts = 0
+    pending = RemoteScript('%s-%d' % (name, scripts))
+    for step in steps:
+        if batched and step.commands is not None:
+            pending.add(step.name, step.commands, as_user=step.as_user,
+                        timeout=step.timeout,
+                        idle_timeout=step.idle_timeout,
+                        retries=step.retries)
+            continue
+        if pending:
+            pending.execute()
+            scripts += 1
+            pending = RemoteScript('%s-%d' % (name, scripts))
+        step.run()
+    pending.execute()
@@ -0,0 +1,259 @@
+# vim: ai ts=4 sts=4 et sw=4 ft=python fdm=indent et foldlevel=0
+
+""" Throttle-aware client layer in front of the cloud provider calls
+
+Every call to a provider goes through a token bucket per cloud, account
+and region, kept in the throttle file so that all the builds on the
+controller share it. The describe and list calls we make ourselves take a
+token each. A bookshelf operation such as create_from_config or destroy
+takes a single token before it starts: the many provider calls and the
+polling inside of it are bookshelf's own and are not limited one by one.
+
+When a provider throttles us the whole bucket is blocked for the
+retry-after it asked for, or an exponential backoff. Reads are then
+retried, so are idempotent operations such as destroy, a few times; other
+writes may have half happened and fail. Identical reads in flight at the
+same time in the same process share one call. The calls of other
+processes are not coalesced, their results are python objects of the
+process that made them: the waits of parallel builds, where most
+identical reads come from, are shared through the poll file instead, see
+lib/poller.py. The reads are recorded in the metrics database, the
+bookshelf operations are timed by their stages instead.
+
+Point CI_SLAVE_THROTTLE_FILE at a shared path to share the buckets between
+jenkins workspaces on the same controller.
+"""
+
+import os
+import random
+import threading
+from time import sleep, time
+
+from lib.metrics import record_api_call
+from lib.mycookbooks import locked_json
+
+
+THROTTLE_FILE_NAME = os.environ.get('CI_SLAVE_THROTTLE_FILE',
+                                    '.throttle.json')
+
+# calls per second and burst, per account and region
+RATES = {'ec2': (5.0, 20),
+         'rackspace': (2.0, 10),
+         'gce': (10.0, 20)}
+MAX_RETRIES = 6
+WRITE_RETRIES = 3
+MIN_BACKOFF = 1
+MAX_BACKOFF = 60
+
+# provider calls without side effects, safe to retry and to share
+READS = ('list_images', 'describe')
+# operations that can safely run again after being throttled
+IDEMPOTENT = ('create_from_saved_state', 'destroy')
+# methods answered from local state, without calling the provider
+LOCAL = ('get_state',)
+
+# what the providers answer when we call them too often
+THROTTLE_CODES = ('RequestLimitExceeded', 'Throttling', 'ThrottlingException',
+                  'rateLimitExceeded', 'userRateLimitExceeded', 'OverLimit')
+THROTTLE_STATUSES = (413, 429)
+
+
+def account_of(cloud, config):
+    """ returns what the provider rate limits us by, besides the region """
+    if cloud == 'ec2':
+        return config.get('credentials', {}).get('access_key_id')
+    if cloud == 'gce':
+        return config.get('project')
+    return config.get('access_key_id')
+
+
+def throttle_of(error):
+    """ tells whether error is a provider throttling us
+
+    :return tuple: whether it is, and the seconds the provider asked us to
+        wait, or None
+    """
+    status = getattr(error, 'status', None) or getattr(error, 'code', None)
+    response = getattr(error, 'resp', None)
+    if response is not None:
+        status = getattr(response, 'status', status)
+    code = getattr(error, 'error_code', None) or type(error).__name__
+    throttled = (code in THROTTLE_CODES or
+                 status in THROTTLE_STATUSES or
+                 any(name in str(error) for name in THROTTLE_CODES))
+    retry_after = getattr(error, 'retry_after', None)
+    if retry_after is None and isinstance(response, dict):
+        retry_after = response.get('retry-after')
+    try:
+        retry_after = float(retry_after) if retry_after else None
+    except ValueError:
+        retry_after = None
+    return throttled, retry_after
+
+
+class TokenBucket(object):
+    """ a token bucket shared by all processes through the throttle file """
+
+    def __init__(self, key, rate, burst, filename=THROTTLE_FILE_NAME):
+        self.key = key
+        self.rate = rate
+        self.burst = burst
+        self.filename = filename
+
+    def acquire(self):
+        """ takes a token, waiting for one if needed
+
+        :return float: the seconds waited
+        """
+        waited = 0
+        while True:
+            with locked_json(self.filename, {}) as buckets:
+                now = time()
+                bucket = buckets.setdefault(self.key, {'tokens': self.burst,
+                                                       'updated': now,
+                                                       'blocked_until': 0})
+                bucket['tokens'] = min(
+                    self.burst,
+                    bucket['tokens'] + (now - bucket['updated']) * self.rate)
+                bucket['updated'] = now
+                if now >= bucket['blocked_until'] and bucket['tokens'] >= 1:
+                    bucket['tokens'] -= 1
+                    return waited
+                delay = max(bucket['blocked_until'] - now,
+                            (1 - bucket['tokens']) / self.rate)
+            sleep(delay)
+            waited += delay
+
+    def block(self, seconds):
+        """ holds every caller of the bucket back for seconds """
+        with locked_json(self.filename, {}) as buckets:
+            bucket = buckets.setdefault(self.key, {'tokens': 0,
+                                                   'updated': time(),
+                                                   'blocked_until': 0})
+            bucket['tokens'] = 0
+            bucket['blocked_until'] = max(bucket['blocked_until'],
+                                          time() + seconds)
+
+
+class _InFlight(object):
+    """ identical reads running at the same time in this process """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def call(self, key, func):
+        with self.lock:
+            leader = key not in self.calls
+            if leader:
+                self.calls[key] = {'done': threading.Event()}
+            call = self.calls[key]
+        if not leader:
+            call['done'].wait()
+            if 'error' in call:
+                raise call['error']
+            return call['value']
+        try:
+            call['value'] = func()
+            return call['value']
+        except Exception as error:
+            call['error'] = error
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call['done'].set()
+
+
+_in_flight = _InFlight()
+
+
+def bucket_for(cloud, region, config):
+    """ returns the shared TokenBucket of the account and region """
+    rate, burst = RATES[cloud]
+    return TokenBucket(
+        '{}/{}/{}'.format(cloud, account_of(cloud, config), region),
+        rate, burst)
+
+
+def throttled_call(cloud, region, config, name, func, *args, **kwargs):
+    """ calls func through the bucket of its account and region
+
+    throttled reads are retried after the backoff, and so are idempotent
+    operations, fewer times. Other throttled writes may have half happened
+    and are not. Only the reads are recorded as api calls.
+    """
+    bucket = bucket_for(cloud, region, config)
+    if name in READS:
+        max_retries = MAX_RETRIES
+    elif name in IDEMPOTENT:
+        max_retries = WRITE_RETRIES
+    else:
+        max_retries = 0
+    retries = 0
+    throttles = 0
+    started = time()
+    while True:
+        bucket.acquire()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as error:
+            throttled, retry_after = throttle_of(error)
+            if throttled:
+                throttles += 1
+                bucket.block(retry_after or min(
+                    MAX_BACKOFF,
+                    MIN_BACKOFF * 2 ** retries * (1 + random.random())))
+                if retries < max_retries:
+                    retries += 1
+                    continue
+            if name in READS:
+                record_api_call(cloud, region, name, started,
+                                time() - started, throttles,
+                                'throttled' if throttled else 'failed')
+            raise
+        if name in READS:
+            record_api_call(cloud, region, name, started, time() - started,
+                            throttles, 'succeeded')
+        return result
+
+
+class ThrottledClient(object):
+    """ proxies a provider object, sending every call through the throttle
+
+    bookshelf instances and instance factories are wrapped, and so are the
+    instances the wrapped factories return.
+
+    :param object target: the object to proxy
+    :param string cloud: 'ec2', 'rackspace' or 'gce'
+    :param string region: the region the calls go to
+    :param dict config: the platform config, for the account
+    """
+
+    def __init__(self, target, cloud, region, config):
+        self._target = target
+        self._cloud = cloud
+        self._region = region
+        self._config = config
+
+    def __getattr__(self, name):
+        attribute = getattr(self._target, name)
+        if not callable(attribute) or name in LOCAL:
+            return attribute
+
+        def throttled(*args, **kwargs):
+            def call():
+                return throttled_call(self._cloud, self._region,
+                                      self._config, name, attribute,
+                                      *args, **kwargs)
+            if name in READS:
+                result = _in_flight.call((id(self._target), name, repr(args),
+                                          repr(sorted(kwargs.items()))),
+                                         call)
+            else:
+                result = call()
+            if hasattr(result, 'get_state'):
+                return ThrottledClient(result, self._cloud, self._region,
+                                       self._config)
+            return result
+        return throttled
@@ -0,0 +1,124 @@
+# vim: ai ts=4 sts=4 et sw=4 ft=python fdm=indent et foldlevel=0
+
+""" Deadlines, hang detection and retries of the bootstrap steps
+
+The shell commands of the steps run on the instance under a small watchdog
+script, in a process group of their own. The watchdog kills the group once
+the step runs past its deadline, or once its output stays quiet for longer
+than its idle timeout, so that a hung apt-get, wget or curl doesn't hold
+the build, or the package manager lock, until the jenkins job times out.
+The steps built on bookshelf helpers drive fabric themselves, every remote
+command they issue is bounded by the deadline of the step instead.
+
+A step that failed with the output of a transient failure, a mirror or
+network error, a package manager lock, or a hang, is retried with backoff.
+"""
+
+import re
+from io import BytesIO
+from pipes import quote
+
+from fabric.api import env, put
+
+
+REMOTE_PATH = '/tmp/ci-slave-watchdog.sh'
+MARKER = '##ci-slave-watchdog'
+
+DEFAULT_TIMEOUT = 45 * 60
+DEFAULT_IDLE_TIMEOUT = 15 * 60
+RETRIES = 2
+BACKOFF = 30
+
+TRANSIENT_PATTERNS = [re.compile(pattern) for pattern in [
+    MARKER + ' killed',
+    # package manager locks
+    r'Could not get lock /var/lib/(dpkg|apt)',
+    r'Unable to lock the administration directory',
+    r'Another app is currently holding the yum lock',
+    # mirrors and the network
+    r'Failed to fetch',
+    r'Hash Sum mismatch',
+    r'Cannot retrieve repository metadata',
+    r'No more mirrors to try',
+    r'Temporary failure (resolving|in name resolution)',
+    r'Could not resolve host',
+    r'Connection (timed out|reset by peer|refused)',
+    r'Failed to connect to',
+    r'HTTP Error 5\d\d',
+    r'ERROR 5\d\d',
+    r'curl: \((6|7|18|28|35|52|56)\)',
+]]
+
+SCRIPT = r"""#!/bin/bash
+# generated by lib/watchdog.py: watchdog.sh <deadline> <idle> <command>
+deadline=$1
+idle=$2
+output=$(mktemp /tmp/ci-slave-watchdog.XXXXXX)
+setsid bash -c "$3" < /dev/null > "$output" 2>&1 &
+pid=$!
+tail -n +1 -s 0.1 --pid=$pid -f "$output" &
+tailer=$!
+(
+    started=$(date +%s)
+    while kill -0 $pid 2> /dev/null; do
+        sleep 5
+        now=$(date +%s)
+        if [ $((now - started)) -ge $deadline ]; then
+            reason="past its deadline of ${deadline}s"
+        elif [ $((now - $(stat -c %Y "$output"))) -ge $idle ]; then
+            reason="no output for ${idle}s"
+        else
+            continue
+        fi
+        printf '\nMARKER killed: %s\n' "$reason"
+        kill -TERM -- -$pid 2> /dev/null
+        sleep 10
+        kill -KILL -- -$pid 2> /dev/null
+        exit
+    done
+) &
+watcher=$!
+wait $pid
+rc=$?
+wait $tailer
+kill $watcher 2> /dev/null
+rm -f "$output"
+exit $rc
+""".replace('MARKER', MARKER)
+
+_installed = set()
+
+
+def install_watchdog():
+    """ uploads the watchdog script to the current host, once """
+    if env.host_string not in _installed:
+        put(BytesIO(SCRIPT.encode('utf-8')), REMOTE_PATH, use_sudo=True,
+            mode=0o755)
+        _installed.add(env.host_string)
+
+
+def forget_watchdog():
+    """ the host rebooted, and may have cleared /tmp """
+    _installed.discard(env.host_string)
+
+
+def watched(command, timeout, idle_timeout):
+    """ returns command wrapped in the watchdog """
+    return 'bash %s %d %d %s' % (REMOTE_PATH, max(1, timeout), idle_timeout,
+                                 quote(command))
+
+
+def is_transient(output):
+    """ True when output shows a failure worth retrying """
+    return any(pattern.search(output) for pattern in TRANSIENT_PATTERNS)
+
+
+def killed_reason(output):
+    """ why the watchdog killed the command of output, or None """
+    match = re.search(MARKER + r' killed: (.*)', output)
+    return match and match.group(1).strip()
+
+
+def retry_delay(attempt):
+    """ seconds to wait before the given retry, counting from 1 """
+    return BACKOFF * 2 ** (attempt - 1)
@@ -0,0 +1,382 @@
+# vim: ai ts=4 sts=4 et sw=4 ft=python fdm=indent et foldlevel=0
+
+""" Work queue of builds shared between controllers
+
+fab enqueue adds targets to a queue, and queue workers started on any
+number of controllers claim them, longest expected build first, and build
+them the way fab matrix does. A claim is a lease that the worker renews
+while the build runs. When a worker dies its lease expires, and the target
+goes to the next worker that asks for one, which destroys the instance the
+previous attempt left behind before building again. A target whose leases
+expired MAX_ATTEMPTS times fails.
+
+Every claim gets a new token, and renewing or completing a lease takes the
+token of the claim. A worker that was only late to renew finds its token
+stale, kills its build and fences the token. The next worker destroys the
+previous attempt only once its token is fenced, or a lease later, when its
+worker can be taken for dead.
+
+The queue lives in an SQLite database, which controllers share by putting
+it on a shared filesystem, see CI_SLAVE_QUEUE. A queue named *.json is kept
+in a json file instead, a stand-in for trying the workers out on a single
+controller. Other backends only need to provide _transaction().
+"""
+
+import json
+import os
+import socket
+import sqlite3
+from contextlib import closing, contextmanager
+from time import sleep, time
+
+from bookshelf.api_v1 import log_green, log_red, log_yellow
+
+from lib.matrix import (CLOUD_LIMITS,
+                        STAGES,
+                        kill_fab,
+                        start_fab,
+                        target_name)
+from lib.mycookbooks import locked_json
+
+
+QUEUE_LOCATION = os.environ.get('CI_SLAVE_QUEUE', 'queue.db')
+LEASE = 5 * 60
+POLL_INTERVAL = 10
+MAX_ATTEMPTS = 3
+LOG_DIR = os.path.join('logs', 'queue')
+
+QUEUED = 'queued'
+CLAIMED = 'claimed'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+
+COLUMNS = ['id', 'target', 'tasks', 'expected', 'status', 'worker',
+           'lease_expires', 'attempts', 'enqueued', 'finished', 'token',
+           'fenced']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    id INTEGER PRIMARY KEY,
+    target TEXT,
+    tasks TEXT,
+    expected REAL,
+    status TEXT,
+    worker TEXT,
+    lease_expires REAL,
+    attempts INTEGER,
+    enqueued REAL,
+    finished REAL,
+    token INTEGER,
+    fenced INTEGER
+);
+"""
+
+
+def worker_name():
+    return '{}-{}'.format(socket.gethostname(), os.getpid())
+
+
+def _expired(entry, now):
+    return entry['status'] == CLAIMED and entry['lease_expires'] < now
+
+
+def _holds(entry, entry_id, worker, token):
+    return (entry['id'] == entry_id and
+            entry['status'] == CLAIMED and
+            entry['worker'] == worker and
+            entry.get('token') == token)
+
+
+class WorkQueue(object):
+    """ the queue operations, on top of the transaction of a backend
+
+    entries are dicts with the COLUMNS keys, the target is stored as
+    cloud/region/distribution.
+    """
+
+    def _transaction(self):
+        """ context manager yielding the list of entries, for the caller to
+        modify in place, and storing them when the caller is done """
+        raise NotImplementedError
+
+    def entries(self):
+        with self._transaction() as entries:
+            return [dict(entry) for entry in entries]
+
+    def enqueue(self, target, tasks=(), expected=0):
+        """ adds a build of target, unless one is already waiting """
+        name = '/'.join(target)
+        with self._transaction() as entries:
+            for entry in entries:
+                if (entry['target'] == name and
+                        entry['status'] in (QUEUED, CLAIMED)):
+                    return False
+            entries.append({'id': max([entry['id'] for entry in entries] +
+                                      [0]) + 1,
+                            'target': name,
+                            'tasks': list(tasks),
+                            'expected': expected,
+                            'status': QUEUED,
+                            'worker': None,
+                            'lease_expires': None,
+                            'attempts': 0,
+                            'enqueued': time(),
+                            'finished': None,
+                            'token': 0,
+                            'fenced': 0})
+            return True
+
+    def claim(self, worker, lease=LEASE, cloud_limits=CLOUD_LIMITS):
+        """ leases the longest waiting build to worker, returns its entry
+
+        expired leases are given to the next worker, up to MAX_ATTEMPTS.
+        Builds of a cloud with cloud_limits builds running wait.
+        """
+        now = time()
+        with self._transaction() as entries:
+            per_cloud = {}
+            for entry in entries:
+                if _expired(entry, now) and entry['attempts'] >= MAX_ATTEMPTS:
+                    entry['status'] = FAILED
+                    entry['finished'] = now
+                elif entry['status'] == CLAIMED and not _expired(entry, now):
+                    cloud = entry['target'].split('/')[0]
+                    per_cloud[cloud] = per_cloud.get(cloud, 0) + 1
+
+            claimable = [entry for entry in entries
+                         if entry['status'] == QUEUED or _expired(entry, now)]
+            claimable.sort(key=lambda entry: -entry['expected'])
+            for entry in claimable:
+                cloud = entry['target'].split('/')[0]
+                if per_cloud.get(cloud, 0) >= cloud_limits.get(cloud,
+                                                               len(entries)):
+                    continue
+                entry.update(status=CLAIMED,
+                             worker=worker,
+                             lease_expires=now + lease,
+                             attempts=entry['attempts'] + 1,
+                             token=(entry.get('token') or 0) + 1)
+                return dict(entry)
+        return None
+
+    def renew(self, entry_id, worker, token, lease=LEASE):
+        """ extends the lease of the claim token, False when it lost it """
+        with self._transaction() as entries:
+            for entry in entries:
+                if _holds(entry, entry_id, worker, token):
+                    entry['lease_expires'] = time() + lease
+                    return True
+        return False
+
+    def complete(self, entry_id, worker, token, passed):
+        """ records the outcome of the build of the claim token """
+        with self._transaction() as entries:
+            for entry in entries:
+                if _holds(entry, entry_id, worker, token):
+                    entry['status'] = SUCCEEDED if passed else FAILED
+                    entry['finished'] = time()
+                    return True
+        return False
+
+    def fence(self, entry_id, token):
+        """ records that the build of the claim token was stopped """
+        with self._transaction() as entries:
+            for entry in entries:
+                if entry['id'] == entry_id:
+                    entry['fenced'] = max(entry.get('fenced') or 0, token)
+
+    def fenced(self, entry_id, token):
+        """ True once the build of the claim token is known to be stopped
+        """
+        for entry in self.entries():
+            if entry['id'] == entry_id:
+                return (entry.get('fenced') or 0) >= token
+        return False
+
+    def pending(self):
+        """ True while builds are waiting or running """
+        return any(entry['status'] in (QUEUED, CLAIMED)
+                   for entry in self.entries())
+
+
+class SQLiteQueue(WorkQueue):
+    """ the queue in an SQLite database, on a filesystem the controllers
+    share """
+
+    def __init__(self, path):
+        self.path = path
+
+    @contextmanager
+    def _transaction(self):
+        with closing(sqlite3.connect(self.path, timeout=60,
+                                     isolation_level=None)) as connection:
+            connection.executescript(SCHEMA)
+            existing = [row[1] for row in
+                        connection.execute('PRAGMA table_info(entries)')]
+            for column in COLUMNS:
+                if column not in existing:
+                    try:
+                        connection.execute(
+                            'ALTER TABLE entries ADD COLUMN {}'.format(column))
+                    except sqlite3.OperationalError:
+                        # added by another worker meanwhile
+                        pass
+            # taken for writing, so that two workers never claim one entry
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                entries = []
+                for row in connection.execute(
+                        'SELECT {} FROM entries'.format(', '.join(COLUMNS))):
+                    entry = dict(zip(COLUMNS, row))
+                    entry['tasks'] = json.loads(entry['tasks'])
+                    entries.append(entry)
+                yield entries
+                for entry in entries:
+                    row = [entry[column] for column in COLUMNS]
+                    row[COLUMNS.index('tasks')] = json.dumps(entry['tasks'])
+                    connection.execute(
+                        'INSERT OR REPLACE INTO entries ({}) '
+                        'VALUES ({})'.format(', '.join(COLUMNS),
+                                             ', '.join('?' * len(COLUMNS))),
+                        row)
+                connection.execute('COMMIT')
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+
+
+class FileQueue(WorkQueue):
+    """ the queue in a json file, for workers on a single controller """
+
+    def __init__(self, path):
+        self.path = path
+
+    def _transaction(self):
+        return locked_json(self.path, [])
+
+
+def open_queue(location=QUEUE_LOCATION):
+    if location.endswith('.json'):
+        return FileQueue(location)
+    return SQLiteQueue(location)
+
+
+class QueueWorker(object):
+    """ builds the targets it claims from queue, slots at a time
+
+    :param WorkQueue queue: the queue shared with the other workers
+    :param int slots: how many builds this worker runs at once
+    :param int lease: how long a claim lasts without being renewed
+    """
+
+    def __init__(self, queue, slots=1, lease=LEASE,
+                 poll_interval=POLL_INTERVAL, cloud_limits=CLOUD_LIMITS):
+        self.queue = queue
+        self.slots = slots
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.cloud_limits = cloud_limits
+        self.worker = worker_name()
+        self.running = {}
+        self.fencing = {}
+        self.cleanups = []
+        self.results = {}
+
+    def _state_file(self, entry):
+        """ next to the queue, where the next attempt finds it """
+        return os.path.join(os.path.dirname(os.path.abspath(self.queue.path)),
+                            '.state-queue-{}.json'.format(entry['id']))
+
+    def _log_path(self, entry):
+        return os.path.join(LOG_DIR, '{}-{}.log'.format(
+            target_name(entry['target'].split('/')), entry['id']))
+
+    def _fab(self, entry, tasks):
+        return start_fab(tuple(entry['target'].split('/')),
+                         entry['tasks'] + tasks, self._state_file(entry),
+                         self._log_path(entry))
+
+    def _start(self, entry):
+        if entry['attempts'] > 1:
+            log_yellow('{} was left by its worker, attempt {}'.format(
+                entry['target'], entry['attempts']))
+            # its worker may still be alive and only late to renew, the
+            # previous attempt is destroyed once the worker stopped it
+            self.fencing[entry['id']] = (entry, time() + self.lease)
+            return
+        log_green('starting {} (expected {}s)'.format(
+            entry['target'], int(entry['expected'])))
+        self._launch(entry)
+
+    def _launch(self, entry):
+        self.running[entry['id']] = (entry, self._fab(entry, STAGES), time())
+
+    def _fence(self):
+        """ starts the reclaimed builds whose previous attempt stopped """
+        for entry_id, (entry, deadline) in list(self.fencing.items()):
+            if (not self.queue.fenced(entry_id, entry['token'] - 1) and
+                    time() < deadline):
+                continue
+            del self.fencing[entry_id]
+            if os.path.isfile(self._state_file(entry)):
+                # the instance of the previous attempt
+                self._fab(entry, ['destroy']).wait()
+            self._launch(entry)
+
+    def _finish(self, entry_id, returncode):
+        entry, process, started = self.running.pop(entry_id)
+        duration = int(time() - started)
+        passed = returncode == 0
+        if passed:
+            log_green('{} succeeded in {}s'.format(entry['target'], duration))
+        else:
+            log_red('{} failed after {}s, see {}'.format(
+                entry['target'], duration, self._log_path(entry)))
+            if os.path.isfile(self._state_file(entry)):
+                # don't leak the instance of a failed build
+                self.cleanups.append(self._fab(entry, ['destroy']))
+        if not self.queue.complete(entry_id, self.worker, entry['token'],
+                                   passed):
+            log_red('{} was given to another worker meanwhile'.format(
+                entry['target']))
+        self.results[entry['target']] = {'passed': passed,
+                                         'duration': duration}
+
+    def _renew(self):
+        for entry_id, (entry, _) in list(self.fencing.items()):
+            if not self.queue.renew(entry_id, self.worker, entry['token'],
+                                    self.lease):
+                log_red('lost the lease of {}'.format(entry['target']))
+                del self.fencing[entry_id]
+        for entry_id, (entry, process, _) in list(self.running.items()):
+            if not self.queue.renew(entry_id, self.worker, entry['token'],
+                                    self.lease):
+                # another worker has it now, leave the build to it
+                log_red('lost the lease of {}, stopping its build'.format(
+                    entry['target']))
+                kill_fab(process)
+                self.queue.fence(entry_id, entry['token'])
+                del self.running[entry_id]
+
+    def run(self):
+        """ builds until the queue is drained, returns the results keyed by
+        target """
+        if not os.path.isdir(LOG_DIR):
+            os.makedirs(LOG_DIR)
+        log_green('worker {} started'.format(self.worker))
+        while self.running or self.fencing or self.queue.pending():
+            while len(self.running) + len(self.fencing) < self.slots:
+                entry = self.queue.claim(self.worker, self.lease,
+                                         self.cloud_limits)
+                if entry is None:
+                    break
+                self._start(entry)
+            sleep(self.poll_interval)
+            self._fence()
+            for entry_id, (_, process, _) in list(self.running.items()):
+                if process.poll() is not None:
+                    self._finish(entry_id, process.returncode)
+            self._renew()
+        for process in self.cleanups:
+            process.wait()
+        return self.results
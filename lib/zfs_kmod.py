@@ -0,0 +1,89 @@
+# vim: ai ts=4 sts=4 et sw=4 ft=python fdm=indent et foldlevel=0
+
+""" Cache of the ZFS kernel modules DKMS builds on CentOS
+
+Installing ZFS from the testing repository builds the SPL and ZFS modules
+through DKMS, one of the longest CPU-bound steps of a bootstrap. The first
+build on a kernel release and ZFS version stores the DKMS trees it built in
+the artifact store on the controller. Later builds on the same kernel
+release and ZFS version unpack them before installing ZFS, DKMS finds the
+modules already built and only installs them. Without a matching entry, or
+when the entry doesn't fit, DKMS builds the modules as before.
+
+Point CI_SLAVE_ARTIFACTS_DIR at a shared path to share the cache between
+jenkins workspaces on the same controller.
+"""
+
+import os
+
+from fabric.api import get, put, sudo
+from fabric.context_managers import hide, settings
+from bookshelf.api_v1 import (install_zfs_from_testing_repository,
+                              log_green,
+                              log_yellow)
+
+
+ARTIFACTS_DIR = os.environ.get('CI_SLAVE_ARTIFACTS_DIR', 'artifacts')
+ZFS_REPOSITORY = '--disablerepo=zfs --enablerepo=zfs-testing'
+REMOTE_ARCHIVE = '/tmp/zfs-kmod.tar.gz'
+
+
+def kernel_release():
+    with settings(hide('running', 'stdout')):
+        return sudo('uname -r').strip()
+
+
+def zfs_version():
+    """ returns the version-release of zfs yum would install, or None """
+    with settings(hide('running', 'stdout'), warn_only=True):
+        output = sudo('yum -q %s list zfs' % ZFS_REPOSITORY)
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) >= 2 and fields[0].startswith('zfs.'):
+            return fields[1]
+    return None
+
+
+def cache_path(kernel, version):
+    """ where the modules of kernel and zfs version live on the controller """
+    return os.path.join(ARTIFACTS_DIR, 'zfs-kmod', kernel,
+                        'zfs-%s.tar.gz' % version)
+
+
+def _dkms_trees(kernel):
+    """ what DKMS built and installed for kernel, relative to / """
+    return ['var/lib/dkms/spl/*/%s' % kernel,
+            'var/lib/dkms/zfs/*/%s' % kernel,
+            'lib/modules/%s/extra' % kernel]
+
+
+def install_zfs_with_kmod_cache():
+    """ installs ZFS, reusing the modules built for the same kernel """
+    kernel = kernel_release()
+    version = zfs_version()
+    path = version and cache_path(kernel, version)
+
+    if path and os.path.isfile(path):
+        log_green('using the ZFS %s modules built for %s' % (version, kernel))
+        put(path, REMOTE_ARCHIVE, use_sudo=True)
+        with settings(warn_only=True):
+            if sudo('tar -xzf %s -C /' % REMOTE_ARCHIVE).failed:
+                log_yellow('unable to unpack the cached modules, '
+                           'DKMS builds them')
+            sudo('rm -f %s' % REMOTE_ARCHIVE)
+
+    install_zfs_from_testing_repository()
+
+    if path and not os.path.isfile(path):
+        log_green('storing the ZFS %s modules built for %s' % (version,
+                                                               kernel))
+        with settings(warn_only=True):
+            archived = sudo('cd / && tar -czf %s %s' % (
+                REMOTE_ARCHIVE, ' '.join(_dkms_trees(kernel))))
+        if archived.succeeded:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            # concurrent builders may store the same entry, the last wins
+            get(REMOTE_ARCHIVE, path + '.%d.tmp' % os.getpid())
+            os.rename(path + '.%d.tmp' % os.getpid(), path)
+        sudo('rm -f %s' % REMOTE_ARCHIVE)
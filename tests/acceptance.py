@@ -1,6 +1,10 @@
 # vim: ai ts=4 sts=4 et sw=4 ft=python fdm=indent et foldlevel=0
 
 # test functions for the different image types
+#
+# every check is tagged with the bootstrap steps and the build inputs it
+# covers, so that a build can run only the checks its changes affect, see
+# lib/check_selection.py. Smoke checks are cheap and always run.
 
 
 import re
@@ -22,247 +26,327 @@ from lib.bootstrap import (local_docker_images,
 #from lib.mycookbooks import cloud_region_distro_config
 
 
-def acceptance_tests(instance):
-    """ proxy function that calls acceptance tests for speficic OS
+CHECKS = []
 
-    :param string distribution: which OS to use 'centos7', 'ubuntu1404'
-    """
-    distribution = instance.distro.value
 
-    ec2_host = "%s@%s" % (instance.username,
-                          instance.ip_address)
+def check(steps=(), inputs=(), smoke=False,
+          distributions=('centos', 'ubuntu')):
+    """ registers an acceptance check
 
-    env.host_string = ec2_host
-    env.key_filename = instance.key_filename
-
-    # run common tests for all platforms
-    acceptance_tests_common_tests_for_flocker(distribution)
-
-    if 'ubuntu' in distribution.lower():
-        acceptance_tests_on_ubuntu14_img_for_flocker(distribution)
-
-    if 'centos' in distribution.lower():
-        acceptance_tests_on_centos7_img_for_flocker(distribution)
+    :param list steps: the bootstrap steps whose work the check verifies
+    :param list inputs: the build inputs it verifies, see lib/fingerprint.py
+    :param bool smoke: cheap enough to run on every build
+    :param tuple distributions: the distributions the check applies to
+    """
+    def register(func):
+        func.steps = tuple(steps)
+        func.inputs = tuple(inputs)
+        func.smoke = smoke
+        func.distributions = tuple(distributions)
+        CHECKS.append(func)
+        return func
+    return register
 
 
-def acceptance_tests_common_tests_for_flocker(distribution):
-    """ Runs checks that are common to all platforms related to Flocker
+def checks_for(distribution):
+    """ returns the checks that apply to distribution, in order
 
     :param string distribution: which OS to use 'centos7', 'ubuntu1404'
     """
+    return [func for func in CHECKS
+            if any(name in distribution.lower()
+                   for name in func.distributions)]
 
-    with settings():
-        env.platform_family = detect.detect()
 
-        # Jenkins should call the correct interpreter based on the shebang
-        # However,
-        # We noticed that our Ubuntu /bin/bash calls were being executed
-        # as /bin/sh.
-        # So we as part of the slave image build process symlinked
-        # /bin/sh -> /bin/bash.
-        # https://clusterhq.atlassian.net/browse/FLOC-2986
-        log_green('check that /bin/sh is symlinked to bash')
-        assert file.is_link("/bin/sh")
-        assert 'bash' in run('ls -l /bin/sh')
-
-        # umask needs to be set to 022, so that the packages we build
-        # through the flocker tests have the correct permissions.
-        # otherwise rpmlint fails with permssion errors.
-        log_green('check that our umask matches 022')
-        assert '022' in run('umask')
-
-        # we need to keep the PATH so that we can run virtualenv with sudo
-        log_green('check that the environment is not reset on sudo')
-        assert sudo("sudo grep "
-                    "'Defaults:\%wheel\ \!env_reset\,\!secure_path'"
-                    " /etc/sudoers")
-
-        # the run acceptance tests fail if we don't have a known_hosts file
-        # so we make sure it exists
-        log_green('check that /root/.ssh/known_hosts exists')
-
-        # known_hosts needs to have 600 permissions
-        assert sudo("ls /root/.ssh/known_hosts")
-        assert "600" in sudo("stat -c %a /root/.ssh/known_hosts")
-
-        # fpm is used for building RPMs/DEBs
-        log_green('check that fpm is installed')
-        assert 'fpm' in sudo('gem list')
-
-        # A lot of Flocker tests use different docker images,
-        # we don't want to have to download those images every time we
-        # spin up a new slave node. So we make sure they are cached
-        # locally when we bake the image.
-        log_green('check that images have been downloaded locally')
-        for image in local_docker_images():
-            log_green(' checking %s' % image)
-            if ':' in image:
-                parts = image.split(':')
-                expression = parts[0] + '.*' + parts[1]
-                assert re.search(expression, sudo('docker images'))
-            else:
-                assert image in sudo('docker images')
-
-        # CentOS 7 provides us with a fairly old git version, we install
-        # a recent version in /usr/local/bin
-        log_green('check that git is installed locally')
-        assert file.exists("/usr/local/bin/git")
-
-        # and then update the PATH so that our new git comes first
-        log_green('check that /usr/local/bin is in path')
-        assert '/usr/local/bin/git' in run('which git')
-
-        # update pip
-        # We have a devpi cache in AWS which we will consume instead of
-        # going upstream to the PyPi servers.
-        # We specify that devpi caching server using -i \$PIP_INDEX_URL
-        # which requires as to include --trusted_host as we are not (yet)
-        # using  SSL on our caching box.
-        # The --trusted-host option is only available with pip 7
-        log_green('check that pip is the latest version')
-        assert '7.' in run('pip --version')
-
-        # The /tmp/acceptance.yaml file is deployed to the jenkins slave
-        # during bootstrapping. These are copied from the Jenkins Master
-        # /etc/slave_config directory.
-        # We just need to make sure that directory exists.
-        log_green('check that /etc/slave_config exists')
-        assert file.dir_exists("/etc/slave_config")
-        assert file.mode_is("/etc/slave_config", "777")
-
-        # pypy will be used in the acceptance tests
-        log_green('check that pypy is available')
-        assert '2.6.1' in run('pypy --version')
-
-        # the client acceptance tests run on docker instances
-        log_green('check that docker is running')
-        assert sudo('docker --version | grep "1.10."')
-        assert process.is_up("docker")
-
-
-def acceptance_tests_on_centos7_img_for_flocker(distribution):
-    """ checks that the CentOS 7 image is suitable for running the Flocker
-    acceptance tests
+def acceptance_tests(instance, names=None):
+    """ proxy function that calls acceptance tests for speficic OS
 
-    :param string distribution: which OS to use 'centos7', 'ubuntu1404'
+    :param instance: the instance to check
+    :param list names: the names of the checks to run, all of them when None
     """
-    with settings():
+    distribution = instance.distro.value
 
-        env.platform_family = detect.detect()
+    ec2_host = "%s@%s" % (instance.username,
+                          instance.ip_address)
+
+    env.host_string = ec2_host
+    env.key_filename = instance.key_filename
 
-        # disable requiretty
-        # http://tinyurl.com/peoffwk
-        log_green("check that tty are not required when sudo'ing")
-        assert sudo('grep "^\#Defaults.*requiretty" /etc/sudoers')
-
-        # the epel-release repository is required for a bunch of packages
-        log_green('assert that EPEL is installed')
-        assert package.installed('epel-release')
-
-        # make sure we installed all the packages we need
-        log_green('assert that required rpm packages are installed')
-        for pkg in centos7_required_packages():
-            # we can't check meta-packages
-            if '@' not in pkg:
-                log_green('... checking %s' % pkg)
-                assert package.installed(pkg)
-
-        # ZFS will be required for the ZFS acceptance tests
-        log_green('check that the zfs repository is installed')
-        assert package.installed('zfs-release')
-
-        log_green('check that zfs from testing repository is installed')
-        assert run(
-            'grep "SPL_DKMS_DISABLE_STRIP=y" /etc/sysconfig/spl')
-        assert run(
-            'grep "ZFS_DKMS_DISABLE_STRIP=y" /etc/sysconfig/zfs')
-        assert package.installed("zfs")
-        assert run('lsmod |grep zfs')
-
-        # We now need SELinux enabled
-        log_green('check that SElinux is enforcing')
-        assert sudo('getenforce | grep -i "enforcing"')
-
-        # And Firewalld should be running too
-        log_green('check that firewalld is enabled')
-        assert sudo("systemctl is-enabled firewalld")
-
-        # EL, won't allow us to run docker as non-root
-        # http://tinyurl.com/qfuyxjm
-        # but our tests require us to, so we add the 'centos' user to the
-        # docker group.
-        # and the jenkins bootstrapping of the node will change the
-        # docker sysconfig file to run as 'docker' group.
-        # TODO: move that jenkins code here
-        # https://clusterhq.atlassian.net/browse/FLOC-2995
-        log_green('check that centos is part of group docker')
-        assert user.exists("centos")
-        assert group.is_exists("docker")
-        assert user.is_belonging_group("centos", "docker")
-
-        # the acceptance tests look for a package in a yum repository,
-        # we provide one by starting a webserver and pointing the tests
-        # to look over there.
-        # for that we need 'nginx' installed and running
-        log_green('check that nginx is running')
-        assert package.installed('nginx')
-        assert port.is_listening(80, "tcp")
-        assert process.is_up("nginx")
-        assert sudo("systemctl is-enabled nginx")
-
-        # the client acceptance tests run on docker instances
-        log_green('check that docker is running')
-        assert sudo('rpm -q docker-engine | grep "1.10."')
-        assert process.is_up("docker")
-        assert sudo("systemctl is-enabled docker")
-
-
-def acceptance_tests_on_ubuntu14_img_for_flocker(distribution):
-    """ checks that the Ubuntu 14 image is suitable for running the Flocker
-    acceptance tests
-
-        :param string distribution: which OS to use 'centos7', 'ubuntu1404'
-    """
     with settings():
         env.platform_family = detect.detect()
 
-        # Jenkins should call the correct interpreter based on the shebang
-        # However,
-        # We noticed that our Ubuntu /bin/bash call were being executed
-        # as /bin/sh.
-        # So we as part of the slave image build process symlinked
-        # /bin/sh -> /bin/bash.
-        # https://clusterhq.atlassian.net/browse/FLOC-2986
-        log_green('check that /bin/sh is symlinked to bash')
-        assert file.is_link("/bin/sh")
-        assert 'bash' in run('ls -l /bin/sh')
-
-        # the client acceptance tests run on docker instances
-        log_green('check that docker is enabled')
-        assert 'docker' in run('ls -l /etc/init')
-
-        # make sure we installed all the packages we need
-        log_green('assert that required deb packages are installed')
-        for pkg in ubuntu14_required_packages():
-            log_green('... checking package: %s' % pkg)
+        # common checks come first, then the ones specific to the OS
+        for func in checks_for(distribution):
+            if names is None or func.__name__ in names:
+                func()
+
+
+# checks that are common to all platforms related to Flocker
+
+
+@check(steps=['symlink_sh_to_bash'], smoke=True)
+def check_sh_is_bash():
+    # Jenkins should call the correct interpreter based on the shebang
+    # However,
+    # We noticed that our Ubuntu /bin/bash calls were being executed
+    # as /bin/sh.
+    # So we as part of the slave image build process symlinked
+    # /bin/sh -> /bin/bash.
+    # https://clusterhq.atlassian.net/browse/FLOC-2986
+    log_green('check that /bin/sh is symlinked to bash')
+    assert file.is_link("/bin/sh")
+    assert 'bash' in run('ls -l /bin/sh')
+
+
+@check(steps=['fix_umask'], smoke=True)
+def check_umask():
+    # umask needs to be set to 022, so that the packages we build
+    # through the flocker tests have the correct permissions.
+    # otherwise rpmlint fails with permssion errors.
+    log_green('check that our umask matches 022')
+    assert '022' in run('umask')
+
+
+@check(steps=['disable_env_reset_on_sudo'])
+def check_env_not_reset_on_sudo():
+    # we need to keep the PATH so that we can run virtualenv with sudo
+    log_green('check that the environment is not reset on sudo')
+    assert sudo("sudo grep "
+                "'Defaults:\%wheel\ \!env_reset\,\!secure_path'"
+                " /etc/sudoers")
+
+
+@check(steps=['create_root_known_hosts'])
+def check_root_known_hosts():
+    # the run acceptance tests fail if we don't have a known_hosts file
+    # so we make sure it exists
+    log_green('check that /root/.ssh/known_hosts exists')
+
+    # known_hosts needs to have 600 permissions
+    assert sudo("ls /root/.ssh/known_hosts")
+    assert "600" in sudo("stat -c %a /root/.ssh/known_hosts")
+
+
+@check(steps=['install_fpm'])
+def check_fpm():
+    # fpm is used for building RPMs/DEBs
+    log_green('check that fpm is installed')
+    assert 'fpm' in sudo('gem list')
+
+
+@check(steps=['cache_docker_images'], inputs=['docker_images'])
+def check_docker_images_cached():
+    # A lot of Flocker tests use different docker images,
+    # we don't want to have to download those images every time we
+    # spin up a new slave node. So we make sure they are cached
+    # locally when we bake the image.
+    log_green('check that images have been downloaded locally')
+    for image in local_docker_images():
+        log_green(' checking %s' % image)
+        if ':' in image:
+            parts = image.split(':')
+            expression = parts[0] + '.*' + parts[1]
+            assert re.search(expression, sudo('docker images'))
+        else:
+            assert image in sudo('docker images')
+
+
+@check(steps=['install_recent_git_from_source', 'add_usr_local_bin_to_path'])
+def check_recent_git():
+    # CentOS 7 provides us with a fairly old git version, we install
+    # a recent version in /usr/local/bin
+    log_green('check that git is installed locally')
+    assert file.exists("/usr/local/bin/git")
+
+    # and then update the PATH so that our new git comes first
+    log_green('check that /usr/local/bin is in path')
+    assert '/usr/local/bin/git' in run('which git')
+
+
+@check(steps=['update_system_pip_to_latest_pip'])
+def check_latest_pip():
+    # update pip
+    # We have a devpi cache in AWS which we will consume instead of
+    # going upstream to the PyPi servers.
+    # We specify that devpi caching server using -i \$PIP_INDEX_URL
+    # which requires as to include --trusted_host as we are not (yet)
+    # using  SSL on our caching box.
+    # The --trusted-host option is only available with pip 7
+    log_green('check that pip is the latest version')
+    assert '7.' in run('pip --version')
+
+
+@check(steps=['create_etc_slave_config'], smoke=True)
+def check_slave_config():
+    # The /tmp/acceptance.yaml file is deployed to the jenkins slave
+    # during bootstrapping. These are copied from the Jenkins Master
+    # /etc/slave_config directory.
+    # We just need to make sure that directory exists.
+    log_green('check that /etc/slave_config exists')
+    assert file.dir_exists("/etc/slave_config")
+    assert file.mode_is("/etc/slave_config", "777")
+
+
+@check(steps=['install_python_pypy'])
+def check_pypy():
+    # pypy will be used in the acceptance tests
+    log_green('check that pypy is available')
+    assert '2.6.1' in run('pypy --version')
+
+
+@check(steps=['install_docker', 'restart_docker'], smoke=True)
+def check_docker_running():
+    # the client acceptance tests run on docker instances
+    log_green('check that docker is running')
+    assert sudo('docker --version | grep "1.10."')
+    assert process.is_up("docker")
+
+
+# checks that the CentOS 7 image is suitable for running the Flocker
+# acceptance tests
+
+
+@check(steps=['disable_requiretty_on_sudoers'], distributions=['centos'])
+def check_requiretty_disabled():
+    # disable requiretty
+    # http://tinyurl.com/peoffwk
+    log_green("check that tty are not required when sudo'ing")
+    assert sudo('grep "^\#Defaults.*requiretty" /etc/sudoers')
+
+
+@check(steps=['add_epel_yum_repository'], distributions=['centos'])
+def check_epel():
+    # the epel-release repository is required for a bunch of packages
+    log_green('assert that EPEL is installed')
+    assert package.installed('epel-release')
+
+
+@check(steps=['install_required_packages'], inputs=['packages'],
+       distributions=['centos'])
+def check_required_rpm_packages():
+    # make sure we installed all the packages we need
+    log_green('assert that required rpm packages are installed')
+    for pkg in centos7_required_packages():
+        # we can't check meta-packages
+        if '@' not in pkg:
+            log_green('... checking %s' % pkg)
             assert package.installed(pkg)
 
-        # Our tests require us to run docker as ubuntu.
-        # So we add the user ubuntu to the docker group.
-        # During bootstrapping of the node, jenkins will update the init
-        # file so that docker is running with the correct group.
-        # TODO: move that jenkins code here
-        log_green('check that ubuntu is part of group docker')
-        assert user.exists("ubuntu")
-        assert group.is_exists("docker")
-        assert user.is_belonging_group("ubuntu", "docker")
-
-        # the acceptance tests look for a package in a yum repository,
-        # we provide one by starting a webserver and pointing the tests
-        # to look over there.
-        # for that we need 'nginx' installed and running
-        log_green('check that nginx is running')
-        assert package.installed('nginx')
-        assert port.is_listening(80, "tcp")
-        assert process.is_up("nginx")
-        assert 'nginx' in run('ls -l /etc/init.d/')
+
+@check(steps=['add_zfs_yum_repository', 'install_zfs_release',
+              'install_zfs_from_testing_repository'],
+       distributions=['centos'])
+def check_zfs():
+    # ZFS will be required for the ZFS acceptance tests
+    log_green('check that the zfs repository is installed')
+    assert package.installed('zfs-release')
+
+    log_green('check that zfs from testing repository is installed')
+    assert run(
+        'grep "SPL_DKMS_DISABLE_STRIP=y" /etc/sysconfig/spl')
+    assert run(
+        'grep "ZFS_DKMS_DISABLE_STRIP=y" /etc/sysconfig/zfs')
+    assert package.installed("zfs")
+    assert run('lsmod |grep zfs')
+
+
+@check(steps=['enable_selinux'], distributions=['centos'])
+def check_selinux():
+    # We now need SELinux enabled
+    log_green('check that SElinux is enforcing')
+    assert sudo('getenforce | grep -i "enforcing"')
+
+
+@check(steps=['enable_firewalld_service'], distributions=['centos'])
+def check_firewalld():
+    # And Firewalld should be running too
+    log_green('check that firewalld is enabled')
+    assert sudo("systemctl is-enabled firewalld")
+
+
+@check(steps=['create_docker_group', 'add_user_to_docker_group'],
+       distributions=['centos'])
+def check_centos_in_docker_group():
+    # EL, won't allow us to run docker as non-root
+    # http://tinyurl.com/qfuyxjm
+    # but our tests require us to, so we add the 'centos' user to the
+    # docker group.
+    # and the jenkins bootstrapping of the node will change the
+    # docker sysconfig file to run as 'docker' group.
+    # TODO: move that jenkins code here
+    # https://clusterhq.atlassian.net/browse/FLOC-2995
+    log_green('check that centos is part of group docker')
+    assert user.exists("centos")
+    assert group.is_exists("docker")
+    assert user.is_belonging_group("centos", "docker")
+
+
+@check(steps=['install_nginx', 'start_nginx'], smoke=True,
+       distributions=['centos'])
+def check_nginx_on_centos():
+    # the acceptance tests look for a package in a yum repository,
+    # we provide one by starting a webserver and pointing the tests
+    # to look over there.
+    # for that we need 'nginx' installed and running
+    log_green('check that nginx is running')
+    assert package.installed('nginx')
+    assert port.is_listening(80, "tcp")
+    assert process.is_up("nginx")
+    assert sudo("systemctl is-enabled nginx")
+
+
+@check(steps=['install_docker', 'restart_docker'], distributions=['centos'])
+def check_docker_engine():
+    # the client acceptance tests run on docker instances
+    log_green('check that docker is running')
+    assert sudo('rpm -q docker-engine | grep "1.10."')
+    assert process.is_up("docker")
+    assert sudo("systemctl is-enabled docker")
+
+
+# checks that the Ubuntu 14 image is suitable for running the Flocker
+# acceptance tests
+
+
+@check(steps=['install_docker'], distributions=['ubuntu'])
+def check_docker_enabled():
+    # the client acceptance tests run on docker instances
+    log_green('check that docker is enabled')
+    assert 'docker' in run('ls -l /etc/init')
+
+
+@check(steps=['install_required_packages'], inputs=['packages'],
+       distributions=['ubuntu'])
+def check_required_deb_packages():
+    # make sure we installed all the packages we need
+    log_green('assert that required deb packages are installed')
+    for pkg in ubuntu14_required_packages():
+        log_green('... checking package: %s' % pkg)
+        assert package.installed(pkg)
+
+
+@check(steps=['create_docker_group', 'add_user_to_docker_group'],
+       distributions=['ubuntu'])
+def check_ubuntu_in_docker_group():
+    # Our tests require us to run docker as ubuntu.
+    # So we add the user ubuntu to the docker group.
+    # During bootstrapping of the node, jenkins will update the init
+    # file so that docker is running with the correct group.
+    # TODO: move that jenkins code here
+    log_green('check that ubuntu is part of group docker')
+    assert user.exists("ubuntu")
+    assert group.is_exists("docker")
+    assert user.is_belonging_group("ubuntu", "docker")
+
+
+@check(steps=['install_nginx'], smoke=True, distributions=['ubuntu'])
+def check_nginx_on_ubuntu():
+    # the acceptance tests look for a package in a yum repository,
+    # we provide one by starting a webserver and pointing the tests
+    # to look over there.
+    # for that we need 'nginx' installed and running
+    log_green('check that nginx is running')
+    assert package.installed('nginx')
+    assert port.is_listening(80, "tcp")
+    assert process.is_up("nginx")
+    assert 'nginx' in run('ls -l /etc/init.d/')
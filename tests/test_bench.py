@@ -0,0 +1,33 @@
+# vim: ai ts=4 sts=4 et sw=4 ft=python fdm=indent et foldlevel=0
+
+""" Stores and loads benchmarks of images, without an instance """
+
+import shutil
+import tempfile
+import unittest
+
+from lib import bench
+
+
+class BenchFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.bench_dir = bench.BENCH_DIR
+        bench.BENCH_DIR = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(bench.BENCH_DIR)
+        bench.BENCH_DIR = self.bench_dir
+
+    def test_docker_reference(self):
+        runs = [{'running': 1.0, 'ssh': 2.0}]
+        bench.save_bench('centos/systemd:latest', runs)
+        self.assertEqual(bench.load_bench('centos/systemd:latest'),
+                         bench.summarize(runs))
+
+    def test_missing(self):
+        self.assertEqual(bench.load_bench('centos/systemd'), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+# vim: ai ts=4 sts=4 et sw=4 ft=python fdm=indent et foldlevel=0
+
+""" Schedules the planned boots of the bootstraps, without an instance """
+
+import unittest
+
+from bookshelf.api_v3.cloud_instance import Distribution
+
+from lib.bootstrap import centos7_bootstrap_steps, ubuntu14_bootstrap_steps
+from lib.reboots import plan_boots
+from lib.scheduler import StepScheduler, critical_path
+
+
+def schedule(scheduler):
+    """ returns the steps in the order scheduler starts them, each step
+    finishing as soon as it starts """
+    order = []
+    while scheduler.pending:
+        startable = [step for step in scheduler.pending
+                     if scheduler._can_start(step)]
+        if not startable:
+            raise AssertionError('unable to schedule steps: %s' % ', '.join(
+                step.name for step in scheduler.pending))
+        scheduler.pending.remove(startable[0])
+        scheduler.durations[startable[0].name] = 1
+        order.append(startable[0].name)
+    return order
+
+
+class PlannedBootsTest(unittest.TestCase):
+
+    def assert_boots_schedule(self, steps):
+        boots, _ = plan_boots(steps)
+        self.assertTrue(len(boots) > 1)
+        done = []
+        for boot in boots:
+            scheduler = StepScheduler(boot, done=done)
+            self.assertEqual(sorted(schedule(scheduler)),
+                             sorted(step.name for step in boot))
+            # requires of the earlier boots are not on the path
+            critical_path(boot, scheduler.durations)
+            done.extend(step.name for step in boot)
+        self.assertEqual(sorted(done), sorted(step.name for step in steps))
+
+    def test_centos7(self):
+        self.assert_boots_schedule(
+            centos7_bootstrap_steps('centos', Distribution.CENTOS7))
+
+    def test_ubuntu14(self):
+        self.assert_boots_schedule(
+            ubuntu14_bootstrap_steps('ubuntu', Distribution.UBUNTU1404))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+# vim: ai ts=4 sts=4 et sw=4 ft=python fdm=indent et foldlevel=0
+
+""" The matrix builds the targets of the jenkins jobs """
+
+import os
+import re
+import unittest
+
+from lib.preflight import all_targets, load_cloud_config
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CLOUD_YAML_FILE = {'ec2': 'ec2.yaml',
+                   'gce': 'gce.yaml',
+                   'rackspace': 'rackspace.yaml'}
+
+
+def _strings(text):
+    return re.findall(r"'([^']*)'", text)
+
+
+def jenkins_targets():
+    """ every (cloud, region, distribution) on_clouds of jobs.groovy lists """
+    with open(os.path.join(ROOT, 'jobs.groovy')) as groovy:
+        source = groovy.read()
+    on_clouds = re.search(r'def on_clouds = \[(.*?)\n\]', source,
+                          re.DOTALL).group(1)
+    targets = []
+    for cloud, regions, distributions in re.findall(
+            r'(\w+)\s*:\s*\[\s*regions\s*:\s*\[(.*?)\]\s*,'
+            r'\s*distributions\s*:\s*\[(.*?)\]', on_clouds, re.DOTALL):
+        for region in _strings(regions):
+            for distro in _strings(distributions):
+                targets.append((cloud, region, distro))
+    return sorted(targets)
+
+
+class TargetsTest(unittest.TestCase):
+
+    def test_matrix_builds_the_jenkins_targets(self):
+        configs = dict(
+            (cloud, load_cloud_config(os.path.join(ROOT, yaml_file))[0])
+            for cloud, yaml_file in CLOUD_YAML_FILE.items())
+        self.assertEqual(all_targets(configs), jenkins_targets())
+
+
+if __name__ == '__main__':
+    unittest.main()